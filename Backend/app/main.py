@@ -1,13 +1,22 @@
 # app/main.py
 
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from psycopg.errors import Error as PsyError
 
 from app.db import close_pool, open_pool, ping
+from app.notify import notify_hub
 from app.routes import api_router
+from app.routes.hik import access_event_writer
+from app.services.company import company_registry
+from app.services.dispatch import dispatch_stream
+from app.services.flow import flow_supervisor, telemetry_ingestor
+from app.services.hik import event_deduplicator, prefilter_stats, station_map
+from app.services.node_red import node_red_outbox
+from app.services.prepaid import active_dispatches, billing_config, wallet_balances
+from app.services.storage import deferred_photo_uploader, storage_client, thumbnail_service
 
 
 @asynccontextmanager
@@ -15,15 +24,54 @@ async def lifespan(app: FastAPI):
     """
     Abre el pool de conexiones al iniciar FastAPI
     y lo cierra correctamente al apagar.
+
+    Los eventos Hik encolados y las fotos diferidas se escriben
+    antes de cerrar el pool.
+    Los caches en memoria se cargan después de que el listener
+    LISTEN/NOTIFY está conectado, para no perder cambios.
     """
 
-    await open_pool()
+    # Cada subsistema registra su cierre apenas arranca: si algo falla a
+    # mitad del arranque, se cierra sólo lo que ya estaba en marcha y en
+    # orden inverso (pool al final).
+    async with AsyncExitStack() as stack:
+        await open_pool()
+        stack.push_async_callback(close_pool)
 
-    try:
-        yield
-    finally:
-        await close_pool()
+        await notify_hub.start()
+        stack.push_async_callback(notify_hub.stop)
+
+        await company_registry.load()
+        await station_map.load()
+        await active_dispatches.load()
+        await billing_config.load()
+        await flow_supervisor.load()
+
+        await storage_client.open()
+        stack.push_async_callback(storage_client.close)
+
+        await thumbnail_service.start()
+        stack.push_async_callback(thumbnail_service.stop)
+
+        await deferred_photo_uploader.start()
+        stack.push_async_callback(deferred_photo_uploader.stop)
+
+        await access_event_writer.start()
+        stack.push_async_callback(access_event_writer.stop)
+
+        await telemetry_ingestor.start()
+        stack.push_async_callback(telemetry_ingestor.stop)
 
+        await flow_supervisor.start()
+        stack.push_async_callback(flow_supervisor.stop)
+
+        await node_red_outbox.start()
+        stack.push_async_callback(node_red_outbox.stop)
+
+        # Primero se cortan los clientes SSE para que no frenen el apagado
+        stack.push_async_callback(dispatch_stream.close)
+
+        yield
 
 app = FastAPI(
     title="DIRAC Access & Water API",
@@ -71,5 +119,31 @@ async def health():
         }
 
 
+@app.get("/health/stats")
+async def health_stats():
+    """
+    Contadores en memoria de los subsistemas (no consulta la DB).
+    """
+
+    return {
+        "ok": True,
+        "hik_prefilter": prefilter_stats(),
+        "hik_dedupe": event_deduplicator.stats(),
+        "access_events": access_event_writer.stats(),
+        "company_registry": company_registry.stats(),
+        "station_map": station_map.stats(),
+        "active_dispatches": active_dispatches.stats(),
+        "billing_config": billing_config.stats(),
+        "wallet_balances": wallet_balances.stats(),
+        "node_red_outbox": node_red_outbox.stats(),
+        "storage": storage_client.stats(),
+        "deferred_photos": deferred_photo_uploader.stats(),
+        "thumbnails": thumbnail_service.stats(),
+        "dispatch_stream": dispatch_stream.stats(),
+        "telemetry": telemetry_ingestor.stats(),
+        "flow_supervisor": {**flow_supervisor.stats(), "stations": flow_supervisor.snapshot()},
+    }
+
+
 # Todas las rutas se registran desde app/routes/__init__.py
 app.include_router(api_router)
\ No newline at end of file
@@ -0,0 +1,114 @@
+# app/notify.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import psycopg
+from psycopg import sql
+
+from app.db import CONNECT_KW, DSN
+
+logger = logging.getLogger(__name__)
+
+NotifyHandler = Callable[[str], Awaitable[None]]
+ReconnectHandler = Callable[[], Awaitable[None]]
+
+
+class NotificationHub:
+    """
+    Una única conexión dedicada (fuera del pool) que hace LISTEN
+    sobre los canales registrados y reparte cada NOTIFY a sus handlers.
+
+    Si la conexión se cae, reconecta con backoff y llama a los
+    handlers de reconexión para que los caches se recarguen completos
+    (durante el corte se pueden haber perdido notificaciones).
+    """
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, List[NotifyHandler]] = {}
+        self._reconnect_handlers: List[ReconnectHandler] = []
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+
+    def subscribe(self, channel: str, handler: NotifyHandler) -> None:
+        """
+        Registrar antes de start(): los LISTEN se hacen al conectar.
+        """
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def on_reconnect(self, handler: ReconnectHandler) -> None:
+        self._reconnect_handlers.append(handler)
+
+    async def start(self, timeout: float = 5) -> None:
+        """
+        Arranca el listener y espera (con tope) el primer LISTEN,
+        así los caches que se cargan después no pierden cambios.
+        """
+        if self._task is not None:
+            return
+
+        self._task = asyncio.create_task(self._run())
+
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("notify: el listener no conectó en %ss, sigue reintentando", timeout)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._ready.clear()
+
+    async def _run(self) -> None:
+        first = True
+        delay = 1.0
+
+        while True:
+            try:
+                conn = await psycopg.AsyncConnection.connect(
+                    DSN,
+                    autocommit=True,
+                    **CONNECT_KW,
+                )
+                async with conn:
+                    for channel in self._handlers:
+                        await conn.execute(
+                            sql.SQL("LISTEN {}").format(sql.Identifier(channel))
+                        )
+
+                    if not first:
+                        for handler in self._reconnect_handlers:
+                            try:
+                                await handler()
+                            except Exception:
+                                logger.exception("notify: falló un handler de reconexión")
+
+                    first = False
+                    delay = 1.0
+                    self._ready.set()
+
+                    async for notify in conn.notifies():
+                        for handler in self._handlers.get(notify.channel, []):
+                            try:
+                                await handler(notify.payload)
+                            except Exception:
+                                logger.exception("notify: falló un handler de %s", notify.channel)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("notify: se perdió la conexión LISTEN, reintento en %ss", delay)
+
+            self._ready.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+notify_hub = NotificationHub()
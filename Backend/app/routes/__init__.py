@@ -6,6 +6,7 @@ from app.routes.fotos.media import router as fotos_media_router
 from app.routes.hik import router as hik_router
 from app.routes.kpi import router as kpi_router
 from app.routes.stations import router as stations_router
+from app.routes.telemetry import router as telemetry_router
 from app.routes.wallet import router as wallet_router
 from app.routes.water import router as water_router
 
@@ -29,6 +30,13 @@ api_router.include_router(
 )
 
 
+# Telemetría del caudalímetro
+# telemetry.py ya define su propio prefijo /water/telemetry
+api_router.include_router(
+    telemetry_router,
+)
+
+
 # Administración de empresas
 api_router.include_router(
     company_router,
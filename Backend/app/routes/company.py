@@ -3,6 +3,7 @@ from pydantic import BaseModel, Field
 from typing import Optional
 
 from app.db import pool
+from app.services.company import company_registry
 
 router = APIRouter()
 
@@ -29,7 +30,10 @@ async def create_or_update_company(body: CompanyIn):
                 (body.name, body.code, body.pin),
             )
             row = await cur.fetchone()
-            return {"ok": True, "id": int(row[0])}
+
+    # el trigger también avisa por NOTIFY, pero así el cambio se ve ya mismo
+    await company_registry.refresh(body.code)
+    return {"ok": True, "id": int(row[0])}
 
 @router.get("")
 async def list_companies(active: bool = True):
@@ -52,4 +56,6 @@ async def deactivate_company(code: str):
             r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="company not found")
-            return {"ok": True}
+
+    await company_registry.refresh(code)
+    return {"ok": True}
@@ -1,53 +1,22 @@
 from __future__ import annotations
 
-import os
 import time
 import uuid
 from typing import Optional
 
-import httpx
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import JSONResponse
 
 from app.db import pool
+from app.services.storage import (
+    image_extension,
+    open_image_upload,
+    thumbnail_service,
+    upload_with_thumb_copy,
+)
 
 router = APIRouter(prefix="/fotos/media", tags=["fotos"])
 
-# ===== ENV =====
-SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
-SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE", "")
-STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "cargadero")
-
-
-def _public_url(object_path: str) -> str:
-    return f"{SUPABASE_URL}/storage/v1/object/public/{STORAGE_BUCKET}/{object_path}"
-
-
-async def _upload_bytes_to_supabase(*, data: bytes, content_type: str, object_path: str) -> str:
-    """
-    Sube bytes (jpg/png) a Supabase Storage usando service role y devuelve URL pública.
-    """
-    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE:
-        raise HTTPException(status_code=500, detail="Supabase env vars missing (SUPABASE_URL/SUPABASE_SERVICE_ROLE)")
-
-    upload_url = f"{SUPABASE_URL}/storage/v1/object/{STORAGE_BUCKET}/{object_path}"
-    headers = {
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
-        "Content-Type": content_type,
-        "x-upsert": "true",
-    }
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(upload_url, content=data, headers=headers)
-
-    if r.status_code not in (200, 201):
-        raise HTTPException(
-            status_code=502,
-            detail={"supabase_status": r.status_code, "supabase_body": r.text},
-        )
-
-    return _public_url(object_path)
-
 
 @router.post("/dispatch/{dispatch_id}/truck")
 async def upload_truck_photo_for_dispatch(
@@ -60,15 +29,11 @@ async def upload_truck_photo_for_dispatch(
     ✅ Adjunta foto del camión a un despacho EXISTENTE.
     - Sube a Supabase Storage
     - Actualiza water_dispatch.photo_path
+    - Genera el thumbnail en segundo plano
     - Devuelve la URL pública
     """
-    content_type = (file.content_type or "").lower()
-    if content_type not in ("image/jpeg", "image/jpg", "image/png"):
-        raise HTTPException(status_code=415, detail=f"Unsupported content-type: {file.content_type}")
-
-    data = await file.read()
-    if not data or len(data) < 1000:
-        raise HTTPException(status_code=400, detail="File empty or too small")
+    # sólo se lee el primer chunk para validar; el resto va por streaming
+    first_chunk, content_type = await open_image_upload(file)
 
     # Buscar station_id si no lo mandan
     if not station_id:
@@ -82,25 +47,28 @@ async def upload_truck_photo_for_dispatch(
 
     safe_station = (station_id or "UNKNOWN").upper().replace(" ", "_")
     ts = int(time.time())
-    ext = ".png" if content_type == "image/png" else ".jpg"
+    ext = image_extension(content_type)
 
     object_path = f"photos/dispatch_{safe_station}/{suffix}_{ts}_{uuid.uuid4().hex[:8]}{ext}"
 
-    public_url = await _upload_bytes_to_supabase(
-        data=data,
-        content_type=content_type,
-        object_path=object_path,
-    )
+    public_url, thumb_path = await upload_with_thumb_copy(file, first_chunk, content_type, object_path)
+    thumb_sources = [(public_url, object_path, thumb_path)] if thumb_path else []
 
     # Update dispatch.photo_path
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                "UPDATE public.water_dispatch SET photo_path=%s WHERE id=%s RETURNING id",
-                (public_url, dispatch_id),
-            )
-            r = await cur.fetchone()
-            if not r:
-                raise HTTPException(status_code=404, detail="dispatch not found")
+    try:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE public.water_dispatch SET photo_path=%s WHERE id=%s RETURNING id",
+                    (public_url, dispatch_id),
+                )
+                r = await cur.fetchone()
+                if not r:
+                    raise HTTPException(status_code=404, detail="dispatch not found")
+    except BaseException:
+        thumbnail_service.discard(thumb_sources)
+        raise
+
+    thumbnail_service.schedule(dispatch_id, thumb_sources)
 
     return JSONResponse({"ok": True, "dispatch_id": dispatch_id, "photo_path": public_url})
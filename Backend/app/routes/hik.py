@@ -1,26 +1,63 @@
 from __future__ import annotations
 import os
 import json
+import asyncio
+import logging
 import datetime
-from typing import Any, Dict, Optional
+import tempfile
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
-import httpx
 import xmltodict
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
+from psycopg.types.json import Jsonb
 
 from app.db import pool
+from app.services.company import company_registry
+from app.services.flow import flow_supervisor
+from app.services.node_red import node_red_outbox
+from app.services.prepaid import (
+    active_dispatches,
+    authorization_error,
+    billing_config,
+    prepaid_enabled,
+)
+from app.services.hik import (
+    compact_raw,
+    count_event,
+    dedupe_key,
+    drop_reason,
+    event_deduplicator,
+    peek_event_head,
+    read_event_payload,
+    station_map,
+)
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # =========================
 # ENV
 # =========================
-# fallback si el evento no trae station_id (por ahora)
+# fallback si el equipo no está en station_device ni trae station_id
 DEFAULT_STATION_ID = os.getenv("STATION_ID", "PALACIO")
 
-# webhook de Node-RED (sin seguridad por ahora)
-NODE_RED_DISPATCH_WEBHOOK = os.getenv("NODE_RED_DISPATCH_WEBHOOK", "")  # ej: http://IP:1880/hik/dispatch_started
+# write-behind de access_event: tamaño de lote, espera máxima y tope de la cola
+HIK_EVENT_BATCH_SIZE = int(os.getenv("HIK_EVENT_BATCH_SIZE", "200"))
+HIK_EVENT_FLUSH_MS = int(os.getenv("HIK_EVENT_FLUSH_MS", "250"))
+HIK_EVENT_QUEUE_MAX = int(os.getenv("HIK_EVENT_QUEUE_MAX", "10000"))
+# cuántos ids de access_event se reservan por viaje a la secuencia
+HIK_EVENT_ID_BLOCK = int(os.getenv("HIK_EVENT_ID_BLOCK", "100"))
+# espera entre reintentos de un lote que no se pudo escribir
+HIK_EVENT_RETRY_S = float(os.getenv("HIK_EVENT_RETRY_S", "5"))
+# lote pendiente al apagar con la DB caída; se reintenta al arrancar.
+# Va en HIK_EVENT_SPILL_DIR (ruta absoluta; en Render, un disco persistente:
+# el disco del servicio se pierde en cada deploy)
+HIK_EVENT_SPILL_DIR = os.path.abspath(
+    os.getenv("HIK_EVENT_SPILL_DIR") or os.path.join(tempfile.gettempdir(), "cargadero-hik")
+)
+HIK_EVENT_SPILL_FILE = os.path.join(HIK_EVENT_SPILL_DIR, "access_event_spill.jsonl")
 
 
 # =========================
@@ -44,16 +81,24 @@ def _parse_ts(s: Optional[str]) -> datetime.datetime:
         return datetime.datetime.now(datetime.timezone.utc)
 
 
-def _pick_station_id(root: Dict[str, Any], acs: Dict[str, Any]) -> str:
+def _pick_station_id(root: Dict[str, Any], acs: Dict[str, Any], source_ip: Optional[str] = None) -> str:
     """
-    Intenta sacar station_id del payload (si existe). Si no hay, usa DEFAULT_STATION_ID.
-
-    En el futuro esto lo podés mapear por:
-      - source_ip
-      - device_serial
-      - device_id
-      - etc.
+    Resuelve station_id del evento, en este orden:
+      1. public.station_device (en memoria): serie, MAC, deviceID, IP
+      2. algún campo identificador que mande el equipo
+      3. DEFAULT_STATION_ID
     """
+    mapped = station_map.resolve(
+        {
+            "serial": [root.get("deviceSerial"), root.get("serialNumber"), acs.get("deviceSerial")],
+            "mac": root.get("macAddress"),
+            "device_id": [root.get("deviceID"), acs.get("deviceID"), root.get("deviceId")],
+            "ip": [root.get("ipAddress"), source_ip],
+        }
+    )
+    if mapped:
+        return mapped
+
     # si Hik manda algún campo identificador (depende el modelo/config)
     for key in ("stationId", "deviceId", "deviceID", "terminalNo", "terminalId", "devIndex"):
         v = acs.get(key) or root.get(key)
@@ -62,29 +107,15 @@ def _pick_station_id(root: Dict[str, Any], acs: Dict[str, Any]) -> str:
     return DEFAULT_STATION_ID
 
 
-async def _notify_node_red_dispatch_started(payload: Dict[str, Any]) -> None:
-    """
-    Best-effort: si Node-RED está caído, NO rompemos nada.
-    Sin seguridad por ahora.
-    """
-    if not NODE_RED_DISPATCH_WEBHOOK:
-        return
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            await client.post(NODE_RED_DISPATCH_WEBHOOK, json=payload)
-    except Exception:
-        return
-
-
 # =========================
 # Normalización Hik
 # =========================
-def normalize_hik_event(data: Dict[str, Any]) -> Dict[str, Any]:
+def normalize_hik_event(data: Dict[str, Any], source_ip: Optional[str] = None) -> Dict[str, Any]:
     root = data.get("EventNotificationAlert") or data
     acs = root.get("AcsEvent", {}) or {}
 
     ts = _parse_ts(root.get("dateTime") or root.get("eventTime") or acs.get("absTime"))
-    station_id = _pick_station_id(root, acs)
+    station_id = _pick_station_id(root, acs, source_ip)
 
     status_str = (acs.get("statusString") or "").lower()
     error_code = (acs.get("errorCode") or "")
@@ -117,87 +148,686 @@ def normalize_hik_event(data: Dict[str, Any]) -> Dict[str, Any]:
 
 
 # =========================
-# DB writes
+# DB writes (write-behind)
 # =========================
+ACCESS_EVENT_COLUMNS = (
+    "id",
+    "station_id",
+    "ts",
+    "granted",
+    "result",
+    "reason",
+    "door_index",
+    "reader_index",
+    "person_id",
+    "person_name",
+    "credential_type",
+    "credential_value",
+    "direction",
+    "pic_url",
+    "raw",
+    "dedupe_key",
+)
+
+
+def _event_row(event_id: int, ev: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (
+        event_id,
+        ev["station_id"],
+        ev["ts"],
+        ev["granted"],
+        ev["result"],
+        ev["reason"],
+        ev["door_index"],
+        ev["reader_index"],
+        ev["person_id"],
+        ev["person_name"],
+        ev["credential_type"],
+        ev["credential_value"],
+        ev["direction"],
+        ev["pic_url"],
+        Jsonb(compact_raw(ev["raw"])),
+        ev.get("dedupe_key"),
+    )
+
+
+class AccessEventWriter:
+    """
+    Cola write-behind para public.access_event.
+
+    El webhook reserva un id (por bloques, desde la secuencia de la tabla),
+    encola la fila y espera a que se escriba su lote. Una tarea en segundo
+    plano junta las filas de todos los requests y las escribe con COPY en
+    una sola conexión, cortando el lote por tamaño (HIK_EVENT_BATCH_SIZE)
+    o por tiempo (HIK_EVENT_FLUSH_MS).
+
+    Esperar el lote permite devolver el id que realmente quedó en la
+    tabla: si el dedupe_key ya estaba (reintento de Hik después de un
+    reinicio, con el deduplicador en memoria vacío), el INSERT no hace
+    nada y se devuelve el id de la fila existente, no el reservado.
+
+    start()/stop() se llaman desde el lifespan de main.py; stop() vacía
+    la cola antes de que se cierre el pool.
+
+    Los eventos ya se confirmaron al equipo, así que un lote que falla
+    no se descarta: queda pendiente y se reintenta cada
+    HIK_EVENT_RETRY_S antes de tomar eventos nuevos (mientras tanto la
+    cola se llena y el webhook frena). A esos requests se les responde
+    con el id reservado apenas falla el primer intento, sin esperar los
+    reintentos. Si al apagar sigue sin poder escribirse, se guarda en
+    HIK_EVENT_SPILL_FILE y se reintenta en el próximo arranque.
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_size: int,
+        flush_ms: int,
+        queue_max: int,
+        id_block: int,
+    ) -> None:
+        self.batch_size = max(1, batch_size)
+        self.flush_s = max(0, flush_ms) / 1000
+        self.id_block = max(1, id_block)
+        # (fila, future del request que la espera)
+        self._queue: "asyncio.Queue[Optional[Tuple[Tuple[Any, ...], asyncio.Future]]]" = asyncio.Queue(
+            maxsize=queue_max
+        )
+        self._ids: Deque[int] = deque()
+        self._ids_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # lote que no se pudo escribir (como mucho uno: mientras exista
+        # no se leen eventos nuevos de la cola)
+        self._failed: List[Tuple[Any, ...]] = []
+        self._stopping = False
+        self._stats: Counter = Counter()
+
+    async def start(self) -> None:
+        if self._task is None:
+            logger.warning("access_event: eventos sin escribir se guardan en %s", HIK_EVENT_SPILL_FILE)
+            self._failed = self._load_spill() + self._failed
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Encola un sentinel y espera a que se escriba todo lo pendiente.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+
+        # con un lote fallido el loop no lee la cola y puede estar llena:
+        # en ese caso corta solo al ver _stopping
+        sentinel = asyncio.create_task(self._queue.put(None))
+        await asyncio.wait({sentinel, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        await self._task
+        sentinel.cancel()
+        self._task = None
+        self._stopping = False
+
+        leftover = list(self._failed)
+        pending: List[Tuple[Tuple[Any, ...], asyncio.Future]] = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                pending.append(item)
+                leftover.append(item[0])
+        self._resolve(pending, {})
+
+        self._failed = []
+        if leftover:
+            self._spill(leftover)
+
+    def pending(self) -> int:
+        """
+        Eventos encolados que todavía no se escribieron.
+        """
+        return self._queue.qsize() + len(self._failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "failed_pending": len(self._failed),
+            **self._stats,
+        }
+
+    async def submit(self, ev: Dict[str, Any]) -> int:
+        """
+        Reserva un id para el evento, lo encola y espera a que se escriba
+        su lote. Devuelve el id de la fila en access_event (el de la fila
+        existente si el dedupe_key ya estaba).
+        Si la cola está llena, espera (backpressure hacia el teclado).
+        """
+        event_id = await self._next_id()
+        row = _event_row(event_id, ev)
+
+        if self._task is None:
+            # sin tarea corriendo (scripts, shells): escribimos directo
+            existing = await self._write([row])
+            return existing.get(event_id, event_id)
+
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return await future
+
+    async def _next_id(self) -> int:
+        async with self._ids_lock:
+            if not self._ids:
+                async with pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            """
+                            SELECT nextval(pg_get_serial_sequence('public.access_event', 'id'))
+                            FROM generate_series(1, %s)
+                            """,
+                            (self.id_block,),
+                        )
+                        rows = await cur.fetchall()
+                self._ids.extend(int(r[0]) for r in rows)
+            return self._ids.popleft()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            if self._failed:
+                # primero el lote pendiente; los nuevos esperan en la cola
+                if await self._flush(self._failed) is not None:
+                    self._failed = []
+                else:
+                    if self._stopping:
+                        break
+                    await asyncio.sleep(HIK_EVENT_RETRY_S)
+                continue
+
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch: List[Tuple[Tuple[Any, ...], asyncio.Future]] = [item]
+            deadline = loop.time() + self.flush_s
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            rows = [row for row, _future in batch]
+            existing = await self._flush(rows, waiting=batch)
+            if existing is None:
+                self._failed = rows
+            else:
+                self._resolve(batch, existing)
+
+    def _resolve(
+        self,
+        batch: List[Tuple[Tuple[Any, ...], asyncio.Future]],
+        existing: Dict[int, int],
+    ) -> None:
+        """
+        Responde a los requests del lote: el id reservado o, si la fila
+        chocó con un dedupe_key ya guardado, el id de esa fila.
+        """
+        for row, future in batch:
+            if not future.done():
+                future.set_result(existing.get(row[0], row[0]))
+
+    async def _flush(
+        self,
+        batch: List[Tuple[Any, ...]],
+        waiting: Optional[List[Tuple[Tuple[Any, ...], asyncio.Future]]] = None,
+    ) -> Optional[Dict[int, int]]:
+        """
+        Escribe el lote con hasta 3 intentos. Devuelve {id reservado: id
+        existente} de las filas duplicadas, o None si no se pudo escribir.
+        """
+        # los ids ya están fijados, así que reintentar el lote es seguro
+        attempts = 3
+        for attempt in range(attempts):
+            try:
+                existing = await self._write(batch)
+            except Exception:
+                logger.exception(
+                    "access_event: falló el lote de %s eventos (intento %s)",
+                    len(batch),
+                    attempt + 1,
+                )
+                self._stats["write_errors"] += 1
+                if waiting:
+                    # el lote queda pendiente: los requests no esperan los reintentos
+                    self._resolve(waiting, {})
+                    waiting = None
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(0.5 * 2**attempt)
+                continue
+
+            self._stats["written"] += len(batch) - len(existing)
+            self._stats["duplicates"] += len(existing)
+            return existing
+
+        self._stats["failed_batches"] += 1
+        return None
+
+    def _spill(self, rows: List[Tuple[Any, ...]]) -> None:
+        os.makedirs(os.path.dirname(HIK_EVENT_SPILL_FILE), exist_ok=True)
+        with open(HIK_EVENT_SPILL_FILE, "a", encoding="utf-8") as f:
+            for row in rows:
+                values = list(row)
+                values[2] = values[2].isoformat()
+                values[14] = values[14].obj
+                f.write(json.dumps(values, default=str) + "\n")
+
+        logger.error(
+            "access_event: %s eventos sin escribir guardados en %s",
+            len(rows),
+            HIK_EVENT_SPILL_FILE,
+        )
+        self._stats["spilled"] += len(rows)
+
+    def _load_spill(self) -> List[Tuple[Any, ...]]:
+        if not os.path.exists(HIK_EVENT_SPILL_FILE):
+            return []
+
+        rows: List[Tuple[Any, ...]] = []
+        with open(HIK_EVENT_SPILL_FILE, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                values = json.loads(line)
+                values[2] = datetime.datetime.fromisoformat(values[2])
+                values[14] = Jsonb(values[14])
+                rows.append(tuple(values))
+
+        # ya están en memoria: si vuelven a fallar, stop() los guarda de nuevo
+        os.remove(HIK_EVENT_SPILL_FILE)
+        logger.warning("access_event: %s eventos recuperados de %s", len(rows), HIK_EVENT_SPILL_FILE)
+        return rows
+
+    async def _write(self, batch: List[Tuple[Any, ...]]) -> Dict[int, int]:
+        # COPY a una tabla temporal y de ahí INSERT ... ON CONFLICT, para que
+        # un reintento de Hik que ya está en la tabla no tire todo el lote.
+        # Devuelve {id reservado: id existente} de las filas que no entraron.
+        columns = ", ".join(ACCESS_EVENT_COLUMNS)
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    CREATE TEMP TABLE IF NOT EXISTS access_event_stage
+                        (LIKE public.access_event INCLUDING DEFAULTS)
+                        ON COMMIT DELETE ROWS
+                    """
+                )
+                async with cur.copy(f"COPY access_event_stage ({columns}) FROM STDIN") as copy:
+                    for row in batch:
+                        await copy.write_row(row)
+                await cur.execute(
+                    f"""
+                    INSERT INTO public.access_event ({columns})
+                    SELECT {columns} FROM access_event_stage
+                    ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+                    """
+                )
+                if cur.rowcount == len(batch):
+                    return {}
+
+                # mismo dedupe_key que una fila ya guardada (o que otra del lote)
+                await cur.execute(
+                    """
+                    SELECT s.id, e.id
+                    FROM access_event_stage s
+                    JOIN public.access_event e
+                      ON e.dedupe_key = s.dedupe_key
+                    WHERE s.dedupe_key IS NOT NULL
+                      AND e.id <> s.id
+                    """
+                )
+                return {int(r[0]): int(r[1]) for r in await cur.fetchall()}
+
+
+access_event_writer = AccessEventWriter(
+    batch_size=HIK_EVENT_BATCH_SIZE,
+    flush_ms=HIK_EVENT_FLUSH_MS,
+    queue_max=HIK_EVENT_QUEUE_MAX,
+    id_block=HIK_EVENT_ID_BLOCK,
+)
+
+
 async def insert_access_event(ev: Dict[str, Any]) -> int:
+    return await access_event_writer.submit(ev)
+
+
+def _is_pin_dispatch_candidate(ev: Dict[str, Any]) -> bool:
+    """
+    Un evento abre despacho sólo si fue concedido por PIN y trae company code.
+    """
+    verify_mode = (ev.get("credential_type") or "").lower()
+    company_code = (ev.get("person_id") or "").strip()
+
+    if not ev.get("granted") or not company_code:
+        return False
+    return "password" in verify_mode
+
+
+def _pin_event_values(ev: Dict[str, Any]) -> Tuple[Any, ...]:
+    """
+    Valores del INSERT de access_event en los CTE del camino PIN.
+    """
+    return (
+        ev["station_id"],
+        ev["ts"],
+        ev["granted"],
+        ev["result"],
+        ev["reason"],
+        ev["door_index"],
+        ev["reader_index"],
+        ev["person_id"],
+        ev["person_name"],
+        ev["credential_type"],
+        ev["credential_value"],
+        ev["direction"],
+        ev["pic_url"],
+        Jsonb(compact_raw(ev["raw"])),
+        ev.get("dedupe_key"),
+    )
+
+
+async def insert_event_and_start_dispatch(
+    ev: Dict[str, Any],
+    company: Dict[str, Any],
+) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    """
+    Camino rápido para PIN concedido: en un solo statement (una conexión,
+    una transacción) inserta el access_event, crea el water_dispatch y
+    deja la notificación para Node-RED en el outbox.
+
+    La empresa ya viene resuelta desde el registro en memoria; el CTE
+    sólo re-chequea por PK que siga activa.
+
+    Si el dedupe_key ya existe (reintento de Hik que no estaba en memoria)
+    no se inserta nada y devuelve (None, None).
+    """
+    station_id = ev.get("station_id") or DEFAULT_STATION_ID
+
+    # si Hik provee picUrl lo guardamos, pero luego Node-RED lo reemplaza con foto camión
+    photo_path = ev.get("pic_url") or None
+
     async with pool.connection() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
-                INSERT INTO public.access_event
-                    (station_id, ts, granted, result, reason,
-                     door_index, reader_index, person_id, person_name,
-                     credential_type, credential_value, direction,
-                     pic_url, snapshot_path, raw)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NULL,%s)
-                RETURNING id
+                WITH ev AS (
+                    INSERT INTO public.access_event
+                        (station_id, ts, granted, result, reason,
+                         door_index, reader_index, person_id, person_name,
+                         credential_type, credential_value, direction,
+                         pic_url, snapshot_path, raw, dedupe_key)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NULL,%s,%s)
+                    ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+                    RETURNING id
+                ),
+                co AS (
+                    SELECT id
+                    FROM public.company
+                    WHERE id = %s
+                      AND active
+                ),
+                wd AS (
+                    INSERT INTO public.water_dispatch (station_id, company_id, photo_path, note)
+                    SELECT %s::text, co.id, %s::text, 'despacho iniciado por PIN'
+                    FROM co, ev
+                    RETURNING id, ts
+                ),
+                nr AS (
+                    INSERT INTO public.node_red_outbox (kind, payload)
+                    SELECT
+                        'dispatch_started',
+                        jsonb_build_object(
+                            'event_id', ev.id,
+                            'dispatch_id', wd.id,
+                            'station_id', %s::text,
+                            'company_code', %s::text,
+                            'company_name', %s::text,
+                            'ts', wd.ts
+                        )
+                    FROM ev, wd
+                    WHERE %s
+                )
+                SELECT ev.id, wd.id, wd.ts
+                FROM ev
+                LEFT JOIN wd ON TRUE
                 """,
                 (
-                    ev["station_id"],
-                    ev["ts"],
-                    ev["granted"],
-                    ev["result"],
-                    ev["reason"],
-                    ev["door_index"],
-                    ev["reader_index"],
-                    ev["person_id"],
-                    ev["person_name"],
-                    ev["credential_type"],
-                    ev["credential_value"],
-                    ev["direction"],
-                    ev["pic_url"],
-                    json.dumps(ev["raw"]),
+                    *_pin_event_values(ev),
+                    company["id"],
+                    station_id,
+                    photo_path,
+                    station_id,
+                    company["code"],
+                    company["name"],
+                    node_red_outbox.enabled("dispatch_started"),
                 ),
             )
             row = await cur.fetchone()
-            return int(row[0])
 
+    if row is None:
+        return None, None
 
-async def maybe_start_dispatch(ev: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    verify_mode = (ev.get("credential_type") or "").lower()
-    company_code = (ev.get("person_id") or "").strip()
-    station_id = ev.get("station_id") or DEFAULT_STATION_ID
-
-    if not ev.get("granted") or not company_code:
-        return None
-    if "password" not in verify_mode:
-        return None
+    event_id = int(row[0])
+    if row[1] is None:
+        return event_id, None
 
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                "SELECT id, name FROM public.company WHERE code=%s AND active",
-                (company_code,),
-            )
-            r = await cur.fetchone()
-            if not r:
-                return None
+    ts = row[2]
+    return event_id, {
+        "dispatch_id": int(row[1]),
+        "station_id": station_id,
+        "company_code": company["code"],
+        "company_name": company["name"],
+        "ts": ts.isoformat() if ts else None,
+    }
 
-            company_id = int(r[0])
-            company_name = r[1]
 
-            # si Hik provee picUrl lo guardamos, pero luego Node-RED lo reemplaza con foto camión
-            photo_path = ev.get("pic_url") or None
+async def insert_event_and_start_prepaid_dispatch(
+    ev: Dict[str, Any],
+    company: Dict[str, Any],
+    config: Dict[str, Any],
+) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    """
+    Camino PIN con PREPAID_ENABLED: igual que insert_event_and_start_dispatch
+    (un solo statement), pero el despacho lo crea
+    public.authorize_and_start_dispatch() con la tarifa de billing_config,
+    igual que /water/dispatch/start: saldo mínimo, una carga activa por
+    empresa y tope de litros.
+
+    Si la autorización se rechaza, el access_event queda guardado, no
+    se crea despacho ni se avisa a Node-RED, y dispatch_info trae el
+    error en "billing_error" (mismo detail que el 402/409 de la ruta).
+    """
+    station_id = ev.get("station_id") or DEFAULT_STATION_ID
+    photo_path = ev.get("pic_url") or None
 
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
             await cur.execute(
                 """
-                INSERT INTO public.water_dispatch (station_id, company_id, photo_path, note)
-                VALUES (%s, %s, %s, 'despacho iniciado por PIN')
-                RETURNING id, ts
+                WITH ev AS (
+                    INSERT INTO public.access_event
+                        (station_id, ts, granted, result, reason,
+                         door_index, reader_index, person_id, person_name,
+                         credential_type, credential_value, direction,
+                         pic_url, snapshot_path, raw, dedupe_key)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NULL,%s,%s)
+                    ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+                    RETURNING id
+                ),
+                auth AS (
+                    -- en la lista del SELECT: sólo corre si se insertó el evento
+                    SELECT public.authorize_and_start_dispatch(
+                        %s::text,
+                        %s::text,
+                        %s::text,
+                        NULL::jsonb,
+                        NULL::jsonb,
+                        'despacho iniciado por PIN',
+                        %s::numeric,
+                        %s::numeric,
+                        %s::integer
+                    ) AS r
+                    FROM ev
+                ),
+                wd AS (
+                    SELECT
+                        (r).result_code AS result_code,
+                        (r).dispatch_id AS id,
+                        (r).dispatch_ts AS ts,
+                        (r).balance AS balance,
+                        (r).max_affordable_liters AS max_affordable_liters,
+                        (r).active_dispatch_id AS active_dispatch_id
+                    FROM auth
+                ),
+                nr AS (
+                    INSERT INTO public.node_red_outbox (kind, payload)
+                    SELECT
+                        'dispatch_started',
+                        jsonb_build_object(
+                            'event_id', ev.id,
+                            'dispatch_id', wd.id,
+                            'station_id', %s::text,
+                            'company_code', %s::text,
+                            'company_name', %s::text,
+                            'ts', wd.ts,
+                            'max_affordable_liters', wd.max_affordable_liters
+                        )
+                    FROM ev, wd
+                    WHERE wd.result_code = 'OK'
+                      AND %s
+                )
+                SELECT
+                    ev.id,
+                    wd.result_code,
+                    wd.id,
+                    wd.ts,
+                    wd.balance,
+                    wd.max_affordable_liters,
+                    wd.active_dispatch_id
+                FROM ev
+                LEFT JOIN wd ON TRUE
                 """,
-                (station_id, company_id, photo_path),
+                (
+                    *_pin_event_values(ev),
+                    company["code"],
+                    station_id,
+                    photo_path,
+                    config["price_per_m3"],
+                    config["minimum_balance"],
+                    config["version"],
+                    station_id,
+                    company["code"],
+                    company["name"],
+                    node_red_outbox.enabled("dispatch_started"),
+                ),
             )
             row = await cur.fetchone()
-            dispatch_id = int(row[0])
-            ts = row[1]
 
-    return {
-        "dispatch_id": dispatch_id,
-        "station_id": station_id,
-        "company_code": company_code,
-        "company_name": company_name,
-        "ts": ts.isoformat() if ts else None,
-    }
+    if row is None:
+        return None, None
+
+    event_id = int(row[0])
+    code = row[1]
+
+    if code == "OK":
+        ts = row[3]
+        return event_id, {
+            "dispatch_id": int(row[2]),
+            "station_id": station_id,
+            "company_code": company["code"],
+            "company_name": company["name"],
+            "ts": ts.isoformat() if ts else None,
+            "max_affordable_liters": row[5],
+        }
+
+    if code == "INSUFFICIENT_MINIMUM_BALANCE":
+        error = authorization_error(
+            code,
+            balance=float(row[4]),
+            minimum_balance=float(config["minimum_balance"]),
+            currency=config["currency"],
+        )
+    elif code == "ACTIVE_DISPATCH_EXISTS":
+        active_dispatch_id = int(row[6]) if row[6] is not None else None
+        if active_dispatch_id is not None:
+            active_dispatches.add(company["id"], active_dispatch_id)
+        error = authorization_error(code, dispatch_id=active_dispatch_id)
+    else:
+        error = authorization_error(code or "PREPAID_ACCOUNT_NOT_AVAILABLE")
+
+    return event_id, {"billing_error": error.detail}
+
+
+async def process_event(ev: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Guarda el evento y, si corresponde, abre el despacho y encola el aviso a Node-RED.
+    Los eventos que no abren despacho van por el write-behind.
+
+    Con PREPAID_ENABLED el PIN pasa por la misma autorización prepaga que
+    /water/dispatch/start; si se rechaza, el evento se guarda igual y la
+    respuesta trae billing_error en vez de dispatch_id.
+    """
+    company = None
+    if _is_pin_dispatch_candidate(ev):
+        company = await company_registry.get_active((ev.get("person_id") or "").strip())
+
+    config = None
+    if company and prepaid_enabled():
+        config = await billing_config.get()
+
+        # rechazos que se resuelven en memoria, sin abrir la transacción
+        rejected = None
+        if config is None:
+            rejected = authorization_error("PREPAID_ACCOUNT_NOT_AVAILABLE")
+        else:
+            active_dispatch_id = active_dispatches.get(company["id"])
+            if active_dispatch_id is not None:
+                rejected = authorization_error("ACTIVE_DISPATCH_EXISTS", dispatch_id=active_dispatch_id)
+
+        if rejected is not None:
+            event_id = await insert_access_event(ev)
+            return {"ok": True, "event_id": event_id, "dispatch_id": None, "billing_error": rejected.detail}
+
+    if company:
+        if config is not None:
+            event_id, dispatch_info = await insert_event_and_start_prepaid_dispatch(ev, company, config)
+        else:
+            event_id, dispatch_info = await insert_event_and_start_dispatch(ev, company)
+        if event_id is None:
+            return {"ok": True, "event_id": None, "dispatch_id": None, "duplicate": True}
+    else:
+        event_id, dispatch_info = await insert_access_event(ev), None
+
+    if dispatch_info and "billing_error" in dispatch_info:
+        return {"ok": True, "event_id": event_id, "dispatch_id": None, "billing_error": dispatch_info["billing_error"]}
+
+    if dispatch_info:
+        flow_supervisor.track(
+            dispatch_info["dispatch_id"],
+            dispatch_info["station_id"],
+            dispatch_info.get("max_affordable_liters"),
+        )
+        if config is not None:
+            active_dispatches.add(company["id"], dispatch_info["dispatch_id"])
+        # la entrega a Node-RED corre en segundo plano (outbox); no la esperamos
+        node_red_outbox.wake()
+
+    return {"ok": True, "event_id": event_id, "dispatch_id": dispatch_info["dispatch_id"] if dispatch_info else None}
 
 
 # =========================
@@ -205,39 +835,56 @@ async def maybe_start_dispatch(ev: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 # =========================
 @router.post("/webhook")
 async def webhook(request: Request):
-    body = await request.body()
-    if not body:
+    # En multipart (evento + foto) sólo nos quedamos con la parte del evento
+    try:
+        body, ct = await read_event_payload(
+            request.headers.get("content-type") or "",
+            request.stream(),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Cannot parse payload: {e}")
+
+    if not body.strip():
         raise HTTPException(status_code=400, detail="Empty body")
 
-    ct = (request.headers.get("content-type") or "").lower()
+    # Heartbeats, videoloss, etc.: se cuentan y se descartan sin parsear ni tocar la DB
+    head = peek_event_head(body)
+    reason = drop_reason(head)
+    count_event(reason)
+    if reason:
+        return JSONResponse({"ok": True, "event_id": None, "dispatch_id": None, "ignored": reason})
+
+    source_ip = request.client.host if request.client else None
+
+    # Reintentos de Hik: se responde lo mismo que al original, sin tocar el pool
+    key = dedupe_key(head, body, source_ip)
+    future, is_new = event_deduplicator.claim(key)
+    if not is_new:
+        original = await asyncio.shield(future)
+        if original is None:
+            raise HTTPException(status_code=503, detail="Original event failed, retry")
+        return JSONResponse({**original, "duplicate": True})
+
     try:
         if "xml" in ct or body.strip().startswith(b"<"):
             data = xmltodict.parse(body)
         else:
             data = json.loads(body.decode("utf-8"))
     except Exception as e:
+        event_deduplicator.release(key, future)
         raise HTTPException(status_code=400, detail=f"Cannot parse payload: {e}")
 
-    ev = normalize_hik_event(data)
+    ev = normalize_hik_event(data, source_ip)
+    ev["dedupe_key"] = key
 
-    event_id = await insert_access_event(ev)
-    dispatch_info = await maybe_start_dispatch(ev)
+    try:
+        result = await process_event(ev)
+    except BaseException:
+        event_deduplicator.release(key, future)
+        raise
 
-    if dispatch_info:
-        await _notify_node_red_dispatch_started(
-            {
-                "event_id": event_id,
-                "dispatch_id": dispatch_info["dispatch_id"],
-                "station_id": dispatch_info["station_id"],
-                "company_code": dispatch_info["company_code"],
-                "company_name": dispatch_info["company_name"],
-                "ts": dispatch_info["ts"],
-            }
-        )
-
-    return JSONResponse(
-        {"ok": True, "event_id": event_id, "dispatch_id": dispatch_info["dispatch_id"] if dispatch_info else None}
-    )
+    event_deduplicator.resolve(future, result)
+    return JSONResponse(result)
 
 
 @router.post("/test")
@@ -259,19 +906,4 @@ async def test_event(payload: Dict[str, Any]):
         "raw": payload,
     }
 
-    event_id = await insert_access_event(ev)
-    dispatch_info = await maybe_start_dispatch(ev)
-
-    if dispatch_info:
-        await _notify_node_red_dispatch_started(
-            {
-                "event_id": event_id,
-                "dispatch_id": dispatch_info["dispatch_id"],
-                "station_id": dispatch_info["station_id"],
-                "company_code": dispatch_info["company_code"],
-                "company_name": dispatch_info["company_name"],
-                "ts": dispatch_info["ts"],
-            }
-        )
-
-    return {"ok": True, "event_id": event_id, "dispatch_id": dispatch_info["dispatch_id"] if dispatch_info else None}
+    return await process_event(ev)
@@ -1,68 +1,16 @@
 # app/routes/kpi.py
 from __future__ import annotations
 
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional
 
 from fastapi import APIRouter, Query
 from app.db import get_conn
+from app.services.dispatch import build_dispatch_where
+from app.services.pagination import parse_dt
 
 router = APIRouter(prefix="/kpi", tags=["kpi"])
 
 
-# -----------------------------
-# Helpers
-# -----------------------------
-def _parse_dt(s: Optional[str]) -> Optional[datetime]:
-    """
-    Acepta ISO8601 (con o sin Z). Si es naive, la asume UTC.
-    """
-    if not s:
-        return None
-    ss = s.strip()
-    if not ss:
-        return None
-    # soportar "Z"
-    if ss.endswith("Z"):
-        ss = ss[:-1] + "+00:00"
-    dt = datetime.fromisoformat(ss)
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt
-
-
-def _build_where(
-    *,
-    dt_from: Optional[datetime],
-    dt_to: Optional[datetime],
-    station_id: Optional[str],
-    company_id: Optional[int],
-) -> Tuple[str, List[Any]]:
-    where: List[str] = []
-    params: List[Any] = []
-
-    # ts range
-    if dt_from is not None:
-        where.append("wd.ts >= %s")
-        params.append(dt_from)
-    if dt_to is not None:
-        where.append("wd.ts < %s")
-        params.append(dt_to)
-
-    # filters
-    if station_id:
-        where.append("wd.station_id = %s")
-        params.append(station_id)
-
-    if company_id is not None:
-        where.append("wd.company_id = %s")
-        params.append(company_id)
-
-    if where:
-        return "WHERE " + " AND ".join(where), params
-    return "", params
-
-
 # -----------------------------
 # KPI: Summary
 # -----------------------------
@@ -84,10 +32,10 @@ async def kpi_summary(
       from, to: ISO8601 (ej: 2026-01-01T00:00:00Z)
       station_id, company_id: opcionales
     """
-    dt_from = _parse_dt(from_ts)
-    dt_to = _parse_dt(to_ts)
+    dt_from = parse_dt(from_ts)
+    dt_to = parse_dt(to_ts)
 
-    where_sql, params = _build_where(
+    where_sql, params = build_dispatch_where(
         dt_from=dt_from,
         dt_to=dt_to,
         station_id=station_id,
@@ -145,12 +93,12 @@ async def kpi_by_company(
       station_id: opcional
       top: límite (max 500)
     """
-    dt_from = _parse_dt(from_ts)
-    dt_to = _parse_dt(to_ts)
+    dt_from = parse_dt(from_ts)
+    dt_to = parse_dt(to_ts)
     top = max(1, min(int(top), 500))
 
     # acá NO filtramos por company_id porque justamente agrupamos por company
-    where_sql, params = _build_where(
+    where_sql, params = build_dispatch_where(
         dt_from=dt_from,
         dt_to=dt_to,
         station_id=station_id,
@@ -223,12 +171,12 @@ async def kpi_by_station(
       company_id: opcional
       top: límite (max 500)
     """
-    dt_from = _parse_dt(from_ts)
-    dt_to = _parse_dt(to_ts)
+    dt_from = parse_dt(from_ts)
+    dt_to = parse_dt(to_ts)
     top = max(1, min(int(top), 500))
 
     # acá NO filtramos por station_id porque agrupamos por estación
-    where_sql, params = _build_where(
+    where_sql, params = build_dispatch_where(
         dt_from=dt_from,
         dt_to=dt_to,
         station_id=None,
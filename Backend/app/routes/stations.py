@@ -5,14 +5,19 @@
 #   GET    /stations/{station_id}          → obtener una estación
 #   POST   /stations                       → crear/actualizar (upsert)
 #   PATCH  /stations/{station_id}/active   → activar/desactivar
+#   GET    /stations/{station_id}/devices  → equipos Hik asociados
+#   POST   /stations/{station_id}/devices  → asociar equipo (upsert por kind+value)
+#   DELETE /stations/devices/{kind}/{value} → quitar asociación
 #
 # Requiere:
 #   - Tabla public.station (id TEXT PK, name TEXT, active BOOL, created_at TIMESTAMPTZ)
+#   - Tabla public.station_device (sql/migrations/004_station_device.sql)
 
 from fastapi import APIRouter, HTTPException, Path
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Literal, Optional, List
 from app.db import get_conn
+from app.services.hik import normalize_device_value, station_map
 
 router = APIRouter(prefix="/stations", tags=["stations"])
 
@@ -34,12 +39,33 @@ class StationActivePatch(BaseModel):
     active: bool
 
 
+DeviceKind = Literal["ip", "serial", "mac", "device_id"]
+
+
+class StationDeviceIn(BaseModel):
+    kind: DeviceKind
+    value: str = Field(..., min_length=1, max_length=200)
+    note: Optional[str] = None
+
+
+class StationDeviceOut(BaseModel):
+    kind: DeviceKind
+    value: str
+    station_id: str
+    note: Optional[str] = None
+
+
 # --------- Helpers ---------
 def _row_to_out(row) -> StationOut:
     # row: (id, name, active)
     return StationOut(id=row[0], name=row[1], active=bool(row[2]))
 
 
+def _row_to_device_out(row) -> StationDeviceOut:
+    # row: (kind, value, station_id, note)
+    return StationDeviceOut(kind=row[0], value=row[1], station_id=row[2], note=row[3])
+
+
 # --------- Endpoints ---------
 @router.get("", response_model=List[StationOut])
 async def list_stations():
@@ -115,3 +141,76 @@ async def set_station_active(
     if not row:
         raise HTTPException(status_code=404, detail=f"Station '{station_id}' no encontrada")
     return _row_to_out(row)
+
+
+@router.get("/{station_id}/devices", response_model=List[StationDeviceOut])
+async def list_station_devices(station_id: str = Path(..., min_length=1)):
+    async with get_conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT kind, value, station_id, note
+                  FROM public.station_device
+                 WHERE station_id = %s
+              ORDER BY kind, value;
+                """,
+                (station_id,),
+            )
+            rows = await cur.fetchall()
+    return [_row_to_device_out(r) for r in rows]
+
+
+@router.post("/{station_id}/devices", response_model=StationDeviceOut, status_code=201)
+async def upsert_station_device(
+    d: StationDeviceIn,
+    station_id: str = Path(..., min_length=1),
+):
+    """
+    Asocia un equipo Hik (IP de origen, serie, MAC o deviceID) a la estación.
+    Si el equipo ya estaba asociado a otra estación, se mueve.
+    """
+    value = normalize_device_value(d.kind, d.value)
+
+    async with get_conn() as conn:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(
+                    """
+                    INSERT INTO public.station_device (kind, value, station_id, note)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (kind, value) DO UPDATE
+                        SET station_id = EXCLUDED.station_id,
+                            note = EXCLUDED.note
+                    RETURNING kind, value, station_id, note;
+                    """,
+                    (d.kind, value, station_id, d.note),
+                )
+                row = await cur.fetchone()
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error upsert station device: {e}")
+
+    # el trigger también avisa por NOTIFY; recargamos ya para este proceso
+    await station_map.load()
+    return _row_to_device_out(row)
+
+
+@router.delete("/devices/{kind}/{value}")
+async def delete_station_device(kind: DeviceKind, value: str):
+    async with get_conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                DELETE FROM public.station_device
+                 WHERE kind = %s
+                   AND value = %s
+             RETURNING kind;
+                """,
+                (kind, normalize_device_value(kind, value)),
+            )
+            row = await cur.fetchone()
+
+    if not row:
+        raise HTTPException(status_code=404, detail=f"Device '{kind}:{value}' no encontrado")
+
+    await station_map.load()
+    return {"ok": True}
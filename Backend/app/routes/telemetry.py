@@ -0,0 +1,78 @@
+# app/routes/telemetry.py
+# Telemetría del caudalímetro enviada por Node-RED.
+# Endpoints:
+#   POST /water/telemetry → lote de muestras de uno o varios despachos
+#
+# Requiere:
+#   - Tabla public.water_flow_sample (sql/migrations/010_water_flow_sample.sql)
+
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
+
+from app.services.flow import telemetry_ingestor
+
+router = APIRouter(prefix="/water/telemetry", tags=["water"])
+
+# Tope de muestras por request
+MAX_SAMPLES_PER_BATCH = 5000
+
+
+# --------- Schemas ---------
+class FlowSampleIn(BaseModel):
+    dispatch_id: int
+    ts: Optional[datetime] = Field(None, description="Hora de la lectura; si falta, la de recepción")
+    liters: Optional[float] = Field(None, ge=0, description="Litros acumulados del despacho")
+    flow_l_min: Optional[float] = Field(None, ge=0)
+    pulses: Optional[int] = Field(None, ge=0, description="Pulsos acumulados del caudalímetro")
+
+
+class TelemetryIn(BaseModel):
+    samples: List[FlowSampleIn] = Field(..., min_length=1)
+
+
+# --------- Endpoints ---------
+@router.post("")
+async def ingest_telemetry(body: TelemetryIn):
+    """
+    Recibe muestras del caudalímetro en lote, por ejemplo:
+
+      {"samples": [
+        {"dispatch_id": 120, "ts": "2026-03-01T10:00:01Z", "liters": 35.2, "flow_l_min": 610},
+        {"dispatch_id": 121, "ts": "2026-03-01T10:00:01Z", "pulses": 8800}
+      ]}
+
+    Se guardan todas en water_flow_sample; liters/flow_l_min de
+    water_dispatch se actualizan con la última lectura cada pocos segundos.
+    """
+    if len(body.samples) > MAX_SAMPLES_PER_BATCH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"too many samples (max {MAX_SAMPLES_PER_BATCH})",
+        )
+
+    now = datetime.now(timezone.utc)
+
+    samples = []
+    for s in body.samples:
+        ts = s.ts or now
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+
+        if s.liters is None and s.flow_l_min is None and s.pulses is None:
+            raise HTTPException(
+                status_code=422,
+                detail=f"sample for dispatch {s.dispatch_id} has no liters, flow_l_min or pulses",
+            )
+
+        samples.append((s.dispatch_id, ts, s.liters, s.flow_l_min, s.pulses))
+
+    accepted = await telemetry_ingestor.ingest(samples)
+
+    return {
+        "ok": True,
+        "accepted": accepted,
+        "dispatches": len({s[0] for s in samples}),
+    }
@@ -1,14 +1,22 @@
+import hashlib
 import os
 import uuid
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
+from typing import Any
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
 from app.db import pool
+from app.services.company import company_registry
+from app.services.pagination import decode_cursor, encode_cursor, parse_dt_param
 from app.services.prepaid import (
+    billing_config,
     calculate_max_affordable_liters,
     prepaid_enabled,
+    wallet_balances,
 )
 
 
@@ -48,23 +56,9 @@ async def get_billing_config():
     Devuelve la configuración general del sistema prepago.
     """
 
-    async with pool.connection() as connection:
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT
-                    price_per_m3,
-                    minimum_balance,
-                    currency,
-                    updated_at
-                FROM public.water_billing_config
-                WHERE id = 1
-                """
-            )
+    config = await billing_config.get()
 
-            row = await cursor.fetchone()
-
-    if not row:
+    if not config:
         raise HTTPException(
             status_code=503,
             detail="Billing configuration not found",
@@ -73,56 +67,92 @@ async def get_billing_config():
     return {
         "ok": True,
         "prepaid_enabled": prepaid_enabled(),
-        "price_per_m3": float(row[0]),
-        "minimum_balance": float(row[1]),
-        "currency": row[2],
-        "updated_at": row[3].isoformat(),
+        "price_per_m3": float(config["price_per_m3"]),
+        "minimum_balance": float(config["minimum_balance"]),
+        "currency": config["currency"],
+        "updated_at": config["updated_at"].isoformat(),
+        "version": config["version"],
     }
 
 
+def _wallet_etag(
+    company: dict[str, Any],
+    wallet: dict[str, Any],
+    config: dict[str, Any],
+) -> str:
+    """
+    Cambia cuando cambia el saldo, la tarifa o la empresa.
+    """
+
+    raw = "|".join(
+        str(value)
+        for value in (
+            company["id"],
+            company["code"],
+            company["name"],
+            company["active"],
+            wallet["balance"],
+            wallet["updated_at"].isoformat(),
+            config["version"],
+            prepaid_enabled(),
+        )
+    )
+
+    return f'"{hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]}"'
+
+
 @router.get("/company/{company_code}")
 async def get_company_wallet(
     company_code: str,
+    request: Request,
 ):
     """
     Devuelve el saldo y la capacidad de carga de una empresa.
+
+    Lo consultan los teclados y Node-RED antes de cada carga: el saldo
+    sale de wallet_balances (en memoria) y la respuesta lleva ETag.
+    Con If-None-Match igual se responde 304 sin tocar la DB.
     """
 
-    async with pool.connection() as connection:
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT
-                    c.id,
-                    c.name,
-                    c.code,
-                    c.active,
-                    cw.balance,
-                    cfg.price_per_m3,
-                    cfg.minimum_balance,
-                    cfg.currency,
-                    cw.updated_at
-                FROM public.company c
-                JOIN public.company_wallet cw
-                  ON cw.company_id = c.id
-                CROSS JOIN public.water_billing_config cfg
-                WHERE c.code = %s
-                  AND cfg.id = 1
-                """,
-                (company_code,),
-            )
+    company = await company_registry.get(company_code)
+
+    if not company:
+        raise HTTPException(
+            status_code=404,
+            detail="Company wallet not found",
+        )
+
+    config = await billing_config.get()
+
+    if not config:
+        raise HTTPException(
+            status_code=404,
+            detail="Company wallet not found",
+        )
 
-            row = await cursor.fetchone()
+    wallet = await wallet_balances.get(company)
 
-    if not row:
+    if not wallet:
         raise HTTPException(
             status_code=404,
             detail="Company wallet not found",
         )
 
-    balance = Decimal(row[4])
-    price_per_m3 = Decimal(row[5])
-    minimum_balance = Decimal(row[6])
+    etag = _wallet_etag(company, wallet, config)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+    }
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(
+            status_code=304,
+            headers=headers,
+        )
+
+    balance = wallet["balance"]
+    price_per_m3 = config["price_per_m3"]
+    minimum_balance = config["minimum_balance"]
 
     max_affordable_liters = (
         calculate_max_affordable_liters(
@@ -131,36 +161,44 @@ async def get_company_wallet(
         )
     )
 
-    return {
-        "ok": True,
-        "company_id": int(row[0]),
-        "company_name": row[1],
-        "company_code": row[2],
-        "company_active": bool(row[3]),
-        "balance": float(balance),
-        "price_per_m3": float(price_per_m3),
-        "minimum_balance": float(
-            minimum_balance
-        ),
-        "currency": row[7],
-        "can_start": (
-            bool(row[3])
-            and balance >= minimum_balance
-        ),
-        "max_affordable_liters": float(
-            max_affordable_liters
-        ),
-        "updated_at": row[8].isoformat(),
-    }
+    return JSONResponse(
+        {
+            "ok": True,
+            "company_id": company["id"],
+            "company_name": company["name"],
+            "company_code": company["code"],
+            "company_active": company["active"],
+            "balance": float(balance),
+            "price_per_m3": float(price_per_m3),
+            "minimum_balance": float(
+                minimum_balance
+            ),
+            "currency": config["currency"],
+            "can_start": (
+                company["active"]
+                and balance >= minimum_balance
+            ),
+            "max_affordable_liters": float(
+                max_affordable_liters
+            ),
+            "updated_at": wallet["updated_at"].isoformat(),
+        },
+        headers=headers,
+    )
 
 
 @router.get("/company/{company_code}/movements")
 async def get_company_movements(
     company_code: str,
     limit: int = 50,
+    cursor: str | None = None,
 ):
     """
-    Devuelve los movimientos de saldo de una empresa.
+    Devuelve los movimientos de saldo de una empresa, del más nuevo
+    al más viejo, paginados por cursor sobre (created_at, id).
+
+    Para la página siguiente se manda el next_cursor recibido
+    (null en la última página).
     """
 
     safe_limit = max(
@@ -168,9 +206,25 @@ async def get_company_movements(
         min(int(limit), 200),
     )
 
+    company = await company_registry.get(company_code)
+
+    if not company:
+        return {
+            "ok": True,
+            "items": [],
+            "next_cursor": None,
+        }
+
+    cursor_ts = None
+    cursor_id = None
+
+    if cursor:
+        cursor_ts, cursor_id = decode_cursor(cursor)
+
     async with pool.connection() as connection:
-        async with connection.cursor() as cursor:
-            await cursor.execute(
+        async with connection.cursor() as db_cursor:
+            # comparación de filas: usa el índice de la migración 015
+            await db_cursor.execute(
                 """
                 SELECT
                     wm.id,
@@ -184,19 +238,30 @@ async def get_company_movements(
                     wm.note,
                     wm.created_at
                 FROM public.wallet_movement wm
-                JOIN public.company c
-                  ON c.id = wm.company_id
-                WHERE c.code = %s
-                ORDER BY wm.created_at DESC
+                WHERE wm.company_id = %s
+                  AND (
+                      %s::timestamptz IS NULL
+                      OR (wm.created_at, wm.id) < (%s::timestamptz, %s::bigint)
+                  )
+                ORDER BY
+                    wm.created_at DESC,
+                    wm.id DESC
                 LIMIT %s
                 """,
                 (
-                    company_code,
-                    safe_limit,
+                    company["id"],
+                    cursor_ts,
+                    cursor_ts,
+                    cursor_id,
+                    # uno de más para saber si hay otra página
+                    safe_limit + 1,
                 ),
             )
 
-            rows = await cursor.fetchall()
+            rows = await db_cursor.fetchall()
+
+    has_more = len(rows) > safe_limit
+    rows = rows[:safe_limit]
 
     items = []
 
@@ -219,6 +284,236 @@ async def get_company_movements(
     return {
         "ok": True,
         "items": items,
+        "next_cursor": (
+            encode_cursor(rows[-1][9], rows[-1][0])
+            if has_more
+            else None
+        ),
+    }
+
+
+def _month_start(value: datetime) -> date:
+    return value.astimezone(timezone.utc).date().replace(day=1)
+
+
+def _next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _month_bounds(month: date) -> tuple[datetime, datetime]:
+    following = _next_month(month)
+
+    return (
+        datetime(month.year, month.month, 1, tzinfo=timezone.utc),
+        datetime(following.year, following.month, 1, tzinfo=timezone.utc),
+    )
+
+
+@router.get("/company/{company_code}/statement")
+async def get_company_statement(
+    company_code: str,
+    from_ts: str = Query(..., alias="from"),
+    to_ts: str | None = Query(None, alias="to"),
+):
+    """
+    Extracto de saldo de una empresa en [from, to), mes por mes (UTC).
+
+    Los meses completos salen de wallet_balance_snapshot (migración 016);
+    sólo los meses incompletos de los bordes leen sus movimientos. Un
+    extracto anual cuesta lo mismo sin importar cuánta historia haya.
+    """
+
+    dt_from = parse_dt_param(from_ts, "from")
+    dt_to = parse_dt_param(to_ts, "to") or datetime.now(timezone.utc)
+
+    if dt_to <= dt_from:
+        raise HTTPException(
+            status_code=422,
+            detail="to must be after from",
+        )
+
+    company = await company_registry.get(company_code)
+
+    if not company:
+        raise HTTPException(
+            status_code=404,
+            detail="Company wallet not found",
+        )
+
+    first_month = _month_start(dt_from)
+    last_month = _month_start(dt_to - timedelta(microseconds=1))
+
+    months = [first_month]
+
+    while months[-1] < last_month:
+        months.append(_next_month(months[-1]))
+
+    partial = [
+        month
+        for month in (first_month, last_month)
+        if dt_from > _month_bounds(month)[0]
+        or dt_to < _month_bounds(month)[1]
+    ]
+
+    movements: dict[date, list[tuple[Any, ...]]] = {}
+
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(
+                """
+                SELECT
+                    month,
+                    opening_balance,
+                    closing_balance,
+                    credits,
+                    debits,
+                    movement_count
+                FROM public.wallet_balance_snapshot
+                WHERE company_id = %s
+                  AND month >= %s
+                  AND month <= %s
+                ORDER BY month
+                """,
+                (
+                    company["id"],
+                    first_month,
+                    last_month,
+                ),
+            )
+
+            snapshots = {
+                row[0]: row
+                for row in await cursor.fetchall()
+            }
+
+            # sólo los meses de los bordes que el rango corta
+            for month in dict.fromkeys(partial):
+                if month not in snapshots:
+                    continue
+
+                month_from, month_to = _month_bounds(month)
+
+                await cursor.execute(
+                    """
+                    SELECT
+                        amount,
+                        balance_after,
+                        created_at
+                    FROM public.wallet_movement
+                    WHERE company_id = %s
+                      AND created_at >= %s
+                      AND created_at < %s
+                    ORDER BY
+                        created_at,
+                        id
+                    """,
+                    (
+                        company["id"],
+                        month_from,
+                        month_to,
+                    ),
+                )
+
+                movements[month] = await cursor.fetchall()
+
+            previous = None
+
+            if first_month not in snapshots:
+                await cursor.execute(
+                    """
+                    SELECT closing_balance
+                    FROM public.wallet_balance_snapshot
+                    WHERE company_id = %s
+                      AND month < %s
+                    ORDER BY month DESC
+                    LIMIT 1
+                    """,
+                    (
+                        company["id"],
+                        first_month,
+                    ),
+                )
+
+                previous = await cursor.fetchone()
+
+    # saldo al momento "from"
+    if first_month in snapshots:
+        opening_balance = Decimal(snapshots[first_month][1])
+
+        for amount, balance_after, created_at in movements.get(first_month, []):
+            if created_at >= dt_from:
+                break
+            opening_balance = Decimal(balance_after)
+
+    elif previous:
+        opening_balance = Decimal(previous[0])
+
+    else:
+        opening_balance = Decimal("0")
+
+    balance = opening_balance
+    total_credits = Decimal("0")
+    total_debits = Decimal("0")
+    total_count = 0
+    items = []
+
+    for month in months:
+        month_opening = balance
+        credits = Decimal("0")
+        debits = Decimal("0")
+        count = 0
+        snapshot = snapshots.get(month)
+
+        if snapshot is None:
+            pass
+
+        elif month in partial:
+            for amount, balance_after, created_at in movements.get(month, []):
+                if created_at < dt_from or created_at >= dt_to:
+                    continue
+                amount = Decimal(amount)
+                credits += max(amount, Decimal("0"))
+                debits += max(-amount, Decimal("0"))
+                count += 1
+                balance = Decimal(balance_after)
+
+        else:
+            credits = Decimal(snapshot[3])
+            debits = Decimal(snapshot[4])
+            count = int(snapshot[5])
+            balance = Decimal(snapshot[2])
+
+        total_credits += credits
+        total_debits += debits
+        total_count += count
+
+        items.append(
+            {
+                "month": month.strftime("%Y-%m"),
+                "partial": month in partial,
+                "opening_balance": float(month_opening),
+                "credits": float(credits),
+                "debits": float(debits),
+                "closing_balance": float(balance),
+                "movement_count": count,
+            }
+        )
+
+    config = await billing_config.get()
+
+    return {
+        "ok": True,
+        "company_id": company["id"],
+        "company_code": company["code"],
+        "from": dt_from.isoformat(),
+        "to": dt_to.isoformat(),
+        "currency": config["currency"] if config else None,
+        "opening_balance": float(opening_balance),
+        "credits": float(total_credits),
+        "debits": float(total_debits),
+        "closing_balance": float(balance),
+        "movement_count": total_count,
+        "months": items,
     }
 
 
@@ -244,29 +539,18 @@ async def create_mock_topup(
         f"mock-{uuid.uuid4()}"
     )
 
-    async with pool.connection() as connection:
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT id
-                FROM public.company
-                WHERE code = %s
-                  AND active
-                FOR UPDATE
-                """,
-                (company_code,),
-            )
-
-            company = await cursor.fetchone()
+    company = await company_registry.get_active(company_code)
 
-            if not company:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Company not found or inactive",
-                )
+    if not company:
+        raise HTTPException(
+            status_code=404,
+            detail="Company not found or inactive",
+        )
 
-            company_id = int(company[0])
+    company_id = company["id"]
 
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
             await cursor.execute(
                 """
                 INSERT INTO public.company_wallet (
@@ -343,6 +627,8 @@ async def create_mock_topup(
 
             movement_id = int(movement[0])
 
+            wallet_balances.invalidate(company_id)
+
     return {
         "ok": True,
         "movement_id": movement_id,
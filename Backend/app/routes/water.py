@@ -1,89 +1,275 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import time
 import uuid
+from datetime import datetime
+from decimal import Decimal
 from typing import Optional, Any
 
-import httpx
-from fastapi import APIRouter, HTTPException, UploadFile, Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Query, UploadFile, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from psycopg.types.json import Jsonb
 
 from app.db import pool
+from app.services.company import company_registry
+from app.services.dispatch import build_dispatch_where, dispatch_stream, format_sse
+from app.services.flow import flow_supervisor
+from app.services.pagination import decode_cursor, encode_cursor, parse_dt_param
+from app.services.prepaid import (
+    active_dispatches,
+    prepaid_enabled,
+    settle_dispatches,
+    start_prepaid_dispatch,
+)
+from app.services.storage import (
+    STORAGE_DEFER_DISPATCH_PHOTOS,
+    STORAGE_UPLOAD_CONCURRENCY,
+    deferred_photo_uploader,
+    image_extension,
+    open_image_upload,
+    spool_upload,
+    thumbnail_service,
+    upload_with_thumb_copy,
+)
 
 router = APIRouter()
 
 # =========================
 # ENV
 # =========================
-SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
-SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE", "")
-STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "cargadero")
+# Cada cuánto se manda un comentario keep-alive por el stream SSE
+DISPATCH_STREAM_PING_S = float(os.getenv("DISPATCH_STREAM_PING_S", "15"))
 
 
-def _public_url(object_path: str) -> str:
-    return f"{SUPABASE_URL}/storage/v1/object/public/{STORAGE_BUCKET}/{object_path}"
+def _normalize_photo_paths(value: Any, fallback_photo: Optional[str] = None) -> list[str]:
+    """
+    Normaliza photo_paths para devolver siempre una lista.
+    Sirve para filas viejas o valores NULL.
+    """
+    if isinstance(value, list):
+        return value
+
+    if isinstance(value, tuple):
+        return list(value)
+
+    if isinstance(value, str) and value.strip():
+        # Por si alguna vez vino guardado como string simple
+        return [value]
+
+    if fallback_photo:
+        return [fallback_photo]
+
+    return []
+
+
+# Columnas comunes de /dispatch/recent y /dispatch/history (ver _dispatch_item)
+_DISPATCH_SELECT = """
+    SELECT
+        wd.id,
+        wd.ts,
+        wd.station_id,
+        wd.liters,
+        wd.flow_l_min,
+        wd.photo_path,
+        wd.photo_paths,
+        wd.note,
+        c.id AS company_id,
+        c.name AS company_name,
+        c.code AS company_code,
+        wd.photo_uploads,
+        wd.thumb_paths,
+        wd.billing_status,
+        wd.amount
+    FROM public.water_dispatch wd
+    LEFT JOIN public.company c
+        ON c.id = wd.company_id
+"""
+
+
+def _dispatch_item(r: Any) -> dict[str, Any]:
+    """
+    Fila de /dispatch/recent o /dispatch/history -> dict de respuesta.
+    Las columnas son las de _DISPATCH_SELECT, en ese orden.
+    """
+    photo_path = r[5]
+    photo_paths = _normalize_photo_paths(r[6], fallback_photo=photo_path)
+    thumbs = r[12] or {}
+
+    return {
+        "id": r[0],
+        "ts": r[1].isoformat() if r[1] else None,
+        "station_id": r[2],
+        "liters": r[3],
+        "flow_l_min": r[4],
+        "photo_path": photo_path,
+        "photo_paths": photo_paths,
+        "thumb_path": thumbs.get(photo_path) if photo_path else None,
+        "thumb_paths": [thumbs.get(p) for p in photo_paths],
+        "note": r[7],
+        "company_id": r[8],
+        "company_name": r[9],
+        "company_code": r[10],
+        "photo_uploads": r[11] or {},
+        "billing_status": r[13],
+        "amount": r[14],
+    }
+
 
+def _defer_photos(value: Any) -> bool:
+    """
+    Campo defer_photos del multipart; si no viene, manda la env.
+    """
+    if value is None or not str(value).strip():
+        return STORAGE_DEFER_DISPATCH_PHOTOS
+    return str(value).strip().lower() in ("1", "true", "yes")
 
-async def _upload_bytes_to_supabase(
+
+async def _insert_dispatch(
+    cur: Any,
     *,
-    data: bytes,
-    content_type: str,
-    object_path: str,
-) -> str:
+    station_id: str,
+    company_code: str,
+    company_id: int,
+    photo_path: Optional[str],
+    photo_paths: list[str],
+    photo_uploads: Optional[dict[str, Any]],
+    note: Optional[str],
+) -> tuple[int, Any, Optional[dict[str, Any]]]:
     """
-    Sube bytes a Supabase Storage usando service role y devuelve URL pública.
+    Crea el despacho. Devuelve (id, ts, billing).
+
+    Con prepago, la autorización y el INSERT van juntos en
+    start_prepaid_dispatch (un solo round trip) y billing trae
+    saldo, tarifa y litros máximos; sin prepago billing es None.
     """
-    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE:
-        raise HTTPException(
-            status_code=500,
-            detail="Supabase env vars missing (SUPABASE_URL/SUPABASE_SERVICE_ROLE)",
+    if prepaid_enabled():
+        billing = await start_prepaid_dispatch(
+            cur,
+            company_code=company_code,
+            company_id=company_id,
+            station_id=station_id,
+            photo_path=photo_path,
+            photo_paths=Jsonb(photo_paths),
+            photo_uploads=Jsonb(photo_uploads) if photo_uploads else None,
+            note=note,
         )
+        return billing["dispatch_id"], billing["ts"], billing
+
+    await cur.execute(
+        """
+        INSERT INTO public.water_dispatch
+            (station_id, company_id, photo_path, photo_paths, photo_uploads, note)
+        VALUES
+            (%s, %s, %s, %s, %s, %s)
+        RETURNING id, ts
+        """,
+        (
+            station_id,
+            company_id,
+            photo_path,
+            Jsonb(photo_paths),
+            Jsonb(photo_uploads) if photo_uploads else None,
+            note,
+        ),
+    )
 
-    upload_url = f"{SUPABASE_URL}/storage/v1/object/{STORAGE_BUCKET}/{object_path}"
+    row = await cur.fetchone()
+    return int(row[0]), row[1], None
 
-    headers = {
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
-        "Content-Type": content_type,
-        "x-upsert": "true",
+
+def _billing_item(billing: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    if billing is None:
+        return None
+    return {
+        "balance": float(billing["balance"]),
+        "price_per_m3": float(billing["price_per_m3"]),
+        "currency": billing["currency"],
+        "max_affordable_liters": float(billing["max_affordable_liters"]),
+        "billing_config_version": billing["billing_config_version"],
     }
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(upload_url, content=data, headers=headers)
 
-    if r.status_code not in (200, 201):
-        raise HTTPException(
-            status_code=502,
-            detail={
-                "supabase_status": r.status_code,
-                "supabase_body": r.text,
-            },
-        )
+def _dispatch_started(
+    dispatch_id: int,
+    station_id: str,
+    company_id: int,
+    billing: Optional[dict[str, Any]],
+) -> None:
+    """
+    Después del commit del alta: supervisión de caudal (con el tope de
+    litros prepago) y registro de la carga activa de la empresa.
+    """
+    if billing is None:
+        flow_supervisor.track(dispatch_id, station_id)
+        return
 
-    return _public_url(object_path)
+    flow_supervisor.track(dispatch_id, station_id, billing["max_affordable_liters"])
+    active_dispatches.add(company_id, dispatch_id)
 
 
-def _normalize_photo_paths(value: Any, fallback_photo: Optional[str] = None) -> list[str]:
+async def _start_dispatch_deferred(
+    *,
+    station_id: str,
+    company_code: str,
+    company_id: int,
+    note: str,
+    pending: list[tuple[str, UploadFile, bytes, str, str]],
+) -> JSONResponse:
     """
-    Normaliza photo_paths para devolver siempre una lista.
-    Sirve para filas viejas o valores NULL.
+    Crea el despacho sin esperar a storage.
+
+    Las fotos (ya validadas) se copian a disco local, el despacho se
+    inserta con photo_paths vacío y photo_uploads en "pending", y el
+    worker de fotos diferidas las sube después.
     """
-    if isinstance(value, list):
-        return value
+    spooled = []
+    try:
+        for field, upload, first_chunk, content_type, object_path in pending:
+            path, size = await spool_upload(upload, first_chunk)
+            spooled.append((field, path, content_type, object_path, size))
 
-    if isinstance(value, tuple):
-        return list(value)
+        photo_uploads = {field: {"status": "pending"} for field, *_ in spooled}
 
-    if isinstance(value, str) and value.strip():
-        # Por si alguna vez vino guardado como string simple
-        return [value]
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                dispatch_id, ts, billing = await _insert_dispatch(
+                    cur,
+                    station_id=station_id,
+                    company_code=company_code,
+                    company_id=company_id,
+                    photo_path=None,
+                    photo_paths=[],
+                    photo_uploads=photo_uploads,
+                    note=note,
+                )
+    except BaseException:
+        for _field, path, *_ in spooled:
+            os.remove(path)
+        raise
 
-    if fallback_photo:
-        return [fallback_photo]
+    _dispatch_started(dispatch_id, station_id, company_id, billing)
+    deferred_photo_uploader.submit(dispatch_id, spooled)
 
-    return []
+    return JSONResponse(
+        {
+            "ok": True,
+            "id": dispatch_id,
+            "ts": ts.isoformat() if ts else None,
+            "station_id": station_id,
+            "company_code": company_code,
+            "company_id": company_id,
+            "photo_path": None,
+            "photo_paths": [],
+            "photo_uploads": photo_uploads,
+            "upload_errors": [],
+            "photos_deferred": True,
+            "note": note,
+            "billing": _billing_item(billing),
+        }
+    )
 
 
 # =========================
@@ -103,6 +289,15 @@ class SetLitersIn(BaseModel):
     liters: float = Field(..., ge=0)
 
 
+class BulkLitersItemIn(BaseModel):
+    dispatch_id: int
+    liters: float = Field(..., ge=0)
+
+
+class BulkLitersIn(BaseModel):
+    items: list[BulkLitersItemIn] = Field(..., min_length=1, max_length=1000)
+
+
 # =========================
 # DISPATCH START
 # =========================
@@ -129,10 +324,22 @@ async def start_dispatch(request: Request):
       file2
       file3
       file4
+      defer_photos (opcional, true/false; default STORAGE_DEFER_DISPATCH_PHOTOS)
 
     Guarda:
       - photo_path: primera foto recibida
       - photo_paths: lista JSONB con todas las fotos recibidas
+
+    Las fotos se suben en paralelo. Si alguna falla, el despacho
+    se crea igual con las que subieron y la falla vuelve en upload_errors.
+
+    Con defer_photos el despacho se crea sin esperar a storage: responde
+    con photo_paths vacío y photo_uploads en "pending", y un worker sube
+    las fotos y completa photo_paths después (ver /dispatch/recent).
+
+    Con PREPAID_ENABLED, la autorización (saldo mínimo, carga activa) y
+    el INSERT son una sola llamada a la DB; billing trae saldo, tarifa y
+    los litros máximos, que también usa el supervisor de caudal.
     """
     ct = (request.headers.get("content-type") or "").lower()
 
@@ -153,29 +360,18 @@ async def start_dispatch(request: Request):
                 detail="station_id and company_code are required (multipart)",
             )
 
-        # Buscar empresa activa por code.
+        # Buscar empresa activa por code (registro en memoria).
         # IMPORTANTE:
         # Node-RED manda company_code desde employeeNoString del Hikvision.
-        async with pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    SELECT id
-                    FROM public.company
-                    WHERE code = %s
-                      AND active
-                    """,
-                    (company_code,),
-                )
-                r = await cur.fetchone()
+        company = await company_registry.get_active(company_code)
 
-                if not r:
-                    raise HTTPException(
-                        status_code=404,
-                        detail="company not found or inactive",
-                    )
+        if not company:
+            raise HTTPException(
+                status_code=404,
+                detail="company not found or inactive",
+            )
 
-                company_id = int(r[0])
+        company_id = company["id"]
 
         # Aceptamos varios nombres de archivo desde Node-RED.
         # Tu flujo manda:
@@ -183,8 +379,10 @@ async def start_dispatch(request: Request):
         #   file2 = camara_2
         #   file3 = camara_3
         upload_fields = ["file", "file1", "file2", "file3", "file4"]
-        uploaded_urls: list[str] = []
+        pending: list[tuple[str, UploadFile, bytes, str, str]] = []
 
+        # Primero se validan todas mirando sólo el primer chunk
+        # (igual que antes: 415/400 cortan el request)
         for idx, field in enumerate(upload_fields, start=1):
             file_obj = form.get(field)
 
@@ -193,23 +391,9 @@ async def start_dispatch(request: Request):
 
             upload: UploadFile = file_obj  # type: ignore
 
-            content_type = (upload.content_type or "").lower()
-
-            if content_type not in ("image/jpeg", "image/jpg", "image/png"):
-                raise HTTPException(
-                    status_code=415,
-                    detail=f"Unsupported content-type in {field}: {upload.content_type}",
-                )
-
-            data = await upload.read()
-
-            if not data or len(data) < 1000:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"{field} empty or too small",
-                )
+            first_chunk, content_type = await open_image_upload(upload, field)
 
-            ext = ".png" if content_type == "image/png" else ".jpg"
+            ext = image_extension(content_type)
             ts = int(time.time())
 
             safe_station = station_id.upper().replace(" ", "_")
@@ -219,50 +403,90 @@ async def start_dispatch(request: Request):
                 f"{safe_suffix}_{field}_{idx}_{ts}_{uuid.uuid4().hex[:8]}{ext}"
             )
 
-            public_url = await _upload_bytes_to_supabase(
-                data=data,
-                content_type=content_type,
-                object_path=object_path,
+            pending.append((field, upload, first_chunk, content_type, object_path))
+
+        if _defer_photos(form.get("defer_photos")):
+            return await _start_dispatch_deferred(
+                station_id=station_id,
+                company_code=company_code,
+                company_id=company_id,
+                note=note,
+                pending=pending,
             )
 
-            uploaded_urls.append(public_url)
+        # Después se suben en paralelo y por streaming, con un tope de concurrencia.
+        # gather conserva el orden de los campos, así photo_paths es determinístico.
+        semaphore = asyncio.Semaphore(STORAGE_UPLOAD_CONCURRENCY)
+
+        async def _upload(
+            upload: UploadFile, first_chunk: bytes, content_type: str, object_path: str
+        ) -> tuple[str, Optional[str]]:
+            async with semaphore:
+                return await upload_with_thumb_copy(upload, first_chunk, content_type, object_path)
+
+        results = await asyncio.gather(
+            *(_upload(*item[1:]) for item in pending),
+            return_exceptions=True,
+        )
+
+        uploaded_urls: list[str] = []
+        upload_errors: list[dict[str, Any]] = []
+        photo_uploads: dict[str, Any] = {}
+        thumb_sources = []
+
+        for (field, upload, _first, _ct, object_path), result in zip(pending, results):
+            if isinstance(result, HTTPException):
+                upload_errors.append({"field": field, "status": result.status_code, "detail": result.detail})
+                photo_uploads[field] = {"status": "failed", "error": str(result.detail)}
+            elif isinstance(result, BaseException):
+                upload_errors.append({"field": field, "status": 502, "detail": str(result)})
+                photo_uploads[field] = {"status": "failed", "error": str(result)}
+            else:
+                url, thumb_path = result
+                uploaded_urls.append(url)
+                photo_uploads[field] = {"status": "uploaded", "url": url}
+
+                if thumb_path:
+                    thumb_sources.append((url, object_path, thumb_path))
 
         # Primera foto para compatibilidad con frontend viejo.
         main_photo = uploaded_urls[0] if uploaded_urls else None
 
         # Crear despacho guardando TODAS las fotos en photo_paths.
-        async with pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    INSERT INTO public.water_dispatch
-                        (station_id, company_id, photo_path, photo_paths, note)
-                    VALUES
-                        (%s, %s, %s, %s, %s)
-                    RETURNING id, ts
-                    """,
-                    (
-                        station_id,
-                        company_id,
-                        main_photo,
-                        Jsonb(uploaded_urls),
-                        note,
-                    ),
-                )
+        try:
+            async with pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    dispatch_id, ts, billing = await _insert_dispatch(
+                        cur,
+                        station_id=station_id,
+                        company_code=company_code,
+                        company_id=company_id,
+                        photo_path=main_photo,
+                        photo_paths=uploaded_urls,
+                        photo_uploads=photo_uploads,
+                        note=note,
+                    )
+        except BaseException:
+            thumbnail_service.discard(thumb_sources)
+            raise
 
-                row = await cur.fetchone()
+        _dispatch_started(dispatch_id, station_id, company_id, billing)
+        thumbnail_service.schedule(dispatch_id, thumb_sources)
 
         return JSONResponse(
             {
                 "ok": True,
-                "id": int(row[0]),
-                "ts": row[1].isoformat() if row and row[1] else None,
+                "id": dispatch_id,
+                "ts": ts.isoformat() if ts else None,
                 "station_id": station_id,
                 "company_code": company_code,
                 "company_id": company_id,
                 "photo_path": main_photo,
                 "photo_paths": uploaded_urls,
+                "photo_uploads": photo_uploads,
+                "upload_errors": upload_errors,
                 "note": note,
+                "billing": _billing_item(billing),
             }
         )
 
@@ -272,91 +496,201 @@ async def start_dispatch(request: Request):
     body = await request.json()
     payload = StartDispatchIn.model_validate(body)
 
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                SELECT id
-                FROM public.company
-                WHERE code = %s
-                  AND active
-                """,
-                (payload.company_code,),
-            )
-
-            r = await cur.fetchone()
-
-            if not r:
-                raise HTTPException(
-                    status_code=404,
-                    detail="company not found or inactive",
-                )
+    company = await company_registry.get_active(payload.company_code)
 
-            company_id = int(r[0])
+    if not company:
+        raise HTTPException(
+            status_code=404,
+            detail="company not found or inactive",
+        )
 
-            photo_paths = [payload.photo_path] if payload.photo_path else []
+    company_id = company["id"]
+    photo_paths = [payload.photo_path] if payload.photo_path else []
 
-            await cur.execute(
-                """
-                INSERT INTO public.water_dispatch
-                    (station_id, company_id, photo_path, photo_paths, note)
-                VALUES
-                    (%s, %s, %s, %s, %s)
-                RETURNING id, ts
-                """,
-                (
-                    payload.station_id,
-                    company_id,
-                    payload.photo_path,
-                    Jsonb(photo_paths),
-                    payload.note,
-                ),
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            dispatch_id, ts, billing = await _insert_dispatch(
+                cur,
+                station_id=payload.station_id,
+                company_code=payload.company_code,
+                company_id=company_id,
+                photo_path=payload.photo_path,
+                photo_paths=photo_paths,
+                photo_uploads=None,
+                note=payload.note,
             )
 
-            row = await cur.fetchone()
+    _dispatch_started(dispatch_id, payload.station_id, company_id, billing)
 
     return {
         "ok": True,
-        "id": int(row[0]),
-        "ts": row[1].isoformat() if row and row[1] else None,
+        "id": dispatch_id,
+        "ts": ts.isoformat() if ts else None,
         "station_id": payload.station_id,
         "company_code": payload.company_code,
         "company_id": company_id,
         "photo_path": payload.photo_path,
         "photo_paths": photo_paths,
         "note": payload.note,
+        "billing": _billing_item(billing),
     }
 
 
 # =========================
 # LITERS
 # =========================
-@router.post("/dispatch/{dispatch_id}/liters")
-async def set_liters(dispatch_id: int, body: SetLitersIn):
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
+async def _close_dispatches(cur: Any, items: list[tuple[int, float]]) -> dict[int, dict[str, Any]]:
+    """
+    Carga los litros finales y cierra los despachos, en la transacción
+    del cursor. La usan /dispatch/{id}/liters y /dispatch/liters/bulk,
+    así cerrar uno o muchos tiene el mismo efecto sobre el saldo.
+
+    Los despachos sin cobro (billing_status NULL: los de antes de
+    activar el prepago, o todos si está apagado) se cierran con un solo
+    UPDATE contra los pares recibidos. Con prepago activo, el resto se
+    cobra con settle_dispatches (billeteras y despachos bloqueados
+    siempre en el mismo orden) y sólo se cierran los que se pudieron
+    cobrar.
+
+    Devuelve un resultado por id:
+      {"ok": true, "liters", ...}  /  {"ok": false, "status", "error"}
+    """
+    ids = [dispatch_id for dispatch_id, _liters in items]
+    prepaid = prepaid_enabled()
+    results: dict[int, dict[str, Any]] = {}
+
+    await cur.execute(
+        """
+        UPDATE public.water_dispatch wd
+        SET
+            liters = v.liters,
+            closed_at = COALESCE(wd.closed_at, now()),
+            close_reason = COALESCE(wd.close_reason, 'liters_reported')
+        FROM unnest(%s::bigint[], %s::numeric[]) AS v(id, liters)
+        WHERE wd.id = v.id
+          AND (NOT %s OR wd.billing_status IS NULL)
+        RETURNING wd.id
+        """,
+        (ids, [liters for _id, liters in items], prepaid),
+    )
+    updated = {int(r[0]) for r in await cur.fetchall()}
+
+    for dispatch_id, liters in items:
+        if dispatch_id in updated:
+            results[dispatch_id] = {"ok": True, "liters": liters}
+
+    billed = [(dispatch_id, liters) for dispatch_id, liters in items if dispatch_id not in updated]
+
+    if prepaid and billed:
+        settled = await settle_dispatches(
+            cur,
+            [(dispatch_id, Decimal(str(liters))) for dispatch_id, liters in billed],
+        )
+
+        for dispatch_id, liters in billed:
+            result = settled[dispatch_id]
+            if result["ok"]:
+                result = {"ok": True, "liters": liters, **result}
+            results[dispatch_id] = result
+
+        settled_ids = [dispatch_id for dispatch_id, _liters in billed if results[dispatch_id]["ok"]]
+        if settled_ids:
             await cur.execute(
                 """
                 UPDATE public.water_dispatch
-                SET liters = %s
-                WHERE id = %s
-                RETURNING id
+                SET
+                    closed_at = COALESCE(closed_at, now()),
+                    close_reason = COALESCE(close_reason, 'liters_reported')
+                WHERE id = ANY(%s)
                 """,
-                (body.liters, dispatch_id),
+                (settled_ids,),
             )
 
-            r = await cur.fetchone()
+    for dispatch_id in ids:
+        results.setdefault(
+            dispatch_id,
+            {"ok": False, "status": 404, "error": "dispatch not found"},
+        )
+
+    return results
+
+
+def _dispatches_closed(results: dict[int, dict[str, Any]]) -> None:
+    """
+    Después del commit: Node-RED informó los litros finales, la carga
+    terminó y deja de ser la activa de su empresa.
+    """
+    for dispatch_id, result in results.items():
+        if result["ok"]:
+            flow_supervisor.untrack(dispatch_id)
+            active_dispatches.discard(dispatch_id)
+
+
+@router.post("/dispatch/{dispatch_id}/liters")
+async def set_liters(dispatch_id: int, body: SetLitersIn):
+    """
+    Litros finales de un despacho: la carga terminó.
+
+    Con prepago activo el despacho se cobra en la misma transacción
+    (ver _close_dispatches).
+    """
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            results = await _close_dispatches(cur, [(dispatch_id, body.liters)])
+            result = results[dispatch_id]
 
-            if not r:
+            if not result["ok"]:
                 raise HTTPException(
-                    status_code=404,
-                    detail="dispatch not found",
+                    status_code=result["status"],
+                    detail=result["error"],
                 )
 
+    _dispatches_closed(results)
+
+    return {"id": dispatch_id, **result}
+
+
+@router.post("/dispatch/liters/bulk")
+async def set_liters_bulk(body: BulkLitersIn):
+    """
+    Carga los litros finales de muchos despachos en una sola transacción
+    (ej: Node-RED reenviando lo acumulado durante un corte de conexión).
+
+      {"items": [{"dispatch_id": 120, "liters": 8000}, ...]}
+
+    Devuelve un resultado por item, en el mismo orden:
+      {"dispatch_id", "ok": true, "liters", ...}
+      {"dispatch_id", "ok": false, "status", "error"}
+
+    Cierra y cobra igual que /dispatch/{id}/liters (_close_dispatches):
+    con prepago activo los débitos se escriben con una cantidad fija de
+    sentencias, sin importar cuántos items vengan.
+    """
+    ids = [item.dispatch_id for item in body.items]
+
+    if len(set(ids)) != len(ids):
+        raise HTTPException(
+            status_code=422,
+            detail="duplicated dispatch_id in items",
+        )
+
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            results = await _close_dispatches(
+                cur,
+                [(item.dispatch_id, item.liters) for item in body.items],
+            )
+
+    _dispatches_closed(results)
+
+    items = [{"dispatch_id": item.dispatch_id, **results[item.dispatch_id]} for item in body.items]
+
     return {
         "ok": True,
-        "id": dispatch_id,
-        "liters": body.liters,
+        "prepaid": prepaid_enabled(),
+        "updated": sum(1 for i in items if i["ok"]),
+        "failed": sum(1 for i in items if not i["ok"]),
+        "items": items,
     }
 
 
@@ -375,6 +709,8 @@ async def recent(limit: int = 20, station_id: Optional[str] = None):
     Devuelve:
       - photo_path: foto principal
       - photo_paths: todas las fotos guardadas
+      - photo_uploads: estado por foto (pending/uploaded/failed)
+      - thumb_path / thumb_paths: thumbnails en el mismo orden (null si no hay)
     """
     limit = max(1, min(int(limit), 500))
 
@@ -382,22 +718,8 @@ async def recent(limit: int = 20, station_id: Optional[str] = None):
         async with conn.cursor() as cur:
             if station_id:
                 await cur.execute(
-                    """
-                    SELECT
-                        wd.id,
-                        wd.ts,
-                        wd.station_id,
-                        wd.liters,
-                        wd.flow_l_min,
-                        wd.photo_path,
-                        wd.photo_paths,
-                        wd.note,
-                        c.id AS company_id,
-                        c.name AS company_name,
-                        c.code AS company_code
-                    FROM public.water_dispatch wd
-                    LEFT JOIN public.company c
-                        ON c.id = wd.company_id
+                    _DISPATCH_SELECT
+                    + """
                     WHERE wd.station_id = %s
                     ORDER BY wd.ts DESC
                     LIMIT %s
@@ -406,22 +728,8 @@ async def recent(limit: int = 20, station_id: Optional[str] = None):
                 )
             else:
                 await cur.execute(
-                    """
-                    SELECT
-                        wd.id,
-                        wd.ts,
-                        wd.station_id,
-                        wd.liters,
-                        wd.flow_l_min,
-                        wd.photo_path,
-                        wd.photo_paths,
-                        wd.note,
-                        c.id AS company_id,
-                        c.name AS company_name,
-                        c.code AS company_code
-                    FROM public.water_dispatch wd
-                    LEFT JOIN public.company c
-                        ON c.id = wd.company_id
+                    _DISPATCH_SELECT
+                    + """
                     ORDER BY wd.ts DESC
                     LIMIT %s
                     """,
@@ -430,34 +738,188 @@ async def recent(limit: int = 20, station_id: Optional[str] = None):
 
             rows = await cur.fetchall()
 
-    items = []
+    items = [_dispatch_item(r) for r in rows]
 
-    for r in rows:
-        photo_path = r[5]
-        photo_paths = _normalize_photo_paths(r[6], fallback_photo=photo_path)
+    return {
+        "ok": True,
+        "items": items,
+    }
 
-        items.append(
-            {
-                "id": r[0],
-                "ts": r[1].isoformat() if r[1] else None,
-                "station_id": r[2],
-                "liters": r[3],
-                "flow_l_min": r[4],
-                "photo_path": photo_path,
-                "photo_paths": photo_paths,
-                "note": r[7],
-                "company_id": r[8],
-                "company_name": r[9],
-                "company_code": r[10],
-            }
-        )
+
+# =========================
+# HISTORY (paginado por cursor)
+# =========================
+@router.get("/dispatch/history")
+async def history(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    from_ts: Optional[str] = Query(None, alias="from"),
+    to_ts: Optional[str] = Query(None, alias="to"),
+    station_id: Optional[str] = None,
+    company_id: Optional[int] = None,
+    company_code: Optional[str] = None,
+    billing_status: Optional[str] = None,
+):
+    """
+    Historial de despachos paginado por cursor sobre (ts, id), del más
+    nuevo al más viejo. A diferencia de OFFSET, cada página cuesta lo
+    mismo sin importar qué tan atrás esté.
+
+    Ejemplos:
+      /water/dispatch/history?from=2026-01-01T00:00:00Z&to=2026-02-01T00:00:00Z
+      /water/dispatch/history?company_code=1&billing_status=completed&cursor=...
+
+    Params:
+      limit: 1..500 (default 100)
+      cursor: next_cursor de la página anterior
+      from, to: ISO8601, rango [from, to)
+      station_id, company_id / company_code: opcionales
+      billing_status: active, completed, ... o "none" para los sin cobro
+
+    Devuelve items (mismo formato que /dispatch/recent, más
+    billing_status y amount) y next_cursor (null en la última página).
+    """
+    limit = max(1, min(int(limit), 500))
+
+    dt_from = parse_dt_param(from_ts, "from")
+    dt_to = parse_dt_param(to_ts, "to")
+
+    if company_code:
+        company = await company_registry.get(company_code)
+        if not company:
+            raise HTTPException(status_code=404, detail="company not found")
+        if company_id is not None and company_id != company["id"]:
+            raise HTTPException(status_code=422, detail="company_id and company_code do not match")
+        company_id = company["id"]
+
+    where_sql, params = build_dispatch_where(
+        dt_from=dt_from,
+        dt_to=dt_to,
+        station_id=station_id,
+        company_id=company_id,
+    )
+    extra: list[str] = []
+
+    if billing_status == "none":
+        extra.append("wd.billing_status IS NULL")
+    elif billing_status:
+        extra.append("wd.billing_status = %s")
+        params.append(billing_status)
+
+    if cursor:
+        cursor_ts, cursor_id = decode_cursor(cursor)
+        # comparación de filas: usa los índices (..., ts DESC, id DESC) de la migración 008
+        extra.append("(wd.ts, wd.id) < (%s, %s)")
+        params.extend([cursor_ts, cursor_id])
+
+    if extra:
+        where_sql = (where_sql + " AND " if where_sql else "WHERE ") + " AND ".join(extra)
+
+    sql = f"""
+        {_DISPATCH_SELECT}
+        {where_sql}
+        ORDER BY wd.ts DESC, wd.id DESC
+        LIMIT %s
+    """
+    # uno de más para saber si hay otra página
+    params.append(limit + 1)
+
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql, tuple(params))
+            rows = await cur.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
 
     return {
         "ok": True,
-        "items": items,
+        "filters": {
+            "from": dt_from.isoformat() if dt_from else None,
+            "to": dt_to.isoformat() if dt_to else None,
+            "station_id": station_id,
+            "company_id": company_id,
+            "billing_status": billing_status,
+        },
+        "items": [_dispatch_item(r) for r in rows],
+        "next_cursor": encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None,
     }
 
 
+# =========================
+# STREAM (SSE)
+# =========================
+@router.get("/dispatch/stream")
+async def stream(
+    request: Request,
+    station_id: Optional[str] = None,
+    company_id: Optional[int] = None,
+    last_event_id: Optional[str] = None,
+):
+    """
+    Server-sent events con cada alta o cambio de water_dispatch.
+
+    Reemplaza el polling de /dispatch/recent: todas las pestañas
+    comparten un único LISTEN en el backend.
+
+    Eventos:
+      dispatch: {op, id, ts, station_id, company_id, company_code,
+                 company_name, liters, flow_l_min, billing_status,
+                 amount, photo_path, photo_count, note}
+      resync:   se perdieron eventos; volver a pedir /dispatch/recent
+
+    Para retomar se usa el header Last-Event-ID (EventSource lo manda
+    solo al reconectar) o el query param last_event_id.
+    """
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    queue, backlog = dispatch_stream.subscribe(resume_from)
+
+    def _wanted(event: Any) -> bool:
+        _id, kind, data = event
+        if kind != "dispatch":
+            return True
+        if station_id and str(data.get("station_id")) != station_id:
+            return False
+        if company_id is not None and data.get("company_id") != company_id:
+            return False
+        return True
+
+    async def _events():
+        try:
+            yield "retry: 3000\n\n"
+
+            for event in backlog:
+                if _wanted(event):
+                    yield format_sse(event)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), DISPATCH_STREAM_PING_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": ping\n\n"
+                    continue
+
+                # None = apagado de la app o cliente demasiado lento
+                if event is None:
+                    return
+
+                if _wanted(event):
+                    yield format_sse(event)
+        finally:
+            dispatch_stream.unsubscribe(queue)
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
 # =========================
 # ATTACH PHOTO TO EXISTING DISPATCH
 # =========================
@@ -495,21 +957,7 @@ async def attach_photo(dispatch_id: int, request: Request):
 
     upload: UploadFile = file_obj  # type: ignore
 
-    content_type = (upload.content_type or "").lower()
-
-    if content_type not in ("image/jpeg", "image/jpg", "image/png"):
-        raise HTTPException(
-            status_code=415,
-            detail=f"Unsupported content-type: {upload.content_type}",
-        )
-
-    data = await upload.read()
-
-    if not data or len(data) < 1000:
-        raise HTTPException(
-            status_code=400,
-            detail="File empty or too small",
-        )
+    first_chunk, content_type = await open_image_upload(upload)
 
     async with pool.connection() as conn:
         async with conn.cursor() as cur:
@@ -532,7 +980,7 @@ async def attach_photo(dispatch_id: int, request: Request):
 
             station_id = row[0] or "UNKNOWN"
 
-    ext = ".png" if content_type == "image/png" else ".jpg"
+    ext = image_extension(content_type)
     ts = int(time.time())
 
     safe_station = str(station_id).upper().replace(" ", "_")
@@ -543,37 +991,40 @@ async def attach_photo(dispatch_id: int, request: Request):
         f"{safe_suffix}_{ts}_{uuid.uuid4().hex[:8]}{ext}"
     )
 
-    public_url = await _upload_bytes_to_supabase(
-        data=data,
-        content_type=content_type,
-        object_path=object_path,
-    )
+    public_url, thumb_path = await upload_with_thumb_copy(upload, first_chunk, content_type, object_path)
+    thumb_sources = [(public_url, object_path, thumb_path)] if thumb_path else []
 
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                UPDATE public.water_dispatch
-                SET
-                    photo_path = %s,
-                    photo_paths = COALESCE(photo_paths, '[]'::jsonb) || %s
-                WHERE id = %s
-                RETURNING id
-                """,
-                (
-                    public_url,
-                    Jsonb([public_url]),
-                    dispatch_id,
-                ),
-            )
+    try:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.water_dispatch
+                    SET
+                        photo_path = %s,
+                        photo_paths = COALESCE(photo_paths, '[]'::jsonb) || %s
+                    WHERE id = %s
+                    RETURNING id
+                    """,
+                    (
+                        public_url,
+                        Jsonb([public_url]),
+                        dispatch_id,
+                    ),
+                )
 
-            r = await cur.fetchone()
+                r = await cur.fetchone()
 
-            if not r:
-                raise HTTPException(
-                    status_code=404,
-                    detail="dispatch not found",
-                )
+                if not r:
+                    raise HTTPException(
+                        status_code=404,
+                        detail="dispatch not found",
+                    )
+    except BaseException:
+        thumbnail_service.discard(thumb_sources)
+        raise
+
+    thumbnail_service.schedule(dispatch_id, thumb_sources)
 
     return JSONResponse(
         {
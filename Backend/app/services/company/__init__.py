@@ -0,0 +1,10 @@
+from app.services.company.registry import (
+    CompanyRegistry,
+    company_registry,
+)
+
+
+__all__ = [
+    "CompanyRegistry",
+    "company_registry",
+]
@@ -0,0 +1,142 @@
+from collections import Counter
+from typing import Any, Optional
+
+from app.db import pool
+from app.notify import notify_hub
+
+
+COMPANY_CHANGED_CHANNEL = "company_changed"
+
+
+class CompanyRegistry:
+    """
+    Registro en memoria de public.company indexado por code.
+
+    Se carga completo en el lifespan y se mantiene al día con el
+    trigger company_changed (LISTEN/NOTIFY). Las rutas de company
+    también lo refrescan apenas hacen commit.
+    """
+
+    def __init__(self) -> None:
+        self._by_code: dict[str, dict[str, Any]] = {}
+        self._ready = False
+        self._stats: Counter = Counter()
+
+    async def load(self) -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, name, code, active
+                    FROM public.company
+                    """
+                )
+                rows = await cur.fetchall()
+
+        self._by_code = {
+            r[2]: {
+                "id": int(r[0]),
+                "name": r[1],
+                "code": r[2],
+                "active": bool(r[3]),
+            }
+            for r in rows
+            if r[2]
+        }
+        self._ready = True
+        self._stats["reloads"] += 1
+
+    async def refresh(self, code: str) -> None:
+        """
+        Vuelve a leer una sola empresa (o la quita si ya no existe).
+        """
+        entry = await self._fetch(code)
+
+        if entry is None:
+            self._by_code.pop(code, None)
+        else:
+            self._by_code[code] = entry
+
+        self._stats["refreshes"] += 1
+
+    async def get(self, code: str) -> Optional[dict[str, Any]]:
+        """
+        Devuelve {id, name, code, active} o None.
+
+        Mientras el registro no esté cargado, consulta la DB. Ya cargado,
+        un code que no está se busca en la DB y, si existe, se guarda:
+        una empresa creada mientras LISTEN se reconectaba (o por otro
+        proceso) no da 404 hasta la próxima recarga completa.
+        """
+        if not self._ready:
+            self._stats["db_lookups"] += 1
+            return await self._fetch(code)
+
+        entry = self._by_code.get(code)
+        if entry is not None:
+            self._stats["hits"] += 1
+            return entry
+
+        self._stats["misses"] += 1
+        return await self._fetch_missing(code)
+
+    async def get_active(self, code: str) -> Optional[dict[str, Any]]:
+        """
+        Como get(), pero sólo empresas activas. Una empresa que figura
+        inactiva se vuelve a leer de la DB por si se reactivó sin que
+        llegara el NOTIFY.
+        """
+        entry = await self.get(code)
+        if entry is not None and not entry["active"] and self._ready:
+            entry = await self._fetch_missing(code)
+        if entry is None or not entry["active"]:
+            return None
+        return entry
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "ready": self._ready,
+            "size": len(self._by_code),
+            **self._stats,
+        }
+
+    async def _fetch_missing(self, code: str) -> Optional[dict[str, Any]]:
+        self._stats["miss_lookups"] += 1
+        entry = await self._fetch(code)
+
+        if entry is None:
+            self._by_code.pop(code, None)
+        else:
+            self._by_code[code] = entry
+            self._stats["miss_found"] += 1
+
+        return entry
+
+    async def _fetch(self, code: str) -> Optional[dict[str, Any]]:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, name, code, active
+                    FROM public.company
+                    WHERE code = %s
+                    """,
+                    (code,),
+                )
+                row = await cur.fetchone()
+
+        if not row:
+            return None
+
+        return {
+            "id": int(row[0]),
+            "name": row[1],
+            "code": row[2],
+            "active": bool(row[3]),
+        }
+
+
+company_registry = CompanyRegistry()
+
+notify_hub.subscribe(COMPANY_CHANGED_CHANNEL, company_registry.refresh)
+notify_hub.on_reconnect(company_registry.load)
@@ -0,0 +1,14 @@
+from app.services.dispatch.filters import build_dispatch_where
+from app.services.dispatch.stream import (
+    DispatchStream,
+    dispatch_stream,
+    format_sse,
+)
+
+
+__all__ = [
+    "build_dispatch_where",
+    "DispatchStream",
+    "dispatch_stream",
+    "format_sse",
+]
@@ -0,0 +1,38 @@
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+
+def build_dispatch_where(
+    *,
+    dt_from: Optional[datetime],
+    dt_to: Optional[datetime],
+    station_id: Optional[str],
+    company_id: Optional[int],
+) -> Tuple[str, List[Any]]:
+    """
+    WHERE sobre water_dispatch (alias wd) por rango [from, to), estación y empresa.
+    Lo comparten /kpi y /water/dispatch/history.
+    """
+    where: List[str] = []
+    params: List[Any] = []
+
+    # ts range
+    if dt_from is not None:
+        where.append("wd.ts >= %s")
+        params.append(dt_from)
+    if dt_to is not None:
+        where.append("wd.ts < %s")
+        params.append(dt_to)
+
+    # filters
+    if station_id:
+        where.append("wd.station_id = %s")
+        params.append(station_id)
+
+    if company_id is not None:
+        where.append("wd.company_id = %s")
+        params.append(company_id)
+
+    if where:
+        return "WHERE " + " AND ".join(where), params
+    return "", params
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, deque
+from typing import Any, Optional
+
+from app.notify import notify_hub
+
+logger = logging.getLogger(__name__)
+
+
+DISPATCH_CHANGED_CHANNEL = "water_dispatch_changed"
+
+# ===== ENV =====
+# Eventos que se guardan para retomar con Last-Event-ID
+DISPATCH_STREAM_BUFFER = int(os.getenv("DISPATCH_STREAM_BUFFER", "1000"))
+
+# Eventos encolados por cliente; si un cliente lento los supera, se lo
+# desconecta (el navegador reconecta solo y retoma desde su último id)
+DISPATCH_STREAM_CLIENT_QUEUE = int(os.getenv("DISPATCH_STREAM_CLIENT_QUEUE", "200"))
+
+
+# (id, tipo, datos) -> una entrada "id: / event: / data:" del SSE
+StreamEvent = tuple[str, str, dict[str, Any]]
+
+
+class DispatchStream:
+    """
+    Reparte los cambios de public.water_dispatch a los clientes SSE.
+
+    Hay un solo LISTEN (el de notify_hub) para todos los clientes: cada
+    NOTIFY recibe un id "<arranque>-<seq>", se guarda en un buffer
+    circular y se copia a la cola de cada suscriptor.
+
+    Si el cliente manda un Last-Event-ID que sigue en el buffer, recibe
+    lo que se perdió; si no (reinicio del proceso o buffer pasado), o si
+    la conexión LISTEN se cortó, recibe un evento "resync" para que
+    vuelva a pedir /dispatch/recent.
+    """
+
+    def __init__(self) -> None:
+        self._boot = format(int(time.time()), "x")
+        self._seq = 0
+        self._buffer: deque[tuple[int, StreamEvent]] = deque(maxlen=DISPATCH_STREAM_BUFFER)
+        self._subscribers: set[asyncio.Queue] = set()
+        self._stats: Counter = Counter()
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> tuple[asyncio.Queue, list[StreamEvent]]:
+        """
+        Devuelve (cola, pendientes): los eventos posteriores a
+        last_event_id que siguen en el buffer y la cola para los nuevos.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=DISPATCH_STREAM_CLIENT_QUEUE)
+        self._subscribers.add(queue)
+        self._stats["subscribes"] += 1
+
+        if not last_event_id:
+            return queue, []
+
+        boot, _, seq = last_event_id.partition("-")
+        try:
+            last_seq = int(seq)
+        except ValueError:
+            last_seq = -1
+
+        oldest = self._buffer[0][0] if self._buffer else self._seq + 1
+
+        # otro arranque, id inválido o ya salió del buffer: no se puede completar
+        if boot != self._boot or last_seq < 0 or last_seq + 1 < oldest:
+            self._stats["resyncs"] += 1
+            return queue, [self._resync_event("gap")]
+
+        self._stats["resumes"] += 1
+        return queue, [event for seq, event in self._buffer if seq > last_seq]
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    async def close(self) -> None:
+        """
+        Termina todas las respuestas abiertas (al apagar la app).
+        """
+        for queue in list(self._subscribers):
+            self._offer(queue, None)
+        self._subscribers.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "subscribers": len(self._subscribers),
+            "buffered": len(self._buffer),
+            "last_id": self._event_id(self._seq) if self._seq else None,
+            **self._stats,
+        }
+
+    async def on_notify(self, payload: str) -> None:
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logger.warning("dispatch_stream: payload inválido: %r", payload[:200])
+            return
+
+        self._publish("dispatch", data)
+
+    async def on_reconnect(self) -> None:
+        # durante el corte del LISTEN se pudieron perder cambios
+        self._publish("resync", {"reason": "listener_reconnected"})
+
+    def _publish(self, kind: str, data: dict[str, Any]) -> None:
+        self._seq += 1
+        event = (self._event_id(self._seq), kind, data)
+        self._buffer.append((self._seq, event))
+        self._stats["events"] += 1
+
+        for queue in list(self._subscribers):
+            if not self._offer(queue, event):
+                # cliente lento: se lo corta; reconecta con Last-Event-ID
+                self._subscribers.discard(queue)
+                self._offer(queue, None, force=True)
+                self._stats["dropped_slow"] += 1
+
+    def _resync_event(self, reason: str) -> StreamEvent:
+        # sin id propio: no mueve el Last-Event-ID del cliente
+        return ("", "resync", {"reason": reason, "last_id": self._event_id(self._seq)})
+
+    def _event_id(self, seq: int) -> str:
+        return f"{self._boot}-{seq}"
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, item: Any, force: bool = False) -> bool:
+        try:
+            queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            if not force:
+                return False
+            # dejar lugar para el aviso de fin
+            queue.get_nowait()
+            queue.put_nowait(item)
+            return True
+
+
+def format_sse(event: StreamEvent) -> str:
+    event_id, kind, data = event
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {kind}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'), default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+dispatch_stream = DispatchStream()
+
+notify_hub.subscribe(DISPATCH_CHANGED_CHANNEL, dispatch_stream.on_notify)
+notify_hub.on_reconnect(dispatch_stream.on_reconnect)
@@ -0,0 +1,22 @@
+from app.services.flow.supervisor import (
+    FlowSupervisor,
+    StationFlow,
+    flow_supervisor,
+)
+from app.services.flow.telemetry import (
+    FLOW_PULSES_PER_LITER,
+    TelemetryIngestor,
+    sample_liters,
+    telemetry_ingestor,
+)
+
+
+__all__ = [
+    "FlowSupervisor",
+    "StationFlow",
+    "flow_supervisor",
+    "FLOW_PULSES_PER_LITER",
+    "TelemetryIngestor",
+    "sample_liters",
+    "telemetry_ingestor",
+]
@@ -0,0 +1,402 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from decimal import Decimal
+from typing import Any, Optional
+
+from app.db import pool
+from app.services.flow.telemetry import telemetry_ingestor
+from app.services.node_red import node_red_outbox
+from app.services.prepaid import active_dispatches, prepaid_enabled, settle_dispatches
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ENV =====
+# Caudal nominal: se usa para anticipar el corte antes del tope de litros
+DEFAULT_FLOW_LPS = float(os.getenv("DEFAULT_FLOW_LPS", "12"))
+
+# Período del tick del supervisor; también es lo que tarda la válvula en
+# reaccionar a una orden de corte
+REACTION_S = float(os.getenv("REACTION_S", "1.0"))
+
+MIN_FLOW_LPS = float(os.getenv("MIN_FLOW_LPS", "1.0"))
+MAX_FLOW_LPS = float(os.getenv("MAX_FLOW_LPS", "80.0"))
+ZERO_FLOW_TICKS_TO_STOP = int(os.getenv("ZERO_FLOW_TICKS_TO_STOP", "8"))
+
+# Una lectura más vieja que esto se considera "sin dato" (no "sin
+# caudal"): tiene que cubrir con margen el intervalo entre envíos de
+# telemetría de Node-RED (POST /water/telemetry manda por lotes)
+FLOW_READING_STALE_S = float(os.getenv("FLOW_READING_STALE_S", "30"))
+
+# Despachos abiertos más viejos que esto no se supervisan al arrancar
+# (filas anteriores a closed_at que nunca se cerraron)
+FLOW_SUPERVISE_MAX_AGE_H = float(os.getenv("FLOW_SUPERVISE_MAX_AGE_H", "12"))
+
+# Despacho prepago cortado por el supervisor: Node-RED tiene este tiempo
+# para informar los litros finales (/water/dispatch/{id}/liters); pasado
+# eso el supervisor lo cobra con los últimos litros de la telemetría
+FLOW_SETTLE_GRACE_S = float(os.getenv("FLOW_SETTLE_GRACE_S", "120"))
+
+# Cada cuánto se buscan despachos cortados que siguen sin cobrar
+SETTLE_SWEEP_S = 30
+
+# Ticks seguidos fuera de rango antes de cortar
+OVER_RANGE_TICKS_TO_STOP = 3
+
+
+class StationFlow:
+    """
+    Estado de supervisión de la carga abierta en una estación.
+
+    waiting:    despacho iniciado, todavía sin caudal (o sin lecturas)
+    flowing:    caudal dentro de rango
+    stalled:    había caudal y dejó de haber
+    over_range: caudal por encima de MAX_FLOW_LPS
+    closing:    ya se decidió el corte, falta confirmarlo en la DB
+
+    Si la última lectura tiene más de FLOW_READING_STALE_S (telemetría
+    atrasada o cortada), el caudal es desconocido: el tick no cuenta
+    como "sin caudal", no cambia el estado y no corta (stale=True).
+    """
+
+    __slots__ = (
+        "station_id",
+        "dispatch_id",
+        "max_liters",
+        "state",
+        "zero_ticks",
+        "over_ticks",
+        "flow_lps",
+        "liters",
+        "close_reason",
+        "has_readings",
+        "stale",
+    )
+
+    def __init__(self, station_id: str, dispatch_id: int, max_liters: Optional[float]) -> None:
+        self.station_id = station_id
+        self.dispatch_id = dispatch_id
+        self.max_liters = max_liters
+        self.state = "waiting"
+        self.zero_ticks = 0
+        self.over_ticks = 0
+        self.flow_lps: Optional[float] = None
+        self.liters: Optional[float] = None
+        self.close_reason: Optional[str] = None
+        self.has_readings = False
+        self.stale = False
+
+    def tick(self, reading: Optional[dict[str, Any]], now: float) -> Optional[str]:
+        """
+        Avanza un tick con la última lectura del caudalímetro.
+        Devuelve el motivo de corte, o None si la carga sigue.
+        """
+        if reading is None or now - reading["seen"] > FLOW_READING_STALE_S:
+            # sin lectura reciente no hay con qué decidir: ni estaciones sin
+            # caudalímetro ni telemetría atrasada cortan la carga
+            self.flow_lps = None
+            self.stale = self.has_readings
+            return None
+
+        self.has_readings = True
+        self.stale = False
+        flow_l_min = reading["flow_l_min"]
+        self.flow_lps = flow_l_min / 60 if flow_l_min is not None else None
+        if reading["liters"] is not None:
+            self.liters = reading["liters"]
+
+        if self.max_liters is not None and self.liters is not None:
+            # lo que sigue pasando mientras la válvula reacciona
+            lead = (self.flow_lps or DEFAULT_FLOW_LPS) * REACTION_S
+            if self.liters + lead >= self.max_liters:
+                return "max_liters"
+
+        if self.flow_lps is None or self.flow_lps < MIN_FLOW_LPS:
+            self.zero_ticks += 1
+            self.over_ticks = 0
+            if self.state in ("flowing", "over_range"):
+                self.state = "stalled"
+            if self.zero_ticks >= ZERO_FLOW_TICKS_TO_STOP:
+                return "zero_flow" if self.state == "stalled" else "no_flow"
+            return None
+
+        self.zero_ticks = 0
+
+        if self.flow_lps > MAX_FLOW_LPS:
+            self.over_ticks += 1
+            self.state = "over_range"
+            if self.over_ticks >= OVER_RANGE_TICKS_TO_STOP:
+                return "over_range"
+            return None
+
+        self.over_ticks = 0
+        self.state = "flowing"
+        return None
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "station_id": self.station_id,
+            "dispatch_id": self.dispatch_id,
+            "state": self.state,
+            "flow_lps": round(self.flow_lps, 3) if self.flow_lps is not None else None,
+            "liters": self.liters,
+            "max_liters": self.max_liters,
+            "zero_ticks": self.zero_ticks,
+            "stale": self.stale,
+            "close_reason": self.close_reason,
+        }
+
+
+class FlowSupervisor:
+    """
+    Supervisa en memoria el caudal de cada estación con una carga abierta.
+
+    Cada REACTION_S mira la última lectura de telemetry_ingestor (sin
+    leer la DB) y avanza la máquina de estados de cada estación. Corta
+    la carga después de ZERO_FLOW_TICKS_TO_STOP ticks sin caudal, con
+    caudal fuera de rango sostenido o al llegar al tope de litros
+    prepago: cierra el despacho y, en la misma transacción, encola la
+    orden de corte para Node-RED (outbox, tipo dispatch_stop).
+
+    Al arrancar se reconstruye con los despachos abiertos de la DB.
+
+    El corte guarda los últimos litros de la telemetría pero no cobra:
+    un despacho prepago queda closed_at + billing_status 'active' hasta
+    que Node-RED informe los litros finales. Si no llegan en
+    FLOW_SETTLE_GRACE_S, lo cobra el propio supervisor con los litros
+    guardados (barrido cada SETTLE_SWEEP_S contra la DB, así también
+    cubre cortes anteriores a un reinicio) y la empresa queda libre
+    para otra carga.
+    """
+
+    def __init__(self) -> None:
+        self._stations: dict[str, StationFlow] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stats: Counter = Counter()
+        # cobros rechazados (ej: DISPATCH_EXCEEDED_BALANCE): revisión manual
+        self._unsettleable: set[int] = set()
+
+    async def load(self) -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT DISTINCT ON (station_id)
+                        id,
+                        station_id,
+                        max_affordable_liters
+                    FROM public.water_dispatch
+                    WHERE closed_at IS NULL
+                      AND ts > now() - make_interval(hours => %s)
+                      AND (billing_status IS NULL OR billing_status = 'active')
+                    ORDER BY station_id, ts DESC
+                    """,
+                    (FLOW_SUPERVISE_MAX_AGE_H,),
+                )
+                rows = await cur.fetchall()
+
+        self._stations = {}
+        for dispatch_id, station_id, max_liters in rows:
+            self.track(int(dispatch_id), station_id, max_liters)
+
+        self._stats["loads"] += 1
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def track(self, dispatch_id: int, station_id: Optional[str], max_liters: Any = None) -> None:
+        """
+        Empieza a supervisar un despacho recién abierto.
+        Una estación tiene una sola carga a la vez: la anterior se suelta.
+        """
+        if not station_id:
+            return
+
+        previous = self._stations.get(station_id)
+        if previous is not None and previous.dispatch_id != dispatch_id:
+            logger.warning(
+                "flow: estación %s abrió el despacho %s sin cerrar el %s",
+                station_id,
+                dispatch_id,
+                previous.dispatch_id,
+            )
+            self._stats["replaced"] += 1
+
+        self._stations[station_id] = StationFlow(
+            station_id,
+            dispatch_id,
+            float(max_liters) if isinstance(max_liters, (int, float, Decimal)) else None,
+        )
+        self._stats["tracked"] += 1
+
+    def untrack(self, dispatch_id: int) -> None:
+        """
+        El despacho se cerró por otro lado (ej: Node-RED informó los litros).
+        """
+        for station_id, flow in list(self._stations.items()):
+            if flow.dispatch_id == dispatch_id:
+                del self._stations[station_id]
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        return [flow.snapshot() for flow in self._stations.values()]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "supervising": len(self._stations),
+            "unsettleable": len(self._unsettleable),
+            **self._stats,
+        }
+
+    async def _run(self) -> None:
+        last_sweep = time.monotonic()
+
+        while True:
+            await asyncio.sleep(REACTION_S)
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("flow: falló un tick del supervisor")
+
+            if not prepaid_enabled() or time.monotonic() - last_sweep < SETTLE_SWEEP_S:
+                continue
+            last_sweep = time.monotonic()
+            try:
+                await self.settle_overdue()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("flow: falló el cobro de despachos cortados")
+
+    async def _tick(self) -> None:
+        now = time.monotonic()
+
+        for flow in list(self._stations.values()):
+            if flow.state != "closing":
+                reason = flow.tick(telemetry_ingestor.latest(flow.dispatch_id), now)
+                if reason is None:
+                    continue
+                flow.state = "closing"
+                flow.close_reason = reason
+
+            # si falla la DB, se reintenta en el próximo tick
+            try:
+                await self._close(flow)
+            except Exception:
+                logger.exception("flow: no se pudo cerrar el despacho %s", flow.dispatch_id)
+                self._stats["close_errors"] += 1
+                continue
+
+            if self._stations.get(flow.station_id) is flow:
+                del self._stations[flow.station_id]
+
+    async def _close(self, flow: StationFlow) -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.water_dispatch
+                    SET
+                        closed_at = now(),
+                        close_reason = %s,
+                        liters = COALESCE(%s, liters)
+                    WHERE id = %s
+                      AND closed_at IS NULL
+                    RETURNING company_id
+                    """,
+                    (flow.close_reason, flow.liters, flow.dispatch_id),
+                )
+                row = await cur.fetchone()
+
+                # ya lo había cerrado otro (ej: Node-RED informó los litros)
+                if row is None:
+                    return
+
+                await node_red_outbox.enqueue(
+                    cur,
+                    "dispatch_stop",
+                    {
+                        "dispatch_id": flow.dispatch_id,
+                        "station_id": flow.station_id,
+                        "reason": flow.close_reason,
+                        "liters": flow.liters,
+                        "flow_lps": flow.flow_lps,
+                    },
+                )
+
+        node_red_outbox.wake()
+        logger.warning(
+            "flow: despacho %s (estación %s) cortado por %s",
+            flow.dispatch_id,
+            flow.station_id,
+            flow.close_reason,
+        )
+        self._stats[f"closed_{flow.close_reason}"] += 1
+
+
+    async def settle_overdue(self) -> None:
+        """
+        Cobra los despachos prepago cortados hace más de
+        FLOW_SETTLE_GRACE_S por los que Node-RED no informó litros.
+
+        Los litros son los que guardó el corte (última telemetría); sin
+        litros no hay con qué cobrar y el despacho espera a /liters.
+        settle_dispatches vuelve a mirar billing_status con la fila
+        bloqueada, así que un /liters que llega al mismo tiempo gana
+        y este cobro no se repite.
+        """
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, liters
+                    FROM public.water_dispatch
+                    WHERE billing_status = 'active'
+                      AND closed_at < now() - make_interval(secs => %s)
+                      AND liters IS NOT NULL
+                      AND id <> ALL(%s::bigint[])
+                    ORDER BY id
+                    LIMIT 100
+                    """,
+                    (FLOW_SETTLE_GRACE_S, list(self._unsettleable)),
+                )
+                rows = await cur.fetchall()
+
+                if not rows:
+                    return
+
+                results = await settle_dispatches(
+                    cur,
+                    [(int(dispatch_id), Decimal(liters)) for dispatch_id, liters in rows],
+                )
+
+        for dispatch_id, result in results.items():
+            if result["ok"]:
+                active_dispatches.discard(dispatch_id)
+                self._stats["settled_overdue"] += 1
+                continue
+
+            self._unsettleable.add(dispatch_id)
+            self._stats["settle_errors"] += 1
+            logger.error(
+                "flow: no se pudo cobrar el despacho cortado %s: %s",
+                dispatch_id,
+                result["error"],
+            )
+
+
+flow_supervisor = FlowSupervisor()
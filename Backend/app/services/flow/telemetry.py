@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Optional
+
+from app.db import pool
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ENV =====
+# Cada cuánto se vuelcan los últimos liters/flow_l_min a water_dispatch
+TELEMETRY_FLUSH_S = float(os.getenv("TELEMETRY_FLUSH_S", "2"))
+
+# Despachos sin muestras nuevas por este tiempo se olvidan
+TELEMETRY_IDLE_S = float(os.getenv("TELEMETRY_IDLE_S", "3600"))
+
+# Pulsos del caudalímetro por litro (0 = las muestras tienen que traer liters)
+FLOW_PULSES_PER_LITER = float(os.getenv("FLOW_PULSES_PER_LITER", "0"))
+
+
+# Cada muestra: (dispatch_id, ts, liters, flow_l_min, pulses)
+FlowSample = tuple[int, datetime, Optional[float], Optional[float], Optional[int]]
+
+
+def sample_liters(liters: Optional[float], pulses: Optional[int]) -> Optional[float]:
+    """
+    Litros acumulados de una muestra; si sólo trae pulsos, se convierten.
+    """
+    if liters is not None:
+        return liters
+    if pulses is not None and FLOW_PULSES_PER_LITER > 0:
+        return pulses / FLOW_PULSES_PER_LITER
+    return None
+
+
+class TelemetryIngestor:
+    """
+    Recibe lotes de muestras del caudalímetro (de varios despachos).
+
+    Cada lote se guarda completo en public.water_flow_sample con un COPY.
+    De cada despacho sólo se recuerda la última lectura, y un loop vuelca
+    las que cambiaron a water_dispatch (liters, flow_l_min) cada
+    TELEMETRY_FLUSH_S con un único UPDATE para todos: la carga sobre
+    water_dispatch queda acotada sin importar cuántas muestras mande Node-RED.
+    """
+
+    def __init__(self) -> None:
+        self._latest: dict[int, dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stats: Counter = Counter()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # lo último que quedó sin volcar
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("telemetry: falló el volcado final")
+
+    async def ingest(self, samples: list[FlowSample]) -> int:
+        """
+        Guarda el lote y actualiza la última lectura de cada despacho.
+        """
+        if not samples:
+            return 0
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(
+                    """
+                    COPY public.water_flow_sample
+                        (dispatch_id, ts, liters, flow_l_min, pulses)
+                    FROM STDIN
+                    """
+                ) as copy:
+                    for sample in samples:
+                        await copy.write_row(sample)
+
+        for dispatch_id, ts, liters, flow_l_min, pulses in sorted(samples, key=lambda s: s[1]):
+            self._observe(dispatch_id, ts, sample_liters(liters, pulses), flow_l_min)
+
+        self._stats["batches"] += 1
+        self._stats["samples"] += len(samples)
+        return len(samples)
+
+    def latest(self, dispatch_id: int) -> Optional[dict[str, Any]]:
+        return self._latest.get(dispatch_id)
+
+    async def flush(self) -> int:
+        """
+        Vuelca a water_dispatch la última lectura de cada despacho
+        que cambió desde el volcado anterior.
+        """
+        ids = [i for i, entry in self._latest.items() if entry["dirty"]]
+        if not ids:
+            self._evict_idle()
+            return 0
+
+        values = [(self._latest[i]["liters"], self._latest[i]["flow_l_min"]) for i in ids]
+        for i in ids:
+            self._latest[i]["dirty"] = False
+
+        try:
+            async with pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    # los despachos cerrados o ya cobrados no se tocan: sus
+                    # litros son los que informó Node-RED o los que se
+                    # usaron para debitar (una muestra atrasada no los pisa)
+                    await cur.execute(
+                        """
+                        UPDATE public.water_dispatch wd
+                        SET
+                            liters = COALESCE(v.liters, wd.liters),
+                            flow_l_min = COALESCE(v.flow_l_min, wd.flow_l_min)
+                        FROM unnest(%s::bigint[], %s::numeric[], %s::numeric[])
+                            AS v(id, liters, flow_l_min)
+                        WHERE wd.id = v.id
+                          AND wd.closed_at IS NULL
+                          AND wd.billing_status IS DISTINCT FROM 'completed'
+                        """,
+                        (
+                            ids,
+                            [v[0] for v in values],
+                            [v[1] for v in values],
+                        ),
+                    )
+        except BaseException:
+            for i in ids:
+                if i in self._latest:
+                    self._latest[i]["dirty"] = True
+            raise
+
+        self._stats["flushes"] += 1
+        self._stats["dispatch_updates"] += len(ids)
+        self._evict_idle()
+        return len(ids)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            **self._stats,
+            "tracked_dispatches": len(self._latest),
+            "pending_dispatches": sum(1 for e in self._latest.values() if e["dirty"]),
+        }
+
+    def _observe(
+        self,
+        dispatch_id: int,
+        ts: datetime,
+        liters: Optional[float],
+        flow_l_min: Optional[float],
+    ) -> None:
+        if liters is None and flow_l_min is None:
+            return
+
+        entry = self._latest.get(dispatch_id)
+
+        if entry is None:
+            entry = self._latest[dispatch_id] = {"ts": ts, "liters": None, "flow_l_min": None}
+
+        # muestras viejas (reintentos de Node-RED) no pisan lecturas nuevas;
+        # por eso la entrada se conserva después de volcarla
+        elif ts < entry["ts"]:
+            return
+
+        entry["ts"] = ts
+        if liters is not None:
+            entry["liters"] = liters
+        if flow_l_min is not None:
+            entry["flow_l_min"] = flow_l_min
+        entry["dirty"] = True
+        entry["seen"] = time.monotonic()
+
+    def _evict_idle(self) -> None:
+        limit = time.monotonic() - TELEMETRY_IDLE_S
+        for dispatch_id in [i for i, e in self._latest.items() if not e["dirty"] and e["seen"] < limit]:
+            del self._latest[dispatch_id]
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(TELEMETRY_FLUSH_S)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("telemetry: falló el volcado a water_dispatch")
+                self._stats["flush_errors"] += 1
+
+
+telemetry_ingestor = TelemetryIngestor()
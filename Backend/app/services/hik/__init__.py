@@ -0,0 +1,36 @@
+from app.services.hik.dedupe import (
+    EventDeduplicator,
+    dedupe_key,
+    event_deduplicator,
+)
+from app.services.hik.parser import (
+    count_event,
+    drop_reason,
+    peek_event_head,
+    prefilter_stats,
+    read_event_payload,
+)
+from app.services.hik.raw import compact_raw
+from app.services.hik.stations import (
+    DEVICE_KINDS,
+    StationMap,
+    normalize_device_value,
+    station_map,
+)
+
+
+__all__ = [
+    "EventDeduplicator",
+    "dedupe_key",
+    "event_deduplicator",
+    "count_event",
+    "drop_reason",
+    "peek_event_head",
+    "prefilter_stats",
+    "read_event_payload",
+    "compact_raw",
+    "DEVICE_KINDS",
+    "StationMap",
+    "normalize_device_value",
+    "station_map",
+]
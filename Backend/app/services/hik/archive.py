@@ -0,0 +1,79 @@
+"""
+Mueve a public.access_event_raw_archive (comprimido con zlib) el raw
+de los eventos Hik viejos y deja access_event.raw en NULL.
+
+Uso por consola (por ejemplo desde un cron):
+    python -m app.services.hik.archive --days 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import zlib
+
+from app.db import close_pool, open_pool, pool
+
+
+async def archive_raw_payloads(older_than_days: int, batch_size: int = 500) -> int:
+    """
+    Comprime y mueve a access_event_raw_archive el raw de los eventos
+    con más de older_than_days días, por lotes. Devuelve cuántos movió.
+    """
+    moved = 0
+
+    while True:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, ts, raw
+                    FROM public.access_event
+                    WHERE ts < now() - make_interval(days => %s)
+                      AND raw IS NOT NULL
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (older_than_days, batch_size),
+                )
+                rows = await cur.fetchall()
+
+                if not rows:
+                    return moved
+
+                async with cur.copy(
+                    "COPY public.access_event_raw_archive (event_id, ts, raw_z) FROM STDIN"
+                ) as copy:
+                    for event_id, ts, raw in rows:
+                        data = json.dumps(raw, separators=(",", ":")).encode("utf-8")
+                        await copy.write_row((event_id, ts, zlib.compress(data, 9)))
+
+                await cur.execute(
+                    """
+                    UPDATE public.access_event
+                    SET raw = NULL
+                    WHERE id = ANY(%s)
+                    """,
+                    ([r[0] for r in rows],),
+                )
+
+        moved += len(rows)
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Archiva access_event.raw viejos")
+    parser.add_argument("--days", type=int, default=int(os.getenv("HIK_RAW_ARCHIVE_DAYS", "30")))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    await open_pool()
+    try:
+        moved = await archive_raw_payloads(args.days, args.batch_size)
+    finally:
+        await close_pool()
+
+    print(f"archivados: {moved}")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Optional
+
+
+HIK_DEDUPE_TTL_S = float(os.getenv("HIK_DEDUPE_TTL_S", "600"))
+HIK_DEDUPE_MAX_KEYS = int(os.getenv("HIK_DEDUPE_MAX_KEYS", "50000"))
+
+
+def dedupe_key(head: dict[str, Any], payload: bytes, source_ip: Optional[str]) -> str:
+    """
+    Clave del evento: dispositivo + serialNo si el payload los trae;
+    si no, hash del payload (los reintentos de Hik son byte a byte iguales).
+    """
+    device = head.get("device") or source_ip
+    serial_no = head.get("serial_no")
+
+    if device and serial_no:
+        return f"sn:{device}:{serial_no}"
+
+    return "sha1:" + hashlib.sha1(payload).hexdigest()
+
+
+class EventDeduplicator:
+    """
+    Conjunto TTL en memoria (FIFO acotado) de eventos ya recibidos.
+
+    Cada clave guarda un future con la respuesta original: un reintento
+    que llega mientras el original se procesa espera ese mismo resultado,
+    y uno que llega después lo recibe al instante, sin tocar el pool.
+    El índice único access_event(dedupe_key) cubre reinicios y desalojos.
+    """
+
+    def __init__(self, *, ttl_s: float, max_keys: int) -> None:
+        self.ttl_s = ttl_s
+        self.max_keys = max(1, max_keys)
+        self._entries: "OrderedDict[str, tuple[float, asyncio.Future]]" = OrderedDict()
+        self._stats: Counter = Counter()
+
+    def claim(self, key: str) -> tuple[asyncio.Future, bool]:
+        """
+        Devuelve (future, es_nuevo). Si es_nuevo, el llamador debe
+        completar el future con resolve() o release().
+        """
+        now = time.monotonic()
+        self._expire(now)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._stats["duplicates"] += 1
+            return entry[1], False
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now, future)
+        self._stats["unique"] += 1
+
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+        return future, True
+
+    def resolve(self, future: asyncio.Future, result: dict[str, Any]) -> None:
+        if not future.done():
+            future.set_result(result)
+
+    def release(self, key: str, future: asyncio.Future) -> None:
+        """
+        El original falló: se olvida la clave para que el próximo
+        reintento se procese de nuevo, y los que esperaban reciben None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is future:
+            del self._entries[key]
+        if not future.done():
+            future.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            **self._stats,
+        }
+
+    def _expire(self, now: float) -> None:
+        # las claves están en orden de llegada: se corta en la primera vigente
+        while self._entries:
+            key, (seen_at, future) = next(iter(self._entries.items()))
+            if now - seen_at < self.ttl_s or not future.done():
+                break
+            del self._entries[key]
+
+
+event_deduplicator = EventDeduplicator(
+    ttl_s=HIK_DEDUPE_TTL_S,
+    max_keys=HIK_DEDUPE_MAX_KEYS,
+)
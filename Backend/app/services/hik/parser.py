@@ -0,0 +1,242 @@
+import os
+import re
+from collections import Counter
+from typing import Any, AsyncIterator, Optional
+
+
+# Tipos de evento que sí interesan (el resto se descarta antes de parsear).
+# Si el payload no trae eventType se deja pasar, como hacía /webhook.
+HIK_ACCEPTED_EVENT_TYPES = {
+    value.strip().lower()
+    for value in os.getenv(
+        "HIK_ACCEPTED_EVENT_TYPES",
+        "AccessControllerEvent,AcsEvent,AccessControl",
+    ).split(",")
+    if value.strip()
+}
+
+# Códigos major/minor de AcsEvent aceptados. Vacío = todos.
+HIK_ACCEPTED_MAJOR = {
+    int(value)
+    for value in os.getenv("HIK_ACCEPTED_MAJOR", "5").split(",")
+    if value.strip()
+}
+HIK_ACCEPTED_MINOR = {
+    int(value)
+    for value in os.getenv("HIK_ACCEPTED_MINOR", "").split(",")
+    if value.strip()
+}
+
+# Tope para la parte de evento de un multipart (la foto no cuenta).
+MAX_EVENT_PART_BYTES = 256 * 1024
+MAX_PART_HEADERS_BYTES = 16 * 1024
+
+
+_XML_EVENT_TYPE = re.compile(rb"<eventType>\s*([^<]*?)\s*</eventType>")
+_XML_MAJOR = re.compile(rb"<(?:majorEventType|major)>\s*(\d+)")
+_XML_MINOR = re.compile(rb"<(?:subEventType|minor)>\s*(\d+)")
+
+_JSON_EVENT_TYPE = re.compile(rb'"eventType"\s*:\s*"([^"]*)"')
+_JSON_MAJOR = re.compile(rb'"(?:majorEventType|major)"\s*:\s*"?(\d+)')
+_JSON_MINOR = re.compile(rb'"(?:subEventType|minor)"\s*:\s*"?(\d+)')
+
+
+_XML_SERIAL_NO = re.compile(rb"<serialNo>\s*(\d+)")
+_XML_DEVICE = re.compile(rb"<(?:deviceID|deviceSerial|macAddress|ipAddress)>\s*([^<]+?)\s*<")
+
+_JSON_SERIAL_NO = re.compile(rb'"serialNo"\s*:\s*"?(\d+)')
+_JSON_DEVICE = re.compile(rb'"(?:deviceID|deviceSerial|macAddress|ipAddress)"\s*:\s*"([^"]+)"')
+
+
+_stats: Counter = Counter()
+
+
+def _multipart_boundary(content_type: str) -> Optional[bytes]:
+    """
+    Devuelve el boundary de un Content-Type multipart/* (mixed o form-data).
+    """
+    if not content_type.lower().startswith("multipart/"):
+        return None
+
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.strip().lower() == "boundary" and value:
+            return value.strip().strip('"').encode("latin-1")
+
+    return None
+
+
+class _MultipartEventReader:
+    """
+    Lee un multipart por chunks y se queda sólo con la parte del evento
+    (JSON/XML). Las partes de imagen se descartan a medida que llegan,
+    sin acumularlas en memoria.
+    """
+
+    def __init__(self, boundary: bytes) -> None:
+        self._delimiter = b"--" + boundary
+        self._buffer = bytearray()
+        self._state = "preamble"
+        self._part_content_type = ""
+
+    def feed(self, chunk: bytes) -> Optional[tuple[bytes, str]]:
+        self._buffer += chunk
+        delimiter = self._delimiter
+
+        while True:
+            if self._state == "preamble":
+                index = self._buffer.find(delimiter)
+                if index < 0:
+                    del self._buffer[: -len(delimiter)]
+                    return None
+                del self._buffer[: index + len(delimiter)]
+                self._state = "headers"
+
+            elif self._state == "headers":
+                if self._buffer.startswith(b"--"):
+                    # delimitador de cierre: no hubo parte de evento
+                    self._state = "done"
+                    return None
+
+                index = self._buffer.find(b"\r\n\r\n")
+                if index < 0:
+                    if len(self._buffer) > MAX_PART_HEADERS_BYTES:
+                        raise ValueError("multipart part headers too large")
+                    return None
+
+                headers = bytes(self._buffer[:index]).decode("latin-1").lower()
+                del self._buffer[: index + 4]
+
+                self._part_content_type = ""
+                for line in headers.split("\r\n"):
+                    name, _, value = line.partition(":")
+                    if name.strip() == "content-type":
+                        self._part_content_type = value.strip()
+
+                is_event = "json" in self._part_content_type or "xml" in self._part_content_type
+                if not self._part_content_type:
+                    is_event = "pic" not in headers and "image" not in headers
+
+                self._state = "keep" if is_event else "skip"
+
+            elif self._state in ("keep", "skip"):
+                index = self._buffer.find(b"\r\n" + delimiter)
+                if index < 0:
+                    if self._state == "skip":
+                        # guardamos sólo la cola por si el delimitador quedó partido
+                        del self._buffer[: -(len(delimiter) + 2)]
+                    elif len(self._buffer) > MAX_EVENT_PART_BYTES:
+                        raise ValueError("multipart event part too large")
+                    return None
+
+                if self._state == "keep":
+                    payload = bytes(self._buffer[:index])
+                    self._buffer.clear()
+                    self._state = "done"
+                    return payload, self._part_content_type
+
+                del self._buffer[: index + 2 + len(delimiter)]
+                self._state = "headers"
+
+            else:
+                self._buffer.clear()
+                return None
+
+
+async def read_event_payload(
+    content_type: str,
+    stream: AsyncIterator[bytes],
+) -> tuple[bytes, str]:
+    """
+    Devuelve (payload, content_type) del evento Hik.
+
+    En multipart/mixed (evento + foto) devuelve sólo la parte JSON/XML;
+    el resto del stream se drena sin guardarlo.
+    """
+    boundary = _multipart_boundary(content_type)
+
+    if boundary is None:
+        body = bytearray()
+        async for chunk in stream:
+            body += chunk
+        return bytes(body), content_type.lower()
+
+    reader = _MultipartEventReader(boundary)
+    found: Optional[tuple[bytes, str]] = None
+
+    async for chunk in stream:
+        if found is None:
+            found = reader.feed(chunk)
+
+    if found is None:
+        return b"", ""
+
+    return found
+
+
+def _search(pattern: re.Pattern, payload: bytes) -> Optional[bytes]:
+    match = pattern.search(payload)
+    return match.group(1) if match else None
+
+
+def peek_event_head(payload: bytes) -> dict[str, Any]:
+    """
+    Lee sólo eventType, los códigos major/minor de AcsEvent y los
+    identificadores para deduplicar (dispositivo + serialNo),
+    sin construir el dict completo del payload.
+    """
+    is_xml = payload.lstrip()[:1] == b"<"
+
+    if is_xml:
+        event_type = _search(_XML_EVENT_TYPE, payload)
+        major = _search(_XML_MAJOR, payload)
+        minor = _search(_XML_MINOR, payload)
+        serial_no = _search(_XML_SERIAL_NO, payload)
+        device = _search(_XML_DEVICE, payload)
+    else:
+        event_type = _search(_JSON_EVENT_TYPE, payload)
+        major = _search(_JSON_MAJOR, payload)
+        minor = _search(_JSON_MINOR, payload)
+        serial_no = _search(_JSON_SERIAL_NO, payload)
+        device = _search(_JSON_DEVICE, payload)
+
+    return {
+        "format": "xml" if is_xml else "json",
+        "event_type": event_type.decode("utf-8", "replace") if event_type else None,
+        "major": int(major) if major else None,
+        "minor": int(minor) if minor else None,
+        "serial_no": serial_no.decode("ascii") if serial_no else None,
+        "device": device.decode("utf-8", "replace") if device else None,
+    }
+
+
+def drop_reason(head: dict[str, Any]) -> Optional[str]:
+    """
+    Devuelve el motivo por el cual el evento no nos interesa,
+    o None si hay que procesarlo.
+    """
+    event_type = head.get("event_type")
+    if event_type and event_type.lower() not in HIK_ACCEPTED_EVENT_TYPES:
+        return f"event_type:{event_type[:64]}"
+
+    major = head.get("major")
+    if major is not None and HIK_ACCEPTED_MAJOR and major not in HIK_ACCEPTED_MAJOR:
+        return f"major:{major}"
+
+    minor = head.get("minor")
+    if minor is not None and HIK_ACCEPTED_MINOR and minor not in HIK_ACCEPTED_MINOR:
+        return f"minor:{minor}"
+
+    return None
+
+
+def count_event(reason: Optional[str]) -> None:
+    if reason is None:
+        _stats["accepted"] += 1
+    else:
+        _stats["dropped"] += 1
+        _stats[f"dropped.{reason}"] += 1
+
+
+def prefilter_stats() -> dict[str, int]:
+    return dict(_stats)
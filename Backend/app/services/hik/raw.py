@@ -0,0 +1,43 @@
+import os
+from typing import Any
+
+
+# Campos que algunos firmwares mandan con la foto o datos biométricos
+HEAVY_KEYS = {
+    "picdata",
+    "picturedata",
+    "picture",
+    "pictures",
+    "facedata",
+    "facepicture",
+    "visiblelightpic",
+    "thermalpic",
+    "fingerprintdata",
+}
+
+# Cualquier string más largo que esto se reemplaza por un marcador
+HIK_RAW_MAX_STRING = int(os.getenv("HIK_RAW_MAX_STRING", "1024"))
+
+
+def compact_raw(value: Any) -> Any:
+    """
+    Devuelve una copia del payload sin campos pesados ni vacíos.
+    """
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            if key.startswith("@xmlns") or key.lower() in HEAVY_KEYS:
+                continue
+            item = compact_raw(item)
+            if item is None or item == "" or item == {} or item == []:
+                continue
+            out[key] = item
+        return out
+
+    if isinstance(value, list):
+        return [compact_raw(item) for item in value]
+
+    if isinstance(value, str) and len(value) > HIK_RAW_MAX_STRING:
+        return f"<omitido: {len(value)} caracteres>"
+
+    return value
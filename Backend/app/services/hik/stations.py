@@ -0,0 +1,87 @@
+from collections import Counter
+from typing import Any, Optional
+
+from app.db import pool
+from app.notify import notify_hub
+
+
+STATION_DEVICE_CHANGED_CHANNEL = "station_device_changed"
+
+# Orden de preferencia al resolver: lo más específico primero
+DEVICE_KINDS = ("serial", "mac", "device_id", "ip")
+
+
+def normalize_device_value(kind: str, value: Any) -> str:
+    """
+    Normaliza el identificador para que coincida sin importar el formato
+    (las MAC llegan como aa:bb:.., AA-BB-.. o aabb..).
+    """
+    text = str(value or "").strip()
+
+    if kind == "mac":
+        return text.lower().replace(":", "").replace("-", "").replace(".", "")
+    if kind in ("serial", "device_id"):
+        return text.upper()
+    return text
+
+
+class StationMap:
+    """
+    Mapa en memoria (kind, value) -> station_id, cargado desde
+    public.station_device en el lifespan y recargado completo
+    con cada NOTIFY station_device_changed (la tabla es chica).
+    """
+
+    def __init__(self) -> None:
+        self._map: dict[tuple[str, str], str] = {}
+        self._stats: Counter = Counter()
+
+    async def load(self, _payload: str = "") -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT kind, value, station_id
+                    FROM public.station_device
+                    """
+                )
+                rows = await cur.fetchall()
+
+        self._map = {
+            (r[0], normalize_device_value(r[0], r[1])): r[2]
+            for r in rows
+        }
+        self._stats["reloads"] += 1
+
+    def resolve(self, identifiers: dict[str, Any]) -> Optional[str]:
+        """
+        identifiers: {"serial": .., "mac": .., "device_id": .., "ip": ..}
+        Cada valor puede ser un string o una lista de candidatos.
+        """
+        for kind in DEVICE_KINDS:
+            values = identifiers.get(kind)
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+
+            for value in values:
+                if not value:
+                    continue
+                station_id = self._map.get((kind, normalize_device_value(kind, value)))
+                if station_id:
+                    self._stats["hits"] += 1
+                    return station_id
+
+        self._stats["misses"] += 1
+        return None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self._map),
+            **self._stats,
+        }
+
+
+station_map = StationMap()
+
+notify_hub.subscribe(STATION_DEVICE_CHANGED_CHANNEL, station_map.load)
+notify_hub.on_reconnect(station_map.load)
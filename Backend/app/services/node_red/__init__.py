@@ -0,0 +1,10 @@
+from app.services.node_red.outbox import (
+    NodeRedOutbox,
+    node_red_outbox,
+)
+
+
+__all__ = [
+    "NodeRedOutbox",
+    "node_red_outbox",
+]
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from typing import Any, Optional
+
+import httpx
+from psycopg.types.json import Jsonb
+
+from app.db import pool
+
+logger = logging.getLogger(__name__)
+
+
+# Un webhook por tipo de notificación (sin seguridad por ahora)
+NODE_RED_WEBHOOKS = {
+    "dispatch_started": os.getenv("NODE_RED_DISPATCH_WEBHOOK", ""),  # ej: http://IP:1880/hik/dispatch_started
+    "dispatch_stop": os.getenv("NODE_RED_STOP_WEBHOOK", ""),  # ej: http://IP:1880/water/dispatch_stop
+}
+
+# Si está definido, las notificaciones se entregan en lote:
+# POST {"items": [{"id", "kind", "payload"}, ...]}
+NODE_RED_BATCH_WEBHOOK = os.getenv("NODE_RED_BATCH_WEBHOOK", "")
+
+OUTBOX_BATCH_SIZE = int(os.getenv("NODE_RED_OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_S = float(os.getenv("NODE_RED_OUTBOX_POLL_S", "5"))
+OUTBOX_TIMEOUT_S = float(os.getenv("NODE_RED_OUTBOX_TIMEOUT_S", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("NODE_RED_OUTBOX_MAX_ATTEMPTS", "20"))
+OUTBOX_MAX_BACKOFF_S = float(os.getenv("NODE_RED_OUTBOX_MAX_BACKOFF_S", "300"))
+
+# Mientras se entrega, la fila queda "alquilada" este tiempo
+# para que otro ciclo no la tome de nuevo.
+OUTBOX_LEASE_S = 60
+
+
+class NodeRedOutbox:
+    """
+    Entrega en segundo plano las filas de public.node_red_outbox.
+
+    Usa un único httpx.AsyncClient con keep-alive durante toda la vida
+    del proceso. Las fallas se reintentan con backoff exponencial hasta
+    NODE_RED_OUTBOX_MAX_ATTEMPTS; después la fila queda marcada como
+    given_up para revisión manual.
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._stats: Counter = Counter()
+
+    def enabled(self, kind: str) -> bool:
+        return bool(NODE_RED_BATCH_WEBHOOK or NODE_RED_WEBHOOKS.get(kind))
+
+    async def enqueue(self, cursor: Any, kind: str, payload: dict[str, Any]) -> None:
+        """
+        Inserta la notificación usando el cursor (y la transacción) del llamador.
+        """
+        if not self.enabled(kind):
+            return
+
+        await cursor.execute(
+            """
+            INSERT INTO public.node_red_outbox (kind, payload)
+            VALUES (%s, %s)
+            """,
+            (kind, Jsonb(payload)),
+        )
+
+    def wake(self) -> None:
+        """
+        Avisa que hay filas nuevas (después del commit) para no esperar el poll.
+        """
+        self._wake.set()
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+
+        self._client = httpx.AsyncClient(
+            timeout=OUTBOX_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict[str, int]:
+        return dict(self._stats)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await self._deliver_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("node_red_outbox: falló un ciclo de entrega")
+                claimed = 0
+
+            # si el lote vino lleno, seguimos sin esperar
+            if claimed >= OUTBOX_BATCH_SIZE:
+                continue
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_S)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _deliver_once(self) -> int:
+        rows = await self._claim()
+        if not rows:
+            return 0
+
+        if NODE_RED_BATCH_WEBHOOK:
+            error = await self._post(
+                NODE_RED_BATCH_WEBHOOK,
+                {
+                    "items": [
+                        {"id": r["id"], "kind": r["kind"], "payload": r["payload"]}
+                        for r in rows
+                    ]
+                },
+            )
+            results = [(r, error) for r in rows]
+        else:
+            errors = await asyncio.gather(
+                *(self._post(NODE_RED_WEBHOOKS.get(r["kind"], ""), r["payload"]) for r in rows)
+            )
+            results = list(zip(rows, errors))
+
+        await self._settle(results)
+        return len(rows)
+
+    async def _post(self, url: str, body: dict[str, Any]) -> Optional[str]:
+        if not url:
+            return "no webhook configured"
+
+        try:
+            r = await self._client.post(url, json=body)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+        if r.status_code >= 300:
+            return f"HTTP {r.status_code}: {r.text[:200]}"
+        return None
+
+    async def _claim(self) -> list[dict[str, Any]]:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.node_red_outbox
+                    SET
+                        attempts = attempts + 1,
+                        next_attempt_at = now() + make_interval(secs => %s)
+                    WHERE id IN (
+                        SELECT id
+                        FROM public.node_red_outbox
+                        WHERE delivered_at IS NULL
+                          AND given_up_at IS NULL
+                          AND next_attempt_at <= now()
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, kind, payload, attempts
+                    """,
+                    (OUTBOX_LEASE_S, OUTBOX_BATCH_SIZE),
+                )
+                rows = await cur.fetchall()
+
+        return sorted(
+            (
+                {"id": int(r[0]), "kind": r[1], "payload": r[2], "attempts": int(r[3])}
+                for r in rows
+            ),
+            key=lambda r: r["id"],
+        )
+
+    async def _settle(self, results: list[tuple[dict[str, Any], Optional[str]]]) -> None:
+        delivered = [r["id"] for r, error in results if error is None]
+        failed = []
+
+        for r, error in results:
+            if error is None:
+                continue
+            give_up = r["attempts"] >= OUTBOX_MAX_ATTEMPTS
+            backoff = min(OUTBOX_MAX_BACKOFF_S, 2 ** r["attempts"])
+            failed.append((backoff, error, give_up, r["id"]))
+            self._stats["given_up" if give_up else "retried"] += 1
+
+        self._stats["delivered"] += len(delivered)
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                if delivered:
+                    await cur.execute(
+                        """
+                        UPDATE public.node_red_outbox
+                        SET delivered_at = now(),
+                            last_error = NULL
+                        WHERE id = ANY(%s)
+                        """,
+                        (delivered,),
+                    )
+
+                if failed:
+                    await cur.executemany(
+                        """
+                        UPDATE public.node_red_outbox
+                        SET next_attempt_at = now() + make_interval(secs => %s),
+                            last_error = %s,
+                            given_up_at = CASE WHEN %s THEN now() END
+                        WHERE id = %s
+                        """,
+                        failed,
+                    )
+
+
+node_red_outbox = NodeRedOutbox()
@@ -0,0 +1,50 @@
+import base64
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import HTTPException
+
+
+def parse_dt(s: Optional[str]) -> Optional[datetime]:
+    """
+    Acepta ISO8601 (con o sin Z). Si es naive, la asume UTC.
+    """
+    if not s:
+        return None
+    ss = s.strip()
+    if not ss:
+        return None
+    # soportar "Z"
+    if ss.endswith("Z"):
+        ss = ss[:-1] + "+00:00"
+    dt = datetime.fromisoformat(ss)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def parse_dt_param(value: Optional[str], name: str) -> Optional[datetime]:
+    """
+    parse_dt para query params: una fecha mal formada es un 400, no un 500.
+    """
+    try:
+        return parse_dt(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"invalid {name}: expected ISO8601")
+
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    """
+    Cursor opaco (ts, id) para paginación keyset.
+    """
+    raw = f"{ts.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        ts, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
@@ -1,8 +1,22 @@
+from app.services.prepaid.active import (
+    ActiveDispatchRegistry,
+    active_dispatches,
+)
+
+from app.services.prepaid.config import (
+    BillingConfigCache,
+    billing_config,
+)
+
 from app.services.prepaid.billing import (
+    authorization_error,
     authorize_company,
     insert_dispatch,
     prepaid_enabled,
     settle_dispatch,
+    settle_dispatches,
+    settlement_error,
+    start_prepaid_dispatch,
 )
 
 from app.services.prepaid.pricing import (
@@ -10,12 +24,27 @@ from app.services.prepaid.pricing import (
     calculate_max_affordable_liters,
 )
 
+from app.services.prepaid.wallet_cache import (
+    WalletBalanceCache,
+    wallet_balances,
+)
+
 
 __all__ = [
+    "ActiveDispatchRegistry",
+    "active_dispatches",
+    "BillingConfigCache",
+    "billing_config",
+    "authorization_error",
     "authorize_company",
     "insert_dispatch",
     "prepaid_enabled",
     "settle_dispatch",
+    "settle_dispatches",
+    "settlement_error",
+    "start_prepaid_dispatch",
     "calculate_dispatch_amount",
     "calculate_max_affordable_liters",
+    "WalletBalanceCache",
+    "wallet_balances",
 ]
\ No newline at end of file
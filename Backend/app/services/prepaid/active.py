@@ -0,0 +1,108 @@
+import json
+import logging
+from collections import Counter
+from typing import Any, Optional
+
+from app.db import pool
+from app.notify import notify_hub
+
+logger = logging.getLogger(__name__)
+
+
+DISPATCH_CHANGED_CHANNEL = "water_dispatch_changed"
+
+
+class ActiveDispatchRegistry:
+    """
+    Registro en memoria de la carga prepaga activa de cada empresa
+    (water_dispatch con billing_status = 'active').
+
+    Se carga en el lifespan, las rutas lo actualizan después del commit
+    de cada alta o cobro, y el NOTIFY water_dispatch_changed trae los
+    cambios hechos por otros procesos. Así authorize responde "ya tiene
+    una carga activa" sin ir a la DB.
+
+    No es la garantía: si dos estaciones pasan el chequeo a la vez, el
+    índice único parcial water_dispatch_one_active_per_company
+    (migración 013) rechaza la segunda.
+    """
+
+    def __init__(self) -> None:
+        self._by_company: dict[int, int] = {}
+        self._by_dispatch: dict[int, int] = {}
+        self._ready = False
+        self._stats: Counter = Counter()
+
+    def ready(self) -> bool:
+        return self._ready
+
+    async def load(self) -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT company_id, id
+                    FROM public.water_dispatch
+                    WHERE billing_status = 'active'
+                    """
+                )
+                rows = await cur.fetchall()
+
+        self._by_company = {}
+        self._by_dispatch = {}
+        for company_id, dispatch_id in rows:
+            self.add(int(company_id), int(dispatch_id))
+
+        self._ready = True
+        self._stats["reloads"] += 1
+
+    def get(self, company_id: int) -> Optional[int]:
+        """
+        Id de la carga activa de la empresa, o None.
+        """
+        dispatch_id = self._by_company.get(company_id)
+        self._stats["hits" if dispatch_id is not None else "misses"] += 1
+        return dispatch_id
+
+    def add(self, company_id: int, dispatch_id: int) -> None:
+        previous = self._by_company.get(company_id)
+        if previous is not None and previous != dispatch_id:
+            self._by_dispatch.pop(previous, None)
+
+        self._by_company[company_id] = dispatch_id
+        self._by_dispatch[dispatch_id] = company_id
+
+    def discard(self, dispatch_id: int) -> None:
+        company_id = self._by_dispatch.pop(dispatch_id, None)
+        if company_id is not None and self._by_company.get(company_id) == dispatch_id:
+            del self._by_company[company_id]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "ready": self._ready,
+            "active": len(self._by_company),
+            **self._stats,
+        }
+
+    async def on_notify(self, payload: str) -> None:
+        try:
+            data = json.loads(payload)
+            dispatch_id = int(data["id"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("active_dispatches: payload inválido: %r", payload[:200])
+            return
+
+        company_id = data.get("company_id")
+
+        if data.get("billing_status") == "active" and company_id is not None:
+            self.add(int(company_id), dispatch_id)
+        else:
+            self.discard(dispatch_id)
+
+        self._stats["notifies"] += 1
+
+
+active_dispatches = ActiveDispatchRegistry()
+
+notify_hub.subscribe(DISPATCH_CHANGED_CHANNEL, active_dispatches.on_notify)
+notify_hub.on_reconnect(active_dispatches.load)
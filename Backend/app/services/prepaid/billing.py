@@ -4,10 +4,13 @@ from typing import Any
 
 from fastapi import HTTPException
 
+from app.services.prepaid.active import active_dispatches
+from app.services.prepaid.config import billing_config
 from app.services.prepaid.pricing import (
     calculate_dispatch_amount,
     calculate_max_affordable_liters,
 )
+from app.services.prepaid.wallet_cache import wallet_balances
 
 
 def prepaid_enabled() -> bool:
@@ -28,6 +31,46 @@ def prepaid_enabled() -> bool:
     }
 
 
+# Códigos de public.authorize_and_start_dispatch() -> (status, mensaje)
+AUTHORIZATION_ERRORS: dict[str, tuple[int, str]] = {
+    "PREPAID_ACCOUNT_NOT_AVAILABLE": (
+        402,
+        "La empresa no posee una cuenta prepaga activa",
+    ),
+    "INSUFFICIENT_MINIMUM_BALANCE": (
+        402,
+        "Saldo insuficiente para iniciar una carga",
+    ),
+    "ACTIVE_DISPATCH_EXISTS": (
+        409,
+        "La empresa ya posee una carga activa",
+    ),
+}
+
+
+def authorization_error(
+    code: str,
+    **extra: Any,
+) -> HTTPException:
+    """
+    Arma el error de una autorización rechazada.
+    """
+
+    status_code, message = AUTHORIZATION_ERRORS.get(
+        code,
+        (500, "Resultado de autorización desconocido"),
+    )
+
+    return HTTPException(
+        status_code=status_code,
+        detail={
+            "code": code,
+            "message": message,
+            **extra,
+        },
+    )
+
+
 async def authorize_company(
     cursor: Any,
     company_code: str,
@@ -74,22 +117,22 @@ async def authorize_company(
             "prepaid": False,
         }
 
+    config = await billing_config.get()
+
+    if config is None:
+        raise authorization_error("PREPAID_ACCOUNT_NOT_AVAILABLE")
+
     await cursor.execute(
         """
         SELECT
             c.id,
             c.name,
-            cw.balance,
-            cfg.price_per_m3,
-            cfg.minimum_balance,
-            cfg.currency
+            cw.balance
         FROM public.company c
         JOIN public.company_wallet cw
           ON cw.company_id = c.id
-        CROSS JOIN public.water_billing_config cfg
         WHERE c.code = %s
           AND c.active
-          AND cfg.id = 1
         FOR UPDATE OF c, cw
         """,
         (company_code,),
@@ -98,60 +141,45 @@ async def authorize_company(
     row = await cursor.fetchone()
 
     if not row:
-        raise HTTPException(
-            status_code=402,
-            detail={
-                "code": "PREPAID_ACCOUNT_NOT_AVAILABLE",
-                "message": (
-                    "La empresa no posee una cuenta prepaga activa"
-                ),
-            },
-        )
+        raise authorization_error("PREPAID_ACCOUNT_NOT_AVAILABLE")
 
     company_id = int(row[0])
     company_name = row[1]
     balance = Decimal(row[2])
-    price_per_m3 = Decimal(row[3])
-    minimum_balance = Decimal(row[4])
-    currency = row[5]
+    price_per_m3 = config["price_per_m3"]
+    minimum_balance = config["minimum_balance"]
+    currency = config["currency"]
 
     if balance < minimum_balance:
-        raise HTTPException(
-            status_code=402,
-            detail={
-                "code": "INSUFFICIENT_MINIMUM_BALANCE",
-                "message": (
-                    "Saldo insuficiente para iniciar una carga"
-                ),
-                "balance": float(balance),
-                "minimum_balance": float(minimum_balance),
-                "currency": currency,
-            },
+        raise authorization_error(
+            "INSUFFICIENT_MINIMUM_BALANCE",
+            balance=float(balance),
+            minimum_balance=float(minimum_balance),
+            currency=currency,
         )
 
-    await cursor.execute(
-        """
-        SELECT id
-        FROM public.water_dispatch
-        WHERE company_id = %s
-          AND billing_status = 'active'
-        LIMIT 1
-        """,
-        (company_id,),
-    )
+    if active_dispatches.ready():
+        active_dispatch_id = active_dispatches.get(company_id)
+
+    else:
+        await cursor.execute(
+            """
+            SELECT id
+            FROM public.water_dispatch
+            WHERE company_id = %s
+              AND billing_status = 'active'
+            LIMIT 1
+            """,
+            (company_id,),
+        )
 
-    active_dispatch = await cursor.fetchone()
+        active_dispatch = await cursor.fetchone()
+        active_dispatch_id = int(active_dispatch[0]) if active_dispatch else None
 
-    if active_dispatch:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "ACTIVE_DISPATCH_EXISTS",
-                "message": (
-                    "La empresa ya posee una carga activa"
-                ),
-                "dispatch_id": int(active_dispatch[0]),
-            },
+    if active_dispatch_id is not None:
+        raise authorization_error(
+            "ACTIVE_DISPATCH_EXISTS",
+            dispatch_id=active_dispatch_id,
         )
 
     max_affordable_liters = (
@@ -170,6 +198,7 @@ async def authorize_company(
         "minimum_balance": minimum_balance,
         "currency": currency,
         "max_affordable_liters": max_affordable_liters,
+        "billing_config_version": config["version"],
     }
 
 
@@ -186,7 +215,7 @@ async def insert_dispatch(
     Crea un despacho de agua.
 
     Si el sistema prepago está activado, guarda una copia de:
-    - la tarifa vigente;
+    - la tarifa vigente (y su versión);
     - los litros máximos permitidos;
     - el estado activo del despacho.
     """
@@ -202,7 +231,8 @@ async def insert_dispatch(
                 note,
                 billing_status,
                 price_per_m3,
-                max_affordable_liters
+                max_affordable_liters,
+                billing_config_version
             )
             VALUES (
                 %s,
@@ -212,6 +242,7 @@ async def insert_dispatch(
                 %s,
                 'active',
                 %s,
+                %s,
                 %s
             )
             RETURNING
@@ -226,6 +257,7 @@ async def insert_dispatch(
                 note,
                 authorization["price_per_m3"],
                 authorization["max_affordable_liters"],
+                authorization["billing_config_version"],
             ),
         )
 
@@ -270,239 +302,508 @@ async def insert_dispatch(
     return row
 
 
-async def settle_dispatch(
+async def start_prepaid_dispatch(
     cursor: Any,
-    dispatch_id: int,
-    liters: Decimal,
+    *,
+    company_code: str,
+    company_id: int,
+    station_id: str,
+    photo_path: str | None,
+    photo_paths: Any,
+    photo_uploads: Any,
+    note: str | None,
 ) -> dict[str, Any]:
     """
-    Finaliza un despacho y descuenta el importe correspondiente.
+    Autoriza a la empresa y crea el despacho prepago en una sola llamada.
 
-    El despacho, la billetera y el movimiento se actualizan dentro
-    de la misma transacción de PostgreSQL.
+    Hace lo mismo que authorize_company + insert_dispatch, pero dentro
+    de public.authorize_and_start_dispatch() (migración 012): un solo
+    round trip, así la billetera queda bloqueada lo mínimo posible.
+
+    Si active_dispatches ya conoce una carga activa de la empresa,
+    se rechaza sin ir a la DB. El alta hay que registrarla en
+    active_dispatches después del commit.
+
+    La tarifa sale de billing_config (no se lee water_billing_config)
+    y el despacho guarda su versión en billing_config_version.
+
+    Si la autorización se rechaza, levanta el mismo HTTPException
+    que authorize_company.
     """
 
+    active_dispatch_id = active_dispatches.get(company_id)
+
+    if active_dispatch_id is not None:
+        raise authorization_error(
+            "ACTIVE_DISPATCH_EXISTS",
+            dispatch_id=active_dispatch_id,
+        )
+
+    config = await billing_config.get()
+
+    if config is None:
+        raise authorization_error("PREPAID_ACCOUNT_NOT_AVAILABLE")
+
     await cursor.execute(
         """
         SELECT
+            result_code,
+            dispatch_id,
+            dispatch_ts,
             company_id,
-            billing_status,
-            price_per_m3,
-            liters,
-            amount
-        FROM public.water_dispatch
-        WHERE id = %s
-        FOR UPDATE
+            company_name,
+            balance,
+            max_affordable_liters,
+            active_dispatch_id
+        FROM public.authorize_and_start_dispatch(
+            %s,
+            %s,
+            %s,
+            %s,
+            %s,
+            %s,
+            %s,
+            %s,
+            %s
+        )
         """,
-        (dispatch_id,),
+        (
+            company_code,
+            station_id,
+            photo_path,
+            photo_paths,
+            photo_uploads,
+            note,
+            config["price_per_m3"],
+            config["minimum_balance"],
+            config["version"],
+        ),
     )
 
-    dispatch = await cursor.fetchone()
+    row = await cursor.fetchone()
 
-    if not dispatch:
+    if not row:
         raise HTTPException(
-            status_code=404,
-            detail="dispatch not found",
+            status_code=500,
+            detail="No se pudo crear el despacho",
         )
 
-    company_id = dispatch[0]
-    billing_status = dispatch[1]
-    saved_price_per_m3 = dispatch[2]
-    saved_liters = dispatch[3]
-    saved_amount = dispatch[4]
+    code = row[0]
 
-    if not prepaid_enabled():
-        await cursor.execute(
-            """
-            UPDATE public.water_dispatch
-            SET liters = %s
-            WHERE id = %s
-            """,
-            (
-                liters,
-                dispatch_id,
-            ),
+    if code == "INSUFFICIENT_MINIMUM_BALANCE":
+        raise authorization_error(
+            code,
+            balance=float(row[5]),
+            minimum_balance=float(config["minimum_balance"]),
+            currency=config["currency"],
         )
 
-        return {
-            "amount": None,
-            "balance": None,
-            "billing_status": billing_status,
-        }
+    if code == "ACTIVE_DISPATCH_EXISTS":
+        # la ganó otra estación: el índice único rechazó el INSERT
+        active_dispatch_id = int(row[7]) if row[7] is not None else None
 
-    # Permite repetir exactamente la misma notificación sin
-    # volver a descontar el saldo.
-    if billing_status == "completed":
-        if (
-            saved_liters is not None
-            and Decimal(saved_liters) == liters
-        ):
-            await cursor.execute(
-                """
-                SELECT balance
-                FROM public.company_wallet
-                WHERE company_id = %s
-                """,
-                (company_id,),
-            )
+        if active_dispatch_id is not None:
+            active_dispatches.add(company_id, active_dispatch_id)
 
-            wallet = await cursor.fetchone()
-
-            return {
-                "amount": (
-                    Decimal(saved_amount)
-                    if saved_amount is not None
-                    else None
-                ),
-                "balance": (
-                    Decimal(wallet[0])
-                    if wallet
-                    else None
-                ),
-                "billing_status": "completed",
-            }
+        raise authorization_error(
+            code,
+            dispatch_id=active_dispatch_id,
+        )
 
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "COMPLETED_DISPATCH_CANNOT_CHANGE",
-                "message": (
-                    "No se pueden modificar los litros "
-                    "de un despacho ya cobrado"
-                ),
-            },
+    if code != "OK":
+        raise authorization_error(code)
+
+    return {
+        "dispatch_id": int(row[1]),
+        "ts": row[2],
+        "company_id": int(row[3]),
+        "company_name": row[4],
+        "prepaid": True,
+        "balance": Decimal(row[5]),
+        "price_per_m3": config["price_per_m3"],
+        "minimum_balance": config["minimum_balance"],
+        "currency": config["currency"],
+        "max_affordable_liters": Decimal(row[6]),
+        "billing_config_version": config["version"],
+    }
+
+
+def settlement_error(
+    code: str,
+    **extra: Any,
+) -> HTTPException:
+    """
+    Arma el error de un cobro rechazado (siempre 409).
+    """
+
+    detail: dict[str, Any] = {"code": code}
+
+    if code == "COMPLETED_DISPATCH_CANNOT_CHANGE":
+        detail["message"] = (
+            "No se pueden modificar los litros "
+            "de un despacho ya cobrado"
         )
 
-    if billing_status != "active":
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "DISPATCH_NOT_ACTIVE",
-                "message": (
-                    f"El despacho se encuentra {billing_status}"
-                ),
-            },
+    elif code == "DISPATCH_NOT_ACTIVE":
+        detail["message"] = (
+            f"El despacho se encuentra {extra.pop('billing_status')}"
         )
 
-    if saved_price_per_m3 is None:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "DISPATCH_WITHOUT_PRICE",
-                "message": (
-                    "El despacho no posee una tarifa registrada"
-                ),
-            },
+    elif code == "DISPATCH_WITHOUT_PRICE":
+        detail["message"] = (
+            "El despacho no posee una tarifa registrada"
         )
 
-    await cursor.execute(
-        """
-        SELECT balance
-        FROM public.company_wallet
-        WHERE company_id = %s
-        FOR UPDATE
-        """,
-        (company_id,),
+    elif code == "COMPANY_WALLET_NOT_FOUND":
+        detail["message"] = (
+            "No se encontró la cuenta de la empresa"
+        )
+
+    elif code == "DISPATCH_EXCEEDED_BALANCE":
+        detail["message"] = (
+            "El costo del despacho supera el saldo"
+        )
+        extra["requires_manual_review"] = True
+
+    return HTTPException(
+        status_code=409,
+        detail={
+            **detail,
+            **extra,
+        },
     )
 
-    wallet = await cursor.fetchone()
 
-    if not wallet:
+async def settle_dispatch(
+    cursor: Any,
+    dispatch_id: int,
+    liters: Decimal,
+) -> dict[str, Any]:
+    """
+    Finaliza un despacho y descuenta el importe correspondiente.
+
+    El despacho, la billetera y el movimiento se actualizan dentro
+    de la misma transacción de PostgreSQL.
+
+    Es settle_dispatches con un solo item: mismo orden de bloqueo
+    (billetera y después despacho), así un cobro suelto no se traba
+    con un lote que toque la misma empresa. Si el cobro se rechaza,
+    levanta el HTTPException correspondiente.
+    """
+
+    result = (
+        await settle_dispatches(
+            cursor,
+            [(dispatch_id, liters)],
+        )
+    )[dispatch_id]
+
+    if not result["ok"]:
         raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "COMPANY_WALLET_NOT_FOUND",
-                "message": (
-                    "No se encontró la cuenta de la empresa"
-                ),
-            },
+            status_code=result["status"],
+            detail=result["error"],
         )
 
-    balance = Decimal(wallet[0])
-    price_per_m3 = Decimal(saved_price_per_m3)
+    return {
+        "amount": result["amount"],
+        "balance": result["balance"],
+        "billing_status": result["billing_status"],
+    }
+
 
-    amount = calculate_dispatch_amount(
-        liters=liters,
-        price_per_m3=price_per_m3,
-    )
+async def settle_dispatches(
+    cursor: Any,
+    items: list[tuple[int, Decimal]],
+) -> dict[int, dict[str, Any]]:
+    """
+    Finaliza muchos despachos (de varias empresas) en la transacción
+    del cursor. items = [(dispatch_id, litros), ...] sin ids repetidos.
+
+    Hace lo mismo que settle_dispatch para cada uno, pero con una
+    cantidad fija de sentencias:
+    - bloquea las billeteras (por company_id) y después los despachos
+      (por id), siempre en el mismo orden, así dos cierres concurrentes
+      no se traban entre sí;
+    - calcula todos los importes en memoria, en orden de id, con el
+      saldo de cada empresa descontándose a medida que avanza;
+    - actualiza billeteras y despachos con un UPDATE cada uno e inserta
+      todos los wallet_movement con un solo INSERT.
+
+    Devuelve un resultado por despacho:
+      {"ok": True, "amount", "balance", "billing_status"}
+      {"ok": False, "status", "error"}  (mismo error que settle_dispatch)
+    """
 
-    if amount > balance:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "code": "DISPATCH_EXCEEDED_BALANCE",
-                "message": (
-                    "El costo del despacho supera el saldo"
-                ),
-                "amount": float(amount),
-                "balance": float(balance),
-                "requires_manual_review": True,
-            },
+    if not items:
+        return {}
+
+    ids = [dispatch_id for dispatch_id, _liters in items]
+    liters_by_id = dict(items)
+    results: dict[int, dict[str, Any]] = {}
+
+    if not prepaid_enabled():
+        await cursor.execute(
+            """
+            UPDATE public.water_dispatch wd
+            SET liters = v.liters
+            FROM unnest(
+                %s::bigint[],
+                %s::numeric[]
+            ) AS v(id, liters)
+            WHERE wd.id = v.id
+            RETURNING
+                wd.id,
+                wd.billing_status
+            """,
+            (
+                ids,
+                [liters_by_id[i] for i in ids],
+            ),
         )
 
-    new_balance = balance - amount
+        for row in await cursor.fetchall():
+            results[int(row[0])] = {
+                "ok": True,
+                "amount": None,
+                "balance": None,
+                "billing_status": row[1],
+            }
 
+        return _with_missing(ids, results)
+
+    # orden de bloqueo fijo: billeteras por company_id, despachos por id
     await cursor.execute(
         """
-        UPDATE public.company_wallet
-        SET
-            balance = %s,
-            updated_at = now()
-        WHERE company_id = %s
+        SELECT
+            cw.company_id,
+            cw.balance
+        FROM public.company_wallet cw
+        WHERE cw.company_id IN (
+            SELECT company_id
+            FROM public.water_dispatch
+            WHERE id = ANY(%s)
+        )
+        ORDER BY cw.company_id
+        FOR UPDATE
         """,
-        (
-            new_balance,
-            company_id,
-        ),
+        (ids,),
     )
 
+    balances = {
+        int(row[0]): Decimal(row[1])
+        for row in await cursor.fetchall()
+    }
+    initial_balances = dict(balances)
+
     await cursor.execute(
         """
-        UPDATE public.water_dispatch
-        SET
-            liters = %s,
-            amount = %s,
-            billing_status = 'completed',
-            debited_at = now()
-        WHERE id = %s
-        """,
-        (
+        SELECT
+            id,
+            company_id,
+            billing_status,
+            price_per_m3,
             liters,
-            amount,
-            dispatch_id,
-        ),
+            amount
+        FROM public.water_dispatch
+        WHERE id = ANY(%s)
+        ORDER BY id
+        FOR UPDATE
+        """,
+        (ids,),
     )
 
-    await cursor.execute(
-        """
-        INSERT INTO public.wallet_movement (
-            company_id,
-            dispatch_id,
-            kind,
-            amount,
-            balance_after,
-            note
+    dispatches = await cursor.fetchall()
+
+    # (dispatch_id, company_id, liters, amount, balance_after)
+    debits: list[tuple[int, int, Decimal, Decimal, Decimal]] = []
+    repeated: list[tuple[int, int]] = []
+
+    for (
+        dispatch_id,
+        company_id,
+        billing_status,
+        saved_price_per_m3,
+        saved_liters,
+        saved_amount,
+    ) in dispatches:
+        dispatch_id = int(dispatch_id)
+        company_id = int(company_id)
+        liters = liters_by_id[dispatch_id]
+
+        try:
+            if billing_status == "completed":
+                # misma notificación repetida: no se vuelve a descontar
+                if (
+                    saved_liters is not None
+                    and Decimal(saved_liters) == liters
+                ):
+                    results[dispatch_id] = {
+                        "ok": True,
+                        "amount": (
+                            Decimal(saved_amount)
+                            if saved_amount is not None
+                            else None
+                        ),
+                        "billing_status": "completed",
+                    }
+                    repeated.append((dispatch_id, company_id))
+                    continue
+
+                raise settlement_error("COMPLETED_DISPATCH_CANNOT_CHANGE")
+
+            if billing_status != "active":
+                raise settlement_error(
+                    "DISPATCH_NOT_ACTIVE",
+                    billing_status=billing_status,
+                )
+
+            if saved_price_per_m3 is None:
+                raise settlement_error("DISPATCH_WITHOUT_PRICE")
+
+            if company_id not in balances:
+                raise settlement_error("COMPANY_WALLET_NOT_FOUND")
+
+            balance = balances[company_id]
+
+            amount = calculate_dispatch_amount(
+                liters=liters,
+                price_per_m3=Decimal(saved_price_per_m3),
+            )
+
+            if amount > balance:
+                raise settlement_error(
+                    "DISPATCH_EXCEEDED_BALANCE",
+                    amount=float(amount),
+                    balance=float(balance),
+                )
+
+        except HTTPException as e:
+            results[dispatch_id] = {
+                "ok": False,
+                "status": e.status_code,
+                "error": e.detail,
+            }
+            continue
+
+        balances[company_id] = balance - amount
+        debits.append(
+            (
+                dispatch_id,
+                company_id,
+                liters,
+                amount,
+                balances[company_id],
+            )
         )
-        VALUES (
-            %s,
-            %s,
-            'dispatch',
-            %s,
-            %s,
-            %s
+        results[dispatch_id] = {
+            "ok": True,
+            "amount": amount,
+            "billing_status": "completed",
+        }
+
+    if debits:
+        changed = [
+            company_id
+            for company_id, balance in balances.items()
+            if balance != initial_balances[company_id]
+        ]
+
+        await cursor.execute(
+            """
+            UPDATE public.company_wallet cw
+            SET
+                balance = v.balance,
+                updated_at = now()
+            FROM unnest(
+                %s::bigint[],
+                %s::numeric[]
+            ) AS v(company_id, balance)
+            WHERE cw.company_id = v.company_id
+            """,
+            (
+                changed,
+                [balances[company_id] for company_id in changed],
+            ),
         )
-        """,
-        (
-            company_id,
+
+        for company_id in changed:
+            wallet_balances.invalidate(company_id)
+
+        await cursor.execute(
+            """
+            UPDATE public.water_dispatch wd
+            SET
+                liters = v.liters,
+                amount = v.amount,
+                billing_status = 'completed',
+                debited_at = now()
+            FROM unnest(
+                %s::bigint[],
+                %s::numeric[],
+                %s::numeric[]
+            ) AS v(id, liters, amount)
+            WHERE wd.id = v.id
+            """,
+            (
+                [d[0] for d in debits],
+                [d[2] for d in debits],
+                [d[3] for d in debits],
+            ),
+        )
+
+        # en orden de id: el último movimiento de cada empresa
+        # queda con su saldo final
+        await cursor.execute(
+            """
+            INSERT INTO public.wallet_movement (
+                company_id,
+                dispatch_id,
+                kind,
+                amount,
+                balance_after,
+                note
+            )
+            SELECT
+                v.company_id,
+                v.dispatch_id,
+                'dispatch',
+                -v.amount,
+                v.balance_after,
+                'Débito por despacho de agua'
+            FROM unnest(
+                %s::bigint[],
+                %s::bigint[],
+                %s::numeric[],
+                %s::numeric[]
+            ) WITH ORDINALITY AS v(dispatch_id, company_id, amount, balance_after, n)
+            ORDER BY v.n
+            """,
+            (
+                [d[0] for d in debits],
+                [d[1] for d in debits],
+                [d[3] for d in debits],
+                [d[4] for d in debits],
+            ),
+        )
+
+    for dispatch_id, company_id in [(d[0], d[1]) for d in debits] + repeated:
+        results[dispatch_id]["balance"] = balances.get(company_id)
+
+    return _with_missing(ids, results)
+
+
+def _with_missing(
+    ids: list[int],
+    results: dict[int, dict[str, Any]],
+) -> dict[int, dict[str, Any]]:
+    for dispatch_id in ids:
+        results.setdefault(
             dispatch_id,
-            -amount,
-            new_balance,
-            "Débito por despacho de agua",
-        ),
-    )
+            {
+                "ok": False,
+                "status": 404,
+                "error": "dispatch not found",
+            },
+        )
 
-    return {
-        "amount": amount,
-        "balance": new_balance,
-        "billing_status": "completed",
-    }
\ No newline at end of file
+    return results
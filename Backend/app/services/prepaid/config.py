@@ -0,0 +1,91 @@
+import logging
+from collections import Counter
+from decimal import Decimal
+from typing import Any, Optional
+
+from app.db import pool
+from app.notify import notify_hub
+
+logger = logging.getLogger(__name__)
+
+
+BILLING_CONFIG_CHANNEL = "water_billing_config_changed"
+
+
+class BillingConfigCache:
+    """
+    Copia en memoria de public.water_billing_config (id = 1).
+
+    Se carga en el lifespan y se vuelve a leer sólo cuando llega el
+    NOTIFY water_billing_config_changed (migración 014), cuyo payload
+    es la versión nueva. authorize, /wallet/config y
+    /wallet/company/{code} la usan sin tocar la tabla.
+    """
+
+    def __init__(self) -> None:
+        self._config: Optional[dict[str, Any]] = None
+        self._ready = False
+        self._stats: Counter = Counter()
+
+    async def load(self) -> None:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT
+                        price_per_m3,
+                        minimum_balance,
+                        currency,
+                        updated_at,
+                        version
+                    FROM public.water_billing_config
+                    WHERE id = 1
+                    """
+                )
+                row = await cur.fetchone()
+
+        if row is None:
+            logger.warning("billing_config: no existe water_billing_config id=1")
+            self._config = None
+        else:
+            self._config = {
+                "price_per_m3": Decimal(row[0]),
+                "minimum_balance": Decimal(row[1]),
+                "currency": row[2],
+                "updated_at": row[3],
+                "version": int(row[4]),
+            }
+
+        self._ready = True
+        self._stats["reloads"] += 1
+
+    async def get(self) -> Optional[dict[str, Any]]:
+        """
+        Devuelve {price_per_m3, minimum_balance, currency, updated_at,
+        version} o None si la fila no existe.
+        """
+        if not self._ready:
+            await self.load()
+
+        self._stats["reads"] += 1
+        return self._config
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "ready": self._ready,
+            "version": self._config["version"] if self._config else None,
+            **self._stats,
+        }
+
+    async def on_notify(self, payload: str) -> None:
+        # NOTIFY repetido o de una versión que ya tenemos
+        if self._config is not None and payload == str(self._config["version"]):
+            return
+
+        await self.load()
+
+
+billing_config = BillingConfigCache()
+
+notify_hub.subscribe(BILLING_CONFIG_CHANNEL, billing_config.on_notify)
+notify_hub.on_reconnect(billing_config.load)
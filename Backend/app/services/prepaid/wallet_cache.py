@@ -0,0 +1,108 @@
+import logging
+from collections import Counter
+from decimal import Decimal
+from typing import Any, Optional
+
+from app.db import pool
+from app.notify import notify_hub
+
+logger = logging.getLogger(__name__)
+
+
+WALLET_CHANGED_CHANNEL = "company_wallet_changed"
+
+
+class WalletBalanceCache:
+    """
+    Saldo de cada billetera en memoria, indexado por code de empresa.
+
+    Se llena al leer (read-through) y se descarta:
+    - en la misma transacción que cambia company_wallet
+      (settle_dispatch, settle_dispatches, create_mock_topup);
+    - con el NOTIFY company_wallet_changed (migración 017), que llega
+      después del commit y también trae los cambios de otros procesos.
+
+    Así /wallet/company/{code} responde desde memoria mientras el saldo
+    no cambie.
+    """
+
+    def __init__(self) -> None:
+        self._by_code: dict[str, dict[str, Any]] = {}
+        self._code_by_company: dict[int, str] = {}
+        # sube con cada invalidación: una lectura que se cruzó con una
+        # no guarda lo que leyó
+        self._epoch = 0
+        self._stats: Counter = Counter()
+
+    async def get(self, company: dict[str, Any]) -> Optional[dict[str, Any]]:
+        """
+        Devuelve {balance, updated_at} de la empresa (la entrada de
+        company_registry), o None si no tiene billetera.
+        """
+        entry = self._by_code.get(company["code"])
+
+        if entry is not None and entry["company_id"] == company["id"]:
+            self._stats["hits"] += 1
+            return entry
+
+        self._stats["misses"] += 1
+        epoch = self._epoch
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT balance, updated_at
+                    FROM public.company_wallet
+                    WHERE company_id = %s
+                    """,
+                    (company["id"],),
+                )
+                row = await cur.fetchone()
+
+        if row is None:
+            return None
+
+        entry = {
+            "company_id": company["id"],
+            "balance": Decimal(row[0]),
+            "updated_at": row[1],
+        }
+        if epoch == self._epoch:
+            self._by_code[company["code"]] = entry
+            self._code_by_company[company["id"]] = company["code"]
+        return entry
+
+    def invalidate(self, company_id: int) -> None:
+        self._epoch += 1
+        code = self._code_by_company.pop(company_id, None)
+        if code is not None:
+            self._by_code.pop(code, None)
+            self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._by_code.clear()
+        self._code_by_company.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {"size": len(self._by_code), **self._stats}
+
+    async def on_notify(self, payload: str) -> None:
+        try:
+            company_id = int(payload)
+        except ValueError:
+            logger.warning("wallet_cache: payload inválido: %r", payload[:200])
+            return
+
+        self.invalidate(company_id)
+
+    async def on_reconnect(self) -> None:
+        # durante el corte del LISTEN se pudieron perder cambios
+        self.clear()
+
+
+wallet_balances = WalletBalanceCache()
+
+notify_hub.subscribe(WALLET_CHANGED_CHANNEL, wallet_balances.on_notify)
+notify_hub.on_reconnect(wallet_balances.on_reconnect)
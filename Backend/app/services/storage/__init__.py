@@ -0,0 +1,50 @@
+from app.services.storage.client import (
+    STORAGE_UPLOAD_CONCURRENCY,
+    StorageClient,
+    storage_client,
+)
+from app.services.storage.deferred import (
+    STORAGE_DEFER_DISPATCH_PHOTOS,
+    DeferredPhotoUploader,
+    deferred_photo_uploader,
+    spool_upload,
+)
+from app.services.storage.streaming import (
+    ALLOWED_IMAGE_TYPES,
+    MIN_IMAGE_BYTES,
+    UPLOAD_CHUNK_SIZE,
+    image_extension,
+    iter_upload,
+    open_image_upload,
+)
+from app.services.storage.thumbs import (
+    ThumbnailService,
+    render_thumbnail,
+    tee_to_file,
+    thumb_object_path,
+    thumbnail_service,
+    upload_with_thumb_copy,
+)
+
+
+__all__ = [
+    "STORAGE_UPLOAD_CONCURRENCY",
+    "StorageClient",
+    "storage_client",
+    "STORAGE_DEFER_DISPATCH_PHOTOS",
+    "DeferredPhotoUploader",
+    "deferred_photo_uploader",
+    "spool_upload",
+    "ALLOWED_IMAGE_TYPES",
+    "MIN_IMAGE_BYTES",
+    "UPLOAD_CHUNK_SIZE",
+    "image_extension",
+    "iter_upload",
+    "open_image_upload",
+    "ThumbnailService",
+    "render_thumbnail",
+    "tee_to_file",
+    "thumb_object_path",
+    "thumbnail_service",
+    "upload_with_thumb_copy",
+]
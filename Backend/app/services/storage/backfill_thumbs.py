@@ -0,0 +1,134 @@
+"""
+Genera los thumbnails que faltan para las fotos ya cargadas.
+
+Recorre water_dispatch del más nuevo al más viejo, baja cada foto
+del bucket que no tenga thumbnail en thumb_paths, lo genera y lo sube
+al lado del original. Las fotos que no son de nuestro bucket se saltean.
+
+Uso por consola:
+    python -m app.services.storage.backfill_thumbs --batch-size 100 --concurrency 4
+"""
+import argparse
+import asyncio
+from typing import Any, Optional
+
+from fastapi import HTTPException
+
+from app.db import close_pool, open_pool, pool
+from app.services.storage.client import storage_client
+from app.services.storage.thumbs import thumbnail_service
+
+
+def _missing_thumbs(photo_path: Optional[str], photo_paths: Any, thumb_paths: Any) -> list[str]:
+    urls = list(photo_paths) if isinstance(photo_paths, list) else []
+    if photo_path and photo_path not in urls:
+        urls.append(photo_path)
+
+    done = thumb_paths if isinstance(thumb_paths, dict) else {}
+    return [u for u in urls if u and u not in done]
+
+
+async def backfill_thumbnails(batch_size: int = 100, concurrency: int = 4, limit: int = 0) -> dict[str, int]:
+    """
+    Devuelve contadores: dispatches revisados, thumbnails creados,
+    fotos salteadas (fuera del bucket) y errores.
+    """
+    counts = {"dispatches": 0, "created": 0, "skipped": 0, "errors": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    last_id: Optional[int] = None
+
+    async def _one(url: str) -> Optional[str]:
+        object_path = storage_client.object_path_from_url(url)
+        if object_path is None:
+            counts["skipped"] += 1
+            return None
+
+        async with semaphore:
+            try:
+                data = await storage_client.download(object_path)
+            except HTTPException as e:
+                print(f"no se pudo bajar {object_path}: {e.detail}")
+                counts["errors"] += 1
+                return None
+
+            thumb = await thumbnail_service.make(data, object_path)
+
+        if thumb is None:
+            counts["errors"] += 1
+        else:
+            counts["created"] += 1
+        return thumb
+
+    while True:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, photo_path, photo_paths, thumb_paths
+                    FROM public.water_dispatch
+                    WHERE (%s::bigint IS NULL OR id < %s::bigint)
+                      AND (photo_path IS NOT NULL OR jsonb_array_length(COALESCE(photo_paths, '[]'::jsonb)) > 0)
+                    ORDER BY id DESC
+                    LIMIT %s
+                    """,
+                    (last_id, last_id, batch_size),
+                )
+                rows = await cur.fetchall()
+
+        if not rows:
+            return counts
+
+        if limit:
+            rows = rows[: limit - counts["dispatches"]]
+
+        async def _dispatch(dispatch_id: int, missing: list[str]) -> None:
+            results = await asyncio.gather(*(_one(u) for u in missing))
+            await thumbnail_service.record(
+                dispatch_id,
+                {url: thumb for url, thumb in zip(missing, results) if thumb},
+            )
+
+        # todo el lote en paralelo; el semáforo limita las descargas
+        await asyncio.gather(
+            *(
+                _dispatch(dispatch_id, missing)
+                for dispatch_id, photo_path, photo_paths, thumb_paths in rows
+                if (missing := _missing_thumbs(photo_path, photo_paths, thumb_paths))
+            )
+        )
+
+        counts["dispatches"] += len(rows)
+        if limit and counts["dispatches"] >= limit:
+            return counts
+
+        last_id = rows[-1][0]
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Genera thumbnails de fotos de despachos existentes")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=0, help="máximo de despachos (0 = todos)")
+    args = parser.parse_args()
+
+    await open_pool()
+    await thumbnail_service.start()
+
+    try:
+        if not thumbnail_service.enabled():
+            raise SystemExit("Thumbnails desactivados (instalá Pillow y revisá THUMB_PROCESSES)")
+
+        counts = await backfill_thumbnails(args.batch_size, args.concurrency, args.limit)
+    finally:
+        await thumbnail_service.stop()
+        await storage_client.close()
+        await close_pool()
+
+    print(
+        f"despachos: {counts['dispatches']}  thumbnails: {counts['created']}  "
+        f"salteadas: {counts['skipped']}  errores: {counts['errors']}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,209 @@
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, AsyncIterator, Optional
+
+import httpx
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ENV =====
+SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
+SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE", "")
+STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "cargadero")
+
+STORAGE_TIMEOUT_S = float(os.getenv("STORAGE_TIMEOUT_S", "30"))
+STORAGE_MAX_CONNECTIONS = int(os.getenv("STORAGE_MAX_CONNECTIONS", "10"))
+STORAGE_MAX_KEEPALIVE = int(os.getenv("STORAGE_MAX_KEEPALIVE", "5"))
+
+# Cuántas fotos de un mismo despacho se suben en paralelo
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "3"))
+
+
+def _http2_available() -> bool:
+    # httpx necesita el extra [http2] (paquete h2) para negociar HTTP/2
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class StorageClient:
+    """
+    Cliente único de Supabase Storage para todo el proceso.
+
+    Mantiene un httpx.AsyncClient con keep-alive (y HTTP/2 si está
+    instalado h2), así cada foto no paga un handshake TCP+TLS nuevo.
+    Se abre y se cierra desde el lifespan de main.py; si se usa fuera
+    de la app (scripts), se abre solo en el primer upload.
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats: Counter = Counter()
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+        self._last_ms = 0.0
+
+    async def open(self) -> None:
+        if self._client is not None:
+            return
+
+        self._client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=STORAGE_TIMEOUT_S,
+            limits=httpx.Limits(
+                max_connections=STORAGE_MAX_CONNECTIONS,
+                max_keepalive_connections=STORAGE_MAX_KEEPALIVE,
+            ),
+        )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def public_url(self, object_path: str) -> str:
+        return f"{SUPABASE_URL}/storage/v1/object/public/{STORAGE_BUCKET}/{object_path}"
+
+    def object_path_from_url(self, url: str) -> Optional[str]:
+        """
+        Inversa de public_url(). None si la URL no es de nuestro bucket
+        (ej: photo_path cargado a mano en modo JSON).
+        """
+        prefix = self.public_url("")
+        if not url.startswith(prefix):
+            return None
+        return url[len(prefix):] or None
+
+    async def download(self, object_path: str) -> bytes:
+        """
+        Baja un objeto del bucket (lo usa el backfill de thumbnails).
+        """
+        if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE:
+            raise HTTPException(
+                status_code=500,
+                detail="Supabase env vars missing (SUPABASE_URL/SUPABASE_SERVICE_ROLE)",
+            )
+
+        if self._client is None:
+            await self.open()
+
+        try:
+            r = await self._client.get(
+                f"{SUPABASE_URL}/storage/v1/object/{STORAGE_BUCKET}/{object_path}",
+                headers={"Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}"},
+            )
+        except httpx.HTTPError as e:
+            raise HTTPException(
+                status_code=502,
+                detail={"supabase_error": f"{type(e).__name__}: {e}"},
+            )
+
+        if r.status_code != 200:
+            raise HTTPException(
+                status_code=502,
+                detail={"supabase_status": r.status_code, "supabase_body": r.text},
+            )
+
+        return r.content
+
+    async def upload(
+        self,
+        *,
+        content: bytes | AsyncIterator[bytes],
+        content_type: str,
+        object_path: str,
+        size: Optional[int] = None,
+    ) -> str:
+        """
+        Sube a Supabase Storage usando service role y devuelve URL pública.
+
+        content puede ser bytes o un iterador de chunks (streaming);
+        si se conoce el tamaño se manda Content-Length en vez de chunked.
+        """
+        if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE:
+            raise HTTPException(
+                status_code=500,
+                detail="Supabase env vars missing (SUPABASE_URL/SUPABASE_SERVICE_ROLE)",
+            )
+
+        if self._client is None:
+            await self.open()
+
+        upload_url = f"{SUPABASE_URL}/storage/v1/object/{STORAGE_BUCKET}/{object_path}"
+
+        headers = {
+            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
+            "Content-Type": content_type,
+            "x-upsert": "true",
+        }
+
+        if size is not None:
+            headers["Content-Length"] = str(size)
+
+        sent = 0
+
+        async def _counted(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+            nonlocal sent
+            async for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+
+        if isinstance(content, bytes):
+            sent = len(content)
+            body: Any = content
+        else:
+            body = _counted(content)
+
+        started = time.perf_counter()
+        try:
+            r = await self._client.post(upload_url, content=body, headers=headers)
+        except httpx.HTTPError as e:
+            self._record(started, sent, ok=False)
+            raise HTTPException(
+                status_code=502,
+                detail={"supabase_error": f"{type(e).__name__}: {e}"},
+            )
+
+        if r.status_code not in (200, 201):
+            self._record(started, sent, ok=False)
+            raise HTTPException(
+                status_code=502,
+                detail={
+                    "supabase_status": r.status_code,
+                    "supabase_body": r.text,
+                },
+            )
+
+        self._record(started, sent, ok=True)
+        return self.public_url(object_path)
+
+    def stats(self) -> dict[str, Any]:
+        uploads = self._stats["uploads"]
+        return {
+            "http2": bool(self._client and _http2_available()),
+            **self._stats,
+            "avg_ms": round(self._total_ms / uploads, 2) if uploads else 0.0,
+            "max_ms": round(self._max_ms, 2),
+            "last_ms": round(self._last_ms, 2),
+        }
+
+    def _record(self, started: float, sent: int, *, ok: bool) -> None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self._stats["uploads"] += 1
+        self._stats["bytes"] += sent
+        if not ok:
+            self._stats["errors"] += 1
+
+        self._total_ms += elapsed_ms
+        self._last_ms = elapsed_ms
+        self._max_ms = max(self._max_ms, elapsed_ms)
+
+
+storage_client = StorageClient()
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import os
+import tempfile
+from collections import Counter
+from typing import Any, AsyncIterator
+
+from fastapi import HTTPException, UploadFile
+from psycopg.types.json import Jsonb
+
+from app.db import pool
+from app.services.storage.client import STORAGE_UPLOAD_CONCURRENCY, storage_client
+from app.services.storage.streaming import UPLOAD_CHUNK_SIZE, iter_upload
+from app.services.storage.thumbs import thumbnail_service
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ENV =====
+# Si es true, /water/dispatch/start crea el despacho sin esperar las fotos
+# (se puede pisar por request con el campo defer_photos del multipart)
+STORAGE_DEFER_DISPATCH_PHOTOS = os.getenv("STORAGE_DEFER_DISPATCH_PHOTOS", "false").lower() in ("1", "true", "yes")
+
+# Carpeta local donde quedan las fotos hasta subirlas
+STORAGE_SPOOL_DIR = os.getenv("STORAGE_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "cargadero-photos")
+
+STORAGE_DEFER_WORKERS = int(os.getenv("STORAGE_DEFER_WORKERS", "2"))
+STORAGE_DEFER_ATTEMPTS = int(os.getenv("STORAGE_DEFER_ATTEMPTS", "3"))
+
+# Al apagar, cuánto se espera a que terminen las subidas en curso
+STORAGE_DEFER_DRAIN_S = float(os.getenv("STORAGE_DEFER_DRAIN_S", "20"))
+
+
+# Cada foto diferida: (campo, archivo_local, content_type, object_path, tamaño)
+SpooledPhoto = tuple[str, str, str, str, int]
+
+
+async def spool_upload(upload: UploadFile, first_chunk: bytes) -> tuple[str, int]:
+    """
+    Copia la foto (ya validada) a un archivo local y devuelve (ruta, tamaño).
+
+    Hace falta porque Starlette cierra los archivos del form cuando
+    termina el request, antes de que el worker los suba.
+    """
+    os.makedirs(STORAGE_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=STORAGE_SPOOL_DIR, suffix=".part")
+    size = 0
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in iter_upload(upload, first_chunk):
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+
+    return path, size
+
+
+async def _iter_file(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _error_detail(error: BaseException) -> str:
+    if isinstance(error, HTTPException):
+        return str(error.detail)
+    return f"{type(error).__name__}: {error}"
+
+
+class DeferredPhotoUploader:
+    """
+    Sube en segundo plano las fotos de despachos ya creados.
+
+    Las fotos de un despacho se suben juntas (con el mismo tope de
+    concurrencia que el modo directo) y al final se hace un único UPDATE:
+    photo_paths recibe un append JSONB en el orden de los campos y
+    photo_uploads pasa de "pending" a "uploaded"/"failed" por foto
+    (y thumb_paths suma los thumbnails, si están activos).
+
+    La cola es en memoria: si el proceso se corta, start() marca como
+    "failed" (interrupted) lo que haya quedado en "pending".
+    """
+
+    def __init__(self) -> None:
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+        self._stats: Counter = Counter()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+
+        await self._fail_interrupted()
+
+        self._workers = [
+            asyncio.create_task(self._run())
+            for _ in range(max(1, STORAGE_DEFER_WORKERS))
+        ]
+
+    async def stop(self) -> None:
+        if not self._workers:
+            return
+
+        try:
+            await asyncio.wait_for(self._queue.join(), STORAGE_DEFER_DRAIN_S)
+        except asyncio.TimeoutError:
+            logger.warning("deferred_photos: quedaron %s despachos sin subir al apagar", self._queue.qsize())
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, dispatch_id: int, photos: list[SpooledPhoto]) -> None:
+        """
+        Encola las fotos spooleadas de un despacho recién creado.
+        """
+        if not photos:
+            return
+        self._stats["queued"] += 1
+        self._queue.put_nowait((dispatch_id, photos))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict[str, int]:
+        return {**self._stats, "pending": self.pending()}
+
+    async def _run(self) -> None:
+        while True:
+            dispatch_id, photos = await self._queue.get()
+            try:
+                await self._process(dispatch_id, photos)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("deferred_photos: falló el despacho %s", dispatch_id)
+                self._stats["errors"] += 1
+            finally:
+                for _field, path, *_ in photos:
+                    _remove(path)
+                self._queue.task_done()
+
+    async def _process(self, dispatch_id: int, photos: list[SpooledPhoto]) -> None:
+        semaphore = asyncio.Semaphore(STORAGE_UPLOAD_CONCURRENCY)
+
+        async def _upload(path: str, content_type: str, object_path: str, size: int) -> str:
+            async with semaphore:
+                return await self._upload_with_retry(path, content_type, object_path, size)
+
+        results = await asyncio.gather(
+            *(_upload(*photo[1:]) for photo in photos),
+            return_exceptions=True,
+        )
+
+        urls: list[str] = []
+        statuses: dict[str, Any] = {}
+        thumb_sources = []
+
+        for (field, path, _ct, object_path, _size), result in zip(photos, results):
+            if isinstance(result, BaseException):
+                statuses[field] = {"status": "failed", "error": _error_detail(result)}
+                self._stats["photos_failed"] += 1
+            else:
+                urls.append(result)
+                statuses[field] = {"status": "uploaded", "url": result}
+                thumb_sources.append((result, object_path, path))
+                self._stats["photos_uploaded"] += 1
+
+        # el archivo local sigue ahí, así que el thumbnail sale de disco
+        thumbs = await thumbnail_service.make_many(thumb_sources)
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.water_dispatch
+                    SET photo_paths = COALESCE(photo_paths, '[]'::jsonb) || %s,
+                        photo_path = COALESCE(photo_path, %s::text),
+                        photo_uploads = COALESCE(photo_uploads, '{}'::jsonb) || %s,
+                        thumb_paths = COALESCE(thumb_paths, '{}'::jsonb) || %s
+                    WHERE id = %s
+                    """,
+                    (
+                        Jsonb(urls),
+                        urls[0] if urls else None,
+                        Jsonb(statuses),
+                        Jsonb(thumbs),
+                        dispatch_id,
+                    ),
+                )
+
+        self._stats["dispatches"] += 1
+
+    async def _upload_with_retry(self, path: str, content_type: str, object_path: str, size: int) -> str:
+        attempt = 1
+        while True:
+            try:
+                return await storage_client.upload(
+                    content=_iter_file(path),
+                    content_type=content_type,
+                    object_path=object_path,
+                    size=size,
+                )
+            except HTTPException as e:
+                # 500 = faltan envs de Supabase, no tiene sentido reintentar
+                if e.status_code != 502 or attempt >= STORAGE_DEFER_ATTEMPTS:
+                    raise
+                self._stats["retries"] += 1
+                await asyncio.sleep(2 ** (attempt - 1))
+                attempt += 1
+
+    async def _fail_interrupted(self) -> None:
+        """
+        Los despachos que quedaron con fotos "pending" de una corrida
+        anterior ya no se van a subir (la cola era en memoria).
+        """
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.water_dispatch wd
+                    SET photo_uploads = (
+                        SELECT jsonb_object_agg(
+                            k,
+                            CASE
+                                WHEN v->>'status' = 'pending'
+                                THEN jsonb_build_object('status', 'failed', 'error', 'interrupted')
+                                ELSE v
+                            END
+                        )
+                        FROM jsonb_each(wd.photo_uploads) AS e(k, v)
+                    )
+                    WHERE wd.photo_uploads IS NOT NULL
+                      AND jsonb_path_exists(wd.photo_uploads, '$.* ? (@.status == "pending")')
+                    """
+                )
+                interrupted = cur.rowcount
+
+        if interrupted:
+            logger.warning("deferred_photos: %s despachos con fotos interrumpidas", interrupted)
+            self._stats["interrupted"] += interrupted
+
+
+deferred_photo_uploader = DeferredPhotoUploader()
@@ -0,0 +1,79 @@
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException, UploadFile
+
+
+# Tamaño de cada chunk que se lee del archivo spooleado y se manda a storage
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Una foto de cámara real nunca pesa menos que esto
+MIN_IMAGE_BYTES = 1000
+
+ALLOWED_IMAGE_TYPES = ("image/jpeg", "image/jpg", "image/png")
+
+_MAGIC_BYTES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+)
+
+
+def _sniff_image_type(first_chunk: bytes) -> Optional[str]:
+    for magic, content_type in _MAGIC_BYTES:
+        if first_chunk.startswith(magic):
+            return content_type
+    return None
+
+
+async def open_image_upload(upload: UploadFile, field: Optional[str] = None) -> tuple[bytes, str]:
+    """
+    Valida una foto leyendo sólo el primer chunk: content-type declarado,
+    magic bytes (JPEG/PNG) y tamaño mínimo.
+
+    Devuelve (primer_chunk, content_type_detectado). El resto del archivo
+    se manda después con iter_upload(), sin cargarlo entero en memoria.
+    """
+    where = f" in {field}" if field else ""
+    declared = (upload.content_type or "").lower()
+
+    if declared not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported content-type{where}: {upload.content_type}",
+        )
+
+    await upload.seek(0)
+    first_chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+
+    # Si el primer chunk vino incompleto es porque ya es todo el archivo
+    size = upload.size if upload.size is not None else len(first_chunk)
+    if not first_chunk or size < MIN_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{field} empty or too small" if field else "File empty or too small",
+        )
+
+    detected = _sniff_image_type(first_chunk)
+    if detected is None:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Content{where} is not a JPEG/PNG image",
+        )
+
+    return first_chunk, detected
+
+
+async def iter_upload(upload: UploadFile, first_chunk: bytes) -> AsyncIterator[bytes]:
+    """
+    Primer chunk (ya leído al validar) y después el resto del archivo.
+    """
+    yield first_chunk
+
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def image_extension(content_type: str) -> str:
+    return ".png" if content_type == "image/png" else ".jpg"
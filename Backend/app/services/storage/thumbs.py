@@ -0,0 +1,272 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import posixpath
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Optional
+
+from fastapi import HTTPException, UploadFile
+from psycopg.types.json import Jsonb
+
+from app.db import pool
+from app.services.storage.client import storage_client
+from app.services.storage.streaming import iter_upload
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ENV =====
+THUMB_MAX_PX = int(os.getenv("THUMB_MAX_PX", "320"))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "70"))
+
+# Procesos para redimensionar (0 = thumbnails desactivados)
+THUMB_PROCESSES = int(os.getenv("THUMB_PROCESSES", "2"))
+
+
+# Cada thumbnail pendiente: (url_original, object_path_original, fuente)
+# fuente = bytes de la foto o ruta a un archivo local
+ThumbSource = tuple[str, str, bytes | str]
+
+
+def _pillow_available() -> bool:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def thumb_object_path(object_path: str) -> str:
+    """
+    photos/dispatch_2/start_file1_1_...jpg -> photos/dispatch_2/start_file1_1_..._thumb.jpg
+
+    Los thumbnails quedan al lado del original y siempre son JPEG.
+    """
+    stem, _ext = posixpath.splitext(object_path)
+    return f"{stem}_thumb.jpg"
+
+
+def render_thumbnail(source: bytes | str, max_px: int = THUMB_MAX_PX, quality: int = THUMB_QUALITY) -> bytes:
+    """
+    Redimensiona una foto a JPEG de max_px de lado. Corre en el
+    ProcessPoolExecutor (por eso es una función de módulo).
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        # en JPEG, draft decodifica directamente a 1/2, 1/4 o 1/8 de escala
+        img.draft("RGB", (max_px, max_px))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_px, max_px))
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+async def tee_to_file(chunks: AsyncIterator[bytes], path: str) -> AsyncIterator[bytes]:
+    """
+    Deja pasar los chunks hacia storage y de paso los copia a path,
+    así el thumbnail sale de disco sin releer la foto en el request.
+    """
+    with open(path, "wb") as f:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+            yield chunk
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ThumbnailService:
+    """
+    Genera y sube thumbnails de las fotos de despachos.
+
+    El redimensionado corre en un pool de procesos para no bloquear el
+    event loop. water_dispatch.thumb_paths guarda {url_original: url_thumb},
+    así cualquier ruta que agregue fotos puede sumar su thumbnail con un
+    merge JSONB, sin depender del orden de photo_paths.
+
+    Si Pillow no está instalado o THUMB_PROCESSES=0, queda desactivado
+    y las rutas siguen funcionando sin thumbnails.
+    """
+
+    def __init__(self) -> None:
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._stats: Counter = Counter()
+
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    async def start(self) -> None:
+        if self._executor is not None or THUMB_PROCESSES <= 0:
+            return
+
+        if not _pillow_available():
+            logger.warning("thumbnails: Pillow no está instalado, thumbnails desactivados")
+            return
+
+        # spawn: no se hereda el event loop ni las conexiones del proceso principal
+        self._executor = ProcessPoolExecutor(
+            max_workers=THUMB_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    async def stop(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def make(self, source: bytes | str, object_path: str) -> Optional[str]:
+        """
+        Redimensiona y sube un thumbnail. Devuelve su URL pública, o None
+        si está desactivado o falló (un thumbnail nunca corta un despacho).
+        """
+        if self._executor is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(self._executor, render_thumbnail, source)
+            url = await storage_client.upload(
+                content=data,
+                content_type="image/jpeg",
+                object_path=thumb_object_path(object_path),
+                size=len(data),
+            )
+        except HTTPException as e:
+            logger.warning("thumbnails: falló la subida de %s: %s", object_path, e.detail)
+            self._stats["errors"] += 1
+            return None
+        except Exception:
+            logger.exception("thumbnails: no se pudo generar %s", object_path)
+            self._stats["errors"] += 1
+            return None
+
+        self._stats["created"] += 1
+        self._stats["bytes"] += len(data)
+        return url
+
+    async def make_many(self, items: list[ThumbSource]) -> dict[str, str]:
+        """
+        Genera los thumbnails de varias fotos en paralelo.
+        Devuelve {url_original: url_thumb} sólo con los que salieron bien.
+        """
+        results = await asyncio.gather(
+            *(self.make(source, object_path) for _url, object_path, source in items)
+        )
+        return {url: thumb for (url, *_), thumb in zip(items, results) if thumb}
+
+    async def record(self, dispatch_id: int, thumbs: dict[str, str]) -> None:
+        if not thumbs:
+            return
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    UPDATE public.water_dispatch
+                    SET thumb_paths = COALESCE(thumb_paths, '{}'::jsonb) || %s
+                    WHERE id = %s
+                    """,
+                    (Jsonb(thumbs), dispatch_id),
+                )
+
+    def spool_path(self) -> Optional[str]:
+        """
+        Archivo temporal para copiar una foto mientras se sube
+        (ver tee_to_file), o None si los thumbnails están desactivados.
+        Lo borra schedule() / discard() cuando ya no hace falta.
+        """
+        if self._executor is None:
+            return None
+
+        fd, path = tempfile.mkstemp(prefix="thumb_", suffix=".part")
+        os.close(fd)
+        return path
+
+    def discard(self, items: list[ThumbSource]) -> None:
+        """
+        Borra las copias de spool_path() de fotos que no van a tener thumbnail.
+        """
+        for _url, _object_path, source in items:
+            if isinstance(source, str):
+                _remove(source)
+
+    def schedule(self, dispatch_id: int, items: list[ThumbSource]) -> None:
+        """
+        Genera y registra los thumbnails después de responder el request.
+        Las fuentes que son archivos (de spool_path) se borran al terminar.
+        """
+        if self._executor is None or not items:
+            self.discard(items)
+            return
+
+        task = asyncio.create_task(self._make_and_record(dispatch_id, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> dict[str, Any]:
+        return {"enabled": self.enabled(), **self._stats, "in_flight": len(self._tasks)}
+
+    async def _make_and_record(self, dispatch_id: int, items: list[ThumbSource]) -> None:
+        try:
+            await self.record(dispatch_id, await self.make_many(items))
+        except Exception:
+            logger.exception("thumbnails: no se pudieron registrar los del despacho %s", dispatch_id)
+            self._stats["errors"] += 1
+        finally:
+            self.discard(items)
+
+
+thumbnail_service = ThumbnailService()
+
+
+async def upload_with_thumb_copy(
+    upload: UploadFile,
+    first_chunk: bytes,
+    content_type: str,
+    object_path: str,
+) -> tuple[str, Optional[str]]:
+    """
+    Sube la foto por streaming. Con thumbnails activos, la misma pasada
+    la copia a un archivo temporal: el thumbnail se genera de ahí en
+    segundo plano (thumbnail_service.schedule), sin volver a leer la
+    foto dentro del request.
+
+    Devuelve (url, archivo_para_thumbnail o None).
+    """
+    thumb_path = thumbnail_service.spool_path()
+    content = iter_upload(upload, first_chunk)
+
+    if thumb_path:
+        content = tee_to_file(content, thumb_path)
+
+    try:
+        url = await storage_client.upload(
+            content=content,
+            content_type=content_type,
+            object_path=object_path,
+            size=upload.size,
+        )
+    except BaseException:
+        if thumb_path:
+            _remove(thumb_path)
+        raise
+
+    return url, thumb_path
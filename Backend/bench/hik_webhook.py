@@ -0,0 +1,283 @@
+"""
+Benchmark del webhook Hik (/access/hik/webhook).
+
+Reproduce un corpus de payloads grabados (XML, JSON y multipart con foto)
+contra la app FastAPI en proceso, con una Postgres local y un Node-RED
+falso que sólo responde 200. No necesita red.
+
+Uso (desde Backend/):
+    DATABASE_URL=postgresql://postgres@localhost/cargadero \\
+        python -m bench.hik_webhook --requests 2000 --concurrency 1,8,32 --dup-ratio 0.2
+
+Reporta por nivel de concurrencia:
+  - throughput (req/s)
+  - latencia p50/p95/p99/max (ms)
+  - espera del pool (promedio y total, de pool.get_stats())
+  - duplicados absorbidos, eventos descartados por el pre-filtro
+  - tiempo hasta vaciar el write-behind
+  - POSTs recibidos por el Node-RED falso
+
+Los templates del corpus usan __SERIAL__ y __TS__; cada request única
+recibe un serial nuevo, los duplicados reenvían los mismos bytes.
+Los archivos *.multipart.json se envían como multipart/mixed con una
+foto sintética, como hacen los equipos Hik.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import time
+from pathlib import Path
+
+import httpx
+
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+MULTIPART_BOUNDARY = "MIME_boundary"
+
+
+# =========================
+# Node-RED falso
+# =========================
+class StubNodeRed:
+    """
+    Servidor HTTP mínimo que responde 200 a cualquier POST.
+    """
+
+    def __init__(self) -> None:
+        self.received = 0
+        self._server = None
+
+    async def start(self, port: int) -> None:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.decode("latin-1").split("\r\n"):
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                if length:
+                    await reader.readexactly(length)
+
+                self.received += 1
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# =========================
+# Corpus
+# =========================
+def load_corpus(directory: Path) -> list[tuple[str, str]]:
+    """
+    Devuelve [(nombre, template)] de los .json/.xml del directorio.
+    """
+    items = []
+    for path in sorted(directory.iterdir()):
+        if path.suffix in (".json", ".xml"):
+            items.append((path.name, path.read_text(encoding="utf-8")))
+    if not items:
+        raise SystemExit(f"corpus vacío: {directory}")
+    return items
+
+
+def render(name: str, template: str, serial: int, picture: bytes) -> tuple[bytes, str]:
+    ts = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    payload = template.replace("__SERIAL__", str(serial)).replace("__TS__", ts).encode("utf-8")
+
+    if name.endswith(".multipart.json"):
+        body = (
+            f"--{MULTIPART_BOUNDARY}\r\n"
+            'Content-Disposition: form-data; name="event_log"\r\n'
+            "Content-Type: application/json\r\n\r\n"
+        ).encode() + payload + (
+            f"\r\n--{MULTIPART_BOUNDARY}\r\n"
+            'Content-Disposition: form-data; name="Picture"; filename="Picture.jpg"\r\n'
+            "Content-Type: image/jpeg\r\n\r\n"
+        ).encode() + picture + f"\r\n--{MULTIPART_BOUNDARY}--\r\n".encode()
+        return body, f"multipart/mixed; boundary={MULTIPART_BOUNDARY}"
+
+    if name.endswith(".xml"):
+        return payload, "application/xml"
+    return payload, "application/json"
+
+
+def build_requests(
+    corpus: list[tuple[str, str]],
+    total: int,
+    dup_ratio: float,
+    first_serial: int,
+    rng: random.Random,
+) -> list[tuple[bytes, str]]:
+    picture = b"\xff\xd8\xff\xe0" + rng.randbytes(60_000) + b"\xff\xd9"
+    sent: list[tuple[bytes, str]] = []
+    serial = first_serial
+
+    for _ in range(total):
+        if sent and rng.random() < dup_ratio:
+            sent.append(rng.choice(sent))
+            continue
+        name, template = rng.choice(corpus)
+        serial += 1
+        sent.append(render(name, template, serial, picture))
+
+    return sent
+
+
+# =========================
+# Corrida
+# =========================
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    requests: list[tuple[bytes, str]],
+    concurrency: int,
+) -> dict:
+    from app.db import pool
+    from app.routes.hik import access_event_writer
+    from app.services.hik import event_deduplicator, prefilter_stats
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in requests:
+        queue.put_nowait(item)
+
+    latencies: list[float] = []
+    errors = 0
+
+    async def worker() -> None:
+        nonlocal errors
+        while True:
+            try:
+                body, content_type = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            r = await client.post(
+                "/access/hik/webhook",
+                content=body,
+                headers={"content-type": content_type},
+            )
+            latencies.append((time.perf_counter() - started) * 1000)
+            if r.status_code != 200:
+                errors += 1
+
+    pool.pop_stats()
+    dups_before = event_deduplicator.stats().get("duplicates", 0)
+    dropped_before = prefilter_stats().get("dropped", 0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    drain_started = time.perf_counter()
+    while access_event_writer.pending():
+        await asyncio.sleep(0.01)
+    drain = time.perf_counter() - drain_started
+
+    pool_stats = pool.pop_stats()
+    waits = pool_stats.get("requests_num", 0)
+    wait_ms = pool_stats.get("requests_wait_ms", 0)
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "errors": errors,
+        "rps": len(requests) / wall if wall else 0.0,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0.0,
+        "pool_checkouts": waits,
+        "pool_wait_avg_ms": wait_ms / waits if waits else 0.0,
+        "pool_wait_total_ms": wait_ms,
+        "duplicates": event_deduplicator.stats().get("duplicates", 0) - dups_before,
+        "dropped": prefilter_stats().get("dropped", 0) - dropped_before,
+        "drain_ms": drain * 1000,
+    }
+
+
+def print_report(rows: list[dict], node_red_posts: int) -> None:
+    header = (
+        f"{'conc':>5} {'req':>6} {'err':>4} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7} "
+        f"{'pool':>6} {'wait_avg':>8} {'wait_tot':>9} {'dups':>5} {'drop':>5} {'drain':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(
+            f"{r['concurrency']:>5} {r['requests']:>6} {r['errors']:>4} {r['rps']:>8.1f} "
+            f"{r['p50']:>7.2f} {r['p95']:>7.2f} {r['p99']:>7.2f} {r['max']:>7.2f} "
+            f"{r['pool_checkouts']:>6} {r['pool_wait_avg_ms']:>8.2f} {r['pool_wait_total_ms']:>9} "
+            f"{r['duplicates']:>5} {r['dropped']:>5} {r['drain_ms']:>7.1f}"
+        )
+    print(f"\nlatencias en ms; POSTs recibidos por Node-RED falso: {node_red_posts}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de /access/hik/webhook")
+    parser.add_argument("--corpus", type=Path, default=CORPUS_DIR)
+    parser.add_argument("--requests", type=int, default=1000, help="requests por nivel")
+    parser.add_argument("--concurrency", default="1,8,32", help="niveles separados por coma")
+    parser.add_argument("--dup-ratio", type=float, default=0.1, help="fracción de reintentos duplicados")
+    parser.add_argument("--node-red-port", type=int, default=18800)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not (os.getenv("DATABASE_URL") or os.getenv("SUPABASE_DB_URL")):
+        raise SystemExit("Definí DATABASE_URL apuntando a una Postgres local")
+
+    # Los módulos de la app leen estas envs al importarse
+    os.environ["NODE_RED_DISPATCH_WEBHOOK"] = f"http://127.0.0.1:{args.node_red_port}/hik/dispatch_started"
+    os.environ.setdefault("NODE_RED_OUTBOX_POLL_S", "0.5")
+
+    from app.main import app
+
+    stub = StubNodeRed()
+    await stub.start(args.node_red_port)
+
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args.corpus)
+    # serial base por corrida, para no chocar con el dedupe_key de corridas anteriores
+    serial = int(time.time() * 1000)
+    rows = []
+
+    try:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 50000))
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for level in (int(x) for x in args.concurrency.split(",") if x.strip()):
+                    requests = build_requests(corpus, args.requests, args.dup_ratio, serial, rng)
+                    serial += args.requests + 1
+                    rows.append(await run_level(client, requests, level))
+
+            # dejamos que el outbox termine de entregar antes de apagar
+            await asyncio.sleep(1)
+    finally:
+        await stub.stop()
+
+    print_report(rows, stub.received)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+-- Avisa por NOTIFY cada cambio en public.company.
+-- El backend escucha el canal company_changed y refresca su
+-- registro en memoria (app/services/company/registry.py).
+-- El payload es el code de la empresa afectada.
+
+CREATE OR REPLACE FUNCTION public.notify_company_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('company_changed', COALESCE(OLD.code, ''));
+    END IF;
+
+    IF TG_OP = 'INSERT'
+       OR (TG_OP = 'UPDATE' AND NEW.code IS DISTINCT FROM OLD.code) THEN
+        PERFORM pg_notify('company_changed', COALESCE(NEW.code, ''));
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS company_changed_notify ON public.company;
+
+CREATE TRIGGER company_changed_notify
+AFTER INSERT OR UPDATE OR DELETE ON public.company
+FOR EACH ROW
+EXECUTE FUNCTION public.notify_company_changed();
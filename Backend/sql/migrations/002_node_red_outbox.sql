@@ -0,0 +1,21 @@
+-- Outbox durable de notificaciones a Node-RED.
+-- El webhook Hik inserta la fila en la misma transacción que crea
+-- el despacho; un dispatcher en segundo plano la entrega con reintentos
+-- (app/services/node_red/outbox.py).
+
+CREATE TABLE IF NOT EXISTS public.node_red_outbox (
+    id              bigserial PRIMARY KEY,
+    kind            text        NOT NULL,
+    payload         jsonb       NOT NULL,
+    created_at      timestamptz NOT NULL DEFAULT now(),
+    attempts        integer     NOT NULL DEFAULT 0,
+    next_attempt_at timestamptz NOT NULL DEFAULT now(),
+    delivered_at    timestamptz,
+    given_up_at     timestamptz,
+    last_error      text
+);
+
+CREATE INDEX IF NOT EXISTS node_red_outbox_pending_idx
+    ON public.node_red_outbox (next_attempt_at, id)
+    WHERE delivered_at IS NULL
+      AND given_up_at IS NULL;
@@ -0,0 +1,13 @@
+-- Clave de deduplicación de eventos Hik (dispositivo + serialNo,
+-- o hash del payload). El backend descarta en memoria los reintentos;
+-- este índice único cubre reinicios del proceso y claves desalojadas.
+--
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo sin BEGIN/COMMIT.
+
+ALTER TABLE public.access_event
+    ADD COLUMN IF NOT EXISTS dedupe_key text;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS access_event_dedupe_key_uidx
+    ON public.access_event (dedupe_key)
+    WHERE dedupe_key IS NOT NULL;
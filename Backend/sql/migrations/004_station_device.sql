@@ -0,0 +1,34 @@
+-- Mapeo dispositivo Hik -> estación.
+-- Permite que una sola instancia del backend atienda todos los
+-- cargaderos: el webhook resuelve station_id por IP de origen,
+-- serie, MAC o deviceID con un dict en memoria
+-- (app/services/hik/stations.py) que se recarga con NOTIFY.
+
+CREATE TABLE IF NOT EXISTS public.station_device (
+    kind       text        NOT NULL CHECK (kind IN ('ip', 'serial', 'mac', 'device_id')),
+    value      text        NOT NULL,
+    station_id text        NOT NULL REFERENCES public.station (id) ON DELETE CASCADE,
+    note       text,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, value)
+);
+
+CREATE INDEX IF NOT EXISTS station_device_station_idx
+    ON public.station_device (station_id);
+
+CREATE OR REPLACE FUNCTION public.notify_station_device_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('station_device_changed', '');
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS station_device_changed_notify ON public.station_device;
+
+CREATE TRIGGER station_device_changed_notify
+AFTER INSERT OR UPDATE OR DELETE ON public.station_device
+FOR EACH STATEMENT
+EXECUTE FUNCTION public.notify_station_device_changed();
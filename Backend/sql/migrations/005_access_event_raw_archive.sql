@@ -0,0 +1,19 @@
+-- Archivo comprimido de access_event.raw.
+-- app/services/hik/archive.py mueve acá (zlib) el raw de los eventos
+-- viejos y deja access_event.raw en NULL, para que la tabla principal
+-- quede chica. El espacio lo recupera autovacuum.
+
+ALTER TABLE public.access_event
+    ALTER COLUMN raw DROP NOT NULL;
+
+CREATE TABLE IF NOT EXISTS public.access_event_raw_archive (
+    event_id    bigint      PRIMARY KEY,
+    ts          timestamptz NOT NULL,
+    raw_z       bytea       NOT NULL,
+    archived_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- para encontrar rápido los candidatos a archivar
+CREATE INDEX IF NOT EXISTS access_event_ts_with_raw_idx
+    ON public.access_event (ts)
+    WHERE raw IS NOT NULL;
@@ -0,0 +1,14 @@
+-- Estado de subida por foto de cada despacho.
+-- { "file1": {"status": "pending"}, "file2": {"status": "uploaded", "url": "..."},
+--   "file3": {"status": "failed", "error": "..."} }
+-- En modo diferido el despacho se crea con las fotos en "pending" y
+-- app/services/storage/deferred.py las pasa a uploaded/failed.
+
+ALTER TABLE public.water_dispatch
+    ADD COLUMN IF NOT EXISTS photo_uploads jsonb;
+
+-- para encontrar rápido los despachos con subidas sin terminar
+CREATE INDEX IF NOT EXISTS water_dispatch_photo_uploads_pending_idx
+    ON public.water_dispatch (id)
+    WHERE photo_uploads IS NOT NULL
+      AND jsonb_path_exists(photo_uploads, '$.* ? (@.status == "pending")');
@@ -0,0 +1,7 @@
+-- Thumbnails de las fotos de cada despacho: {url_original: url_thumb}.
+-- Los genera app/services/storage/thumbs.py al subir cada foto; para las
+-- fotos anteriores correr:
+--     python -m app.services.storage.backfill_thumbs
+
+ALTER TABLE public.water_dispatch
+    ADD COLUMN IF NOT EXISTS thumb_paths jsonb;
@@ -0,0 +1,18 @@
+-- Índices para /water/dispatch/history (paginado por cursor sobre (ts, id)).
+-- Uno por filtro, todos terminando en (ts DESC, id DESC), así cada página
+-- es un range scan desde el cursor sin importar qué tan atrás esté.
+--
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo sin BEGIN/COMMIT.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS water_dispatch_ts_id_idx
+    ON public.water_dispatch (ts DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS water_dispatch_company_ts_id_idx
+    ON public.water_dispatch (company_id, ts DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS water_dispatch_station_ts_id_idx
+    ON public.water_dispatch (station_id, ts DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS water_dispatch_billing_status_ts_id_idx
+    ON public.water_dispatch (billing_status, ts DESC, id DESC);
@@ -0,0 +1,51 @@
+-- Avisa por NOTIFY cada alta o cambio en public.water_dispatch.
+-- El backend escucha el canal water_dispatch_changed con una sola
+-- conexión y lo reparte a los clientes de /water/dispatch/stream (SSE)
+-- (app/services/dispatch/stream.py).
+-- El payload es un resumen chico del despacho (NOTIFY admite hasta 8000 bytes).
+
+CREATE OR REPLACE FUNCTION public.notify_water_dispatch_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_company public.company%ROWTYPE;
+BEGIN
+    SELECT * INTO v_company
+    FROM public.company
+    WHERE id = NEW.company_id;
+
+    PERFORM pg_notify(
+        'water_dispatch_changed',
+        json_build_object(
+            'op', lower(TG_OP),
+            'id', NEW.id,
+            'ts', NEW.ts,
+            'station_id', NEW.station_id,
+            'company_id', NEW.company_id,
+            'company_code', v_company.code,
+            'company_name', v_company.name,
+            'liters', NEW.liters,
+            'flow_l_min', NEW.flow_l_min,
+            'billing_status', NEW.billing_status,
+            'amount', NEW.amount,
+            'photo_path', NEW.photo_path,
+            'photo_count', CASE
+                WHEN jsonb_typeof(NEW.photo_paths) = 'array'
+                THEN jsonb_array_length(NEW.photo_paths)
+                ELSE 0
+            END,
+            'note', left(NEW.note, 200)
+        )::text
+    );
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS water_dispatch_changed_notify ON public.water_dispatch;
+
+CREATE TRIGGER water_dispatch_changed_notify
+AFTER INSERT OR UPDATE ON public.water_dispatch
+FOR EACH ROW
+EXECUTE FUNCTION public.notify_water_dispatch_changed();
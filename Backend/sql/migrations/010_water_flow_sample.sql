@@ -0,0 +1,22 @@
+-- Muestras de caudalímetro por despacho (serie temporal, sólo inserts).
+-- Las escribe POST /water/telemetry con COPY, en lotes; los últimos
+-- liters/flow_l_min se vuelcan a water_dispatch cada pocos segundos
+-- (app/services/flow/telemetry.py).
+--
+-- Sin FK a water_dispatch a propósito: es una tabla de alto volumen
+-- y un id desconocido no debe hacer fallar el lote entero.
+
+CREATE TABLE IF NOT EXISTS public.water_flow_sample (
+    dispatch_id bigint      NOT NULL,
+    ts          timestamptz NOT NULL,
+    liters      real,
+    flow_l_min  real,
+    pulses      integer
+);
+
+CREATE INDEX IF NOT EXISTS water_flow_sample_dispatch_ts_idx
+    ON public.water_flow_sample (dispatch_id, ts);
+
+-- BRIN: chico y suficiente para recortar/consultar por rango de fechas
+CREATE INDEX IF NOT EXISTS water_flow_sample_ts_brin
+    ON public.water_flow_sample USING brin (ts);
@@ -0,0 +1,14 @@
+-- Cierre de despachos.
+-- closed_at/close_reason los completa el supervisor de caudal
+-- (app/services/flow/supervisor.py) cuando corta por falta de caudal,
+-- caudal fuera de rango o tope de litros, y /water/dispatch/{id}/liters
+-- cuando Node-RED informa los litros finales.
+-- Al arrancar, el backend reconstruye su estado con los despachos abiertos.
+
+ALTER TABLE public.water_dispatch
+    ADD COLUMN IF NOT EXISTS closed_at timestamptz,
+    ADD COLUMN IF NOT EXISTS close_reason text;
+
+CREATE INDEX IF NOT EXISTS water_dispatch_open_idx
+    ON public.water_dispatch (ts)
+    WHERE closed_at IS NULL;
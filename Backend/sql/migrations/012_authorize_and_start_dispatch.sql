@@ -0,0 +1,103 @@
+-- Autorización prepaga + alta del despacho en una sola llamada.
+-- Reemplaza authorize_company + insert_dispatch (varios round trips con
+-- la billetera bloqueada en el medio): ahora el bloqueo dura lo que
+-- tarda la función. Lo usa app/services/prepaid/billing.py.
+--
+-- Devuelve una fila con result_code:
+--   OK                              despacho creado (dispatch_id, dispatch_ts)
+--   PREPAID_ACCOUNT_NOT_AVAILABLE   empresa inactiva/inexistente o sin billetera
+--   INSUFFICIENT_MINIMUM_BALANCE    saldo < minimum_balance
+--   ACTIVE_DISPATCH_EXISTS          ya hay una carga activa (active_dispatch_id)
+
+CREATE OR REPLACE FUNCTION public.authorize_and_start_dispatch(
+    p_company_code text,
+    p_station_id   text,
+    p_photo_path   text,
+    p_photo_paths  jsonb,
+    p_photo_uploads jsonb,
+    p_note         text
+)
+RETURNS TABLE (
+    result_code           text,
+    dispatch_id           bigint,
+    dispatch_ts           timestamptz,
+    company_id            bigint,
+    company_name          text,
+    balance               numeric,
+    price_per_m3          numeric,
+    minimum_balance       numeric,
+    currency              text,
+    max_affordable_liters numeric,
+    active_dispatch_id    bigint
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    SELECT c.id, c.name, cw.balance, cfg.price_per_m3, cfg.minimum_balance, cfg.currency
+    INTO company_id, company_name, balance, price_per_m3, minimum_balance, currency
+    FROM public.company c
+    JOIN public.company_wallet cw
+      ON cw.company_id = c.id
+    CROSS JOIN public.water_billing_config cfg
+    WHERE c.code = p_company_code
+      AND c.active
+      AND cfg.id = 1
+    FOR UPDATE OF cw;
+
+    IF NOT FOUND THEN
+        result_code := 'PREPAID_ACCOUNT_NOT_AVAILABLE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    IF balance < minimum_balance THEN
+        result_code := 'INSUFFICIENT_MINIMUM_BALANCE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    SELECT wd.id
+    INTO active_dispatch_id
+    FROM public.water_dispatch wd
+    WHERE wd.company_id = authorize_and_start_dispatch.company_id
+      AND wd.billing_status = 'active'
+    LIMIT 1;
+
+    IF active_dispatch_id IS NOT NULL THEN
+        result_code := 'ACTIVE_DISPATCH_EXISTS';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- igual que calculate_max_affordable_liters()
+    max_affordable_liters := (GREATEST(balance, 0) / price_per_m3) * 1000;
+
+    INSERT INTO public.water_dispatch (
+        station_id,
+        company_id,
+        photo_path,
+        photo_paths,
+        photo_uploads,
+        note,
+        billing_status,
+        price_per_m3,
+        max_affordable_liters
+    )
+    VALUES (
+        p_station_id,
+        authorize_and_start_dispatch.company_id,
+        p_photo_path,
+        COALESCE(p_photo_paths, '[]'::jsonb),
+        p_photo_uploads,
+        p_note,
+        'active',
+        authorize_and_start_dispatch.price_per_m3,
+        max_affordable_liters
+    )
+    RETURNING id, ts
+    INTO dispatch_id, dispatch_ts;
+
+    result_code := 'OK';
+    RETURN NEXT;
+END;
+$$;
@@ -0,0 +1,124 @@
+-- Una sola carga prepaga activa por empresa.
+--
+-- El chequeo de "ya tiene una carga activa" se responde desde memoria
+-- (app/services/prepaid/active.py); este índice es el que garantiza
+-- la regla cuando dos estaciones autorizan a la misma empresa a la vez,
+-- y de paso hace barata la búsqueda de la carga activa en la DB.
+--
+-- Antes de crearlo, verificar que no haya duplicados:
+--   SELECT company_id, array_agg(id)
+--   FROM public.water_dispatch
+--   WHERE billing_status = 'active'
+--   GROUP BY company_id
+--   HAVING count(*) > 1;
+--
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo sin BEGIN/COMMIT.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS water_dispatch_one_active_per_company
+    ON public.water_dispatch (company_id)
+    WHERE billing_status = 'active';
+
+-- authorize_and_start_dispatch (migración 012): el chequeo de carga
+-- activa pasa a ser el propio índice. Si el INSERT choca, se devuelve
+-- ACTIVE_DISPATCH_EXISTS con el id de la carga que ganó.
+
+CREATE OR REPLACE FUNCTION public.authorize_and_start_dispatch(
+    p_company_code text,
+    p_station_id   text,
+    p_photo_path   text,
+    p_photo_paths  jsonb,
+    p_photo_uploads jsonb,
+    p_note         text
+)
+RETURNS TABLE (
+    result_code           text,
+    dispatch_id           bigint,
+    dispatch_ts           timestamptz,
+    company_id            bigint,
+    company_name          text,
+    balance               numeric,
+    price_per_m3          numeric,
+    minimum_balance       numeric,
+    currency              text,
+    max_affordable_liters numeric,
+    active_dispatch_id    bigint
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_constraint text;
+BEGIN
+    SELECT c.id, c.name, cw.balance, cfg.price_per_m3, cfg.minimum_balance, cfg.currency
+    INTO company_id, company_name, balance, price_per_m3, minimum_balance, currency
+    FROM public.company c
+    JOIN public.company_wallet cw
+      ON cw.company_id = c.id
+    CROSS JOIN public.water_billing_config cfg
+    WHERE c.code = p_company_code
+      AND c.active
+      AND cfg.id = 1
+    FOR UPDATE OF cw;
+
+    IF NOT FOUND THEN
+        result_code := 'PREPAID_ACCOUNT_NOT_AVAILABLE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    IF balance < minimum_balance THEN
+        result_code := 'INSUFFICIENT_MINIMUM_BALANCE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- igual que calculate_max_affordable_liters()
+    max_affordable_liters := (GREATEST(balance, 0) / price_per_m3) * 1000;
+
+    BEGIN
+        INSERT INTO public.water_dispatch (
+            station_id,
+            company_id,
+            photo_path,
+            photo_paths,
+            photo_uploads,
+            note,
+            billing_status,
+            price_per_m3,
+            max_affordable_liters
+        )
+        VALUES (
+            p_station_id,
+            authorize_and_start_dispatch.company_id,
+            p_photo_path,
+            COALESCE(p_photo_paths, '[]'::jsonb),
+            p_photo_uploads,
+            p_note,
+            'active',
+            authorize_and_start_dispatch.price_per_m3,
+            max_affordable_liters
+        )
+        RETURNING id, ts
+        INTO dispatch_id, dispatch_ts;
+    EXCEPTION WHEN unique_violation THEN
+        GET STACKED DIAGNOSTICS v_constraint = CONSTRAINT_NAME;
+
+        IF v_constraint IS DISTINCT FROM 'water_dispatch_one_active_per_company' THEN
+            RAISE;
+        END IF;
+
+        SELECT wd.id
+        INTO active_dispatch_id
+        FROM public.water_dispatch wd
+        WHERE wd.company_id = authorize_and_start_dispatch.company_id
+          AND wd.billing_status = 'active';
+
+        result_code := 'ACTIVE_DISPATCH_EXISTS';
+        RETURN NEXT;
+        RETURN;
+    END;
+
+    result_code := 'OK';
+    RETURN NEXT;
+END;
+$$;
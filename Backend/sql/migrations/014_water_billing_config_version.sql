@@ -0,0 +1,157 @@
+-- Versión de public.water_billing_config.
+--
+-- El backend guarda la fila en memoria (app/services/prepaid/config.py)
+-- y la vuelve a leer cuando llega el NOTIFY water_billing_config_changed;
+-- el payload es la versión nueva. Cada UPDATE suma 1 a version.
+--
+-- water_dispatch.billing_config_version guarda con qué versión de la
+-- tarifa se autorizó cada despacho prepago.
+
+ALTER TABLE public.water_billing_config
+    ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;
+
+ALTER TABLE public.water_dispatch
+    ADD COLUMN IF NOT EXISTS billing_config_version integer;
+
+CREATE OR REPLACE FUNCTION public.bump_water_billing_config_version()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS water_billing_config_version ON public.water_billing_config;
+
+CREATE TRIGGER water_billing_config_version
+BEFORE UPDATE ON public.water_billing_config
+FOR EACH ROW
+EXECUTE FUNCTION public.bump_water_billing_config_version();
+
+CREATE OR REPLACE FUNCTION public.notify_water_billing_config_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify(
+        'water_billing_config_changed',
+        CASE WHEN TG_OP = 'DELETE' THEN '' ELSE NEW.version::text END
+    );
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS water_billing_config_changed_notify ON public.water_billing_config;
+
+CREATE TRIGGER water_billing_config_changed_notify
+AFTER INSERT OR UPDATE OR DELETE ON public.water_billing_config
+FOR EACH ROW
+EXECUTE FUNCTION public.notify_water_billing_config_changed();
+
+-- authorize_and_start_dispatch ya no lee water_billing_config: recibe
+-- la tarifa (y su versión) desde el cache del backend.
+
+DROP FUNCTION IF EXISTS public.authorize_and_start_dispatch(text, text, text, jsonb, jsonb, text);
+
+CREATE OR REPLACE FUNCTION public.authorize_and_start_dispatch(
+    p_company_code    text,
+    p_station_id      text,
+    p_photo_path      text,
+    p_photo_paths     jsonb,
+    p_photo_uploads   jsonb,
+    p_note            text,
+    p_price_per_m3    numeric,
+    p_minimum_balance numeric,
+    p_config_version  integer
+)
+RETURNS TABLE (
+    result_code           text,
+    dispatch_id           bigint,
+    dispatch_ts           timestamptz,
+    company_id            bigint,
+    company_name          text,
+    balance               numeric,
+    max_affordable_liters numeric,
+    active_dispatch_id    bigint
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_constraint text;
+BEGIN
+    SELECT c.id, c.name, cw.balance
+    INTO company_id, company_name, balance
+    FROM public.company c
+    JOIN public.company_wallet cw
+      ON cw.company_id = c.id
+    WHERE c.code = p_company_code
+      AND c.active
+    FOR UPDATE OF cw;
+
+    IF NOT FOUND THEN
+        result_code := 'PREPAID_ACCOUNT_NOT_AVAILABLE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    IF balance < p_minimum_balance THEN
+        result_code := 'INSUFFICIENT_MINIMUM_BALANCE';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- igual que calculate_max_affordable_liters()
+    max_affordable_liters := (GREATEST(balance, 0) / p_price_per_m3) * 1000;
+
+    BEGIN
+        INSERT INTO public.water_dispatch (
+            station_id,
+            company_id,
+            photo_path,
+            photo_paths,
+            photo_uploads,
+            note,
+            billing_status,
+            price_per_m3,
+            max_affordable_liters,
+            billing_config_version
+        )
+        VALUES (
+            p_station_id,
+            authorize_and_start_dispatch.company_id,
+            p_photo_path,
+            COALESCE(p_photo_paths, '[]'::jsonb),
+            p_photo_uploads,
+            p_note,
+            'active',
+            p_price_per_m3,
+            max_affordable_liters,
+            p_config_version
+        )
+        RETURNING id, ts
+        INTO dispatch_id, dispatch_ts;
+    EXCEPTION WHEN unique_violation THEN
+        GET STACKED DIAGNOSTICS v_constraint = CONSTRAINT_NAME;
+
+        IF v_constraint IS DISTINCT FROM 'water_dispatch_one_active_per_company' THEN
+            RAISE;
+        END IF;
+
+        SELECT wd.id
+        INTO active_dispatch_id
+        FROM public.water_dispatch wd
+        WHERE wd.company_id = authorize_and_start_dispatch.company_id
+          AND wd.billing_status = 'active';
+
+        result_code := 'ACTIVE_DISPATCH_EXISTS';
+        RETURN NEXT;
+        RETURN;
+    END;
+
+    result_code := 'OK';
+    RETURN NEXT;
+END;
+$$;
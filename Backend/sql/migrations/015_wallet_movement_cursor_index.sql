@@ -0,0 +1,9 @@
+-- Índice para /wallet/company/{code}/movements (paginado por cursor
+-- sobre (created_at, id)) y para los movimientos de un mes en
+-- /wallet/company/{code}/statement.
+--
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo sin BEGIN/COMMIT.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS wallet_movement_company_created_id_idx
+    ON public.wallet_movement (company_id, created_at DESC, id DESC);
@@ -0,0 +1,119 @@
+-- Resumen mensual de saldo por empresa (meses en UTC).
+--
+-- Un trigger lo mantiene al día con cada INSERT en wallet_movement, así
+-- un extracto de cualquier período sale de estas filas más los
+-- movimientos de los meses incompletos de los bordes, sin recorrer todo
+-- el historial (ver /wallet/company/{code}/statement).
+--
+-- wallet_movement es append-only: el trigger sólo atiende INSERT.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.wallet_balance_snapshot (
+    company_id         bigint        NOT NULL,
+    month              date          NOT NULL,
+    opening_balance    numeric(14,2) NOT NULL,
+    closing_balance    numeric(14,2) NOT NULL,
+    credits            numeric(14,2) NOT NULL DEFAULT 0,
+    debits             numeric(14,2) NOT NULL DEFAULT 0,
+    movement_count     integer       NOT NULL DEFAULT 0,
+    first_movement_id  bigint        NOT NULL,
+    last_movement_id   bigint        NOT NULL,
+    updated_at         timestamptz   NOT NULL DEFAULT now(),
+    PRIMARY KEY (company_id, month)
+);
+
+CREATE OR REPLACE FUNCTION public.wallet_balance_snapshot_apply()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO public.wallet_balance_snapshot AS s (
+        company_id,
+        month,
+        opening_balance,
+        closing_balance,
+        credits,
+        debits,
+        movement_count,
+        first_movement_id,
+        last_movement_id
+    )
+    VALUES (
+        NEW.company_id,
+        date_trunc('month', NEW.created_at AT TIME ZONE 'UTC')::date,
+        NEW.balance_after - NEW.amount,
+        NEW.balance_after,
+        GREATEST(NEW.amount, 0),
+        GREATEST(-NEW.amount, 0),
+        1,
+        NEW.id,
+        NEW.id
+    )
+    ON CONFLICT (company_id, month) DO UPDATE SET
+        -- los movimientos de una empresa se escriben con la billetera
+        -- bloqueada, así que el id más alto es el saldo más nuevo
+        opening_balance = CASE
+            WHEN NEW.id < s.first_movement_id THEN EXCLUDED.opening_balance
+            ELSE s.opening_balance
+        END,
+        closing_balance = CASE
+            WHEN NEW.id > s.last_movement_id THEN EXCLUDED.closing_balance
+            ELSE s.closing_balance
+        END,
+        credits = s.credits + EXCLUDED.credits,
+        debits = s.debits + EXCLUDED.debits,
+        movement_count = s.movement_count + 1,
+        first_movement_id = LEAST(s.first_movement_id, NEW.id),
+        last_movement_id = GREATEST(s.last_movement_id, NEW.id),
+        updated_at = now();
+
+    RETURN NULL;
+END;
+$$;
+
+-- sin escrituras en wallet_movement mientras se arma la historia
+LOCK TABLE public.wallet_movement IN SHARE MODE;
+
+DROP TRIGGER IF EXISTS wallet_balance_snapshot_apply ON public.wallet_movement;
+
+CREATE TRIGGER wallet_balance_snapshot_apply
+AFTER INSERT ON public.wallet_movement
+FOR EACH ROW
+EXECUTE FUNCTION public.wallet_balance_snapshot_apply();
+
+TRUNCATE public.wallet_balance_snapshot;
+
+INSERT INTO public.wallet_balance_snapshot (
+    company_id,
+    month,
+    opening_balance,
+    closing_balance,
+    credits,
+    debits,
+    movement_count,
+    first_movement_id,
+    last_movement_id
+)
+SELECT
+    company_id,
+    month,
+    (array_agg(balance_after - amount ORDER BY id))[1],
+    (array_agg(balance_after ORDER BY id DESC))[1],
+    sum(GREATEST(amount, 0)),
+    sum(GREATEST(-amount, 0)),
+    count(*),
+    min(id),
+    max(id)
+FROM (
+    SELECT
+        company_id,
+        id,
+        amount,
+        balance_after,
+        date_trunc('month', created_at AT TIME ZONE 'UTC')::date AS month
+    FROM public.wallet_movement
+) m
+GROUP BY company_id, month;
+
+COMMIT;
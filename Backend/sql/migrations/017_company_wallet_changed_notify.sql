@@ -0,0 +1,29 @@
+-- Avisa por NOTIFY cada cambio en public.company_wallet.
+-- El backend escucha el canal company_wallet_changed y descarta el
+-- saldo que tenía en memoria (app/services/prepaid/wallet_cache.py).
+-- El payload es el company_id de la billetera.
+--
+-- Como NOTIFY sale recién en el commit, también cubre a otros procesos
+-- y a lecturas que volvieron a cargar el saldo viejo antes del commit.
+
+CREATE OR REPLACE FUNCTION public.notify_company_wallet_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('company_wallet_changed', OLD.company_id::text);
+    ELSE
+        PERFORM pg_notify('company_wallet_changed', NEW.company_id::text);
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS company_wallet_changed_notify ON public.company_wallet;
+
+CREATE TRIGGER company_wallet_changed_notify
+AFTER INSERT OR UPDATE OR DELETE ON public.company_wallet
+FOR EACH ROW
+EXECUTE FUNCTION public.notify_company_wallet_changed();
@@ -0,0 +1,42 @@
+-- Limita el NOTIFY water_dispatch_changed (migración 009) a los cambios
+-- que les importan a sus consumidores: el SSE /water/dispatch/stream y
+-- el registro de despachos activos (app/services/prepaid/active.py).
+--
+-- Antes disparaba en cada UPDATE, incluido el volcado de telemetría cada
+-- pocos segundos (liters/flow_l_min de despachos abiertos) y los UPDATE
+-- de photo_uploads/thumb_paths del subidor diferido y las miniaturas.
+-- Ahora un UPDATE avisa sólo si cambia el estado de cobro o de cierre,
+-- la empresa/estación, el monto, las fotos o la nota, o los litros de
+-- un despacho ya cerrado (la corrección de litros finales).
+--
+-- WHEN no puede usar OLD en un trigger de INSERT, así que el alta y el
+-- cambio van en dos triggers que llaman a la misma función.
+
+DROP TRIGGER IF EXISTS water_dispatch_changed_notify ON public.water_dispatch;
+DROP TRIGGER IF EXISTS water_dispatch_changed_notify_insert ON public.water_dispatch;
+DROP TRIGGER IF EXISTS water_dispatch_changed_notify_update ON public.water_dispatch;
+
+CREATE TRIGGER water_dispatch_changed_notify_insert
+AFTER INSERT ON public.water_dispatch
+FOR EACH ROW
+EXECUTE FUNCTION public.notify_water_dispatch_changed();
+
+CREATE TRIGGER water_dispatch_changed_notify_update
+AFTER UPDATE ON public.water_dispatch
+FOR EACH ROW
+WHEN (
+    OLD.billing_status IS DISTINCT FROM NEW.billing_status
+    OR OLD.closed_at IS DISTINCT FROM NEW.closed_at
+    OR OLD.close_reason IS DISTINCT FROM NEW.close_reason
+    OR OLD.company_id IS DISTINCT FROM NEW.company_id
+    OR OLD.station_id IS DISTINCT FROM NEW.station_id
+    OR OLD.amount IS DISTINCT FROM NEW.amount
+    OR OLD.photo_path IS DISTINCT FROM NEW.photo_path
+    OR OLD.photo_paths IS DISTINCT FROM NEW.photo_paths
+    OR OLD.note IS DISTINCT FROM NEW.note
+    OR (
+        NEW.closed_at IS NOT NULL
+        AND OLD.liters IS DISTINCT FROM NEW.liters
+    )
+)
+EXECUTE FUNCTION public.notify_water_dispatch_changed();
@@ -0,0 +1,157 @@
+import os
+import re
+import sys
+from decimal import Decimal
+from typing import Any, Optional
+
+import pytest
+
+# app.db arma el pool al importarse (sin abrirlo): alcanza con una URL
+os.environ.setdefault("DATABASE_URL", "postgresql://test@localhost/test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeBillingDB:
+    """
+    water_dispatch, company_wallet y wallet_movement en memoria.
+
+    FakeBillingDB.cursor() entiende sólo las sentencias de
+    _close_dispatches / settle_dispatches (se reconocen por su forma),
+    así los tests corren sin Postgres.
+    """
+
+    def __init__(self) -> None:
+        self.dispatches: dict[int, dict[str, Any]] = {}
+        self.wallets: dict[int, Decimal] = {}
+        self.movements: list[tuple[Any, ...]] = []
+
+    def add_dispatch(
+        self,
+        dispatch_id: int,
+        company_id: int,
+        billing_status: Optional[str] = None,
+        price_per_m3: Optional[str] = None,
+    ) -> None:
+        self.dispatches[dispatch_id] = {
+            "company_id": company_id,
+            "billing_status": billing_status,
+            "price_per_m3": Decimal(price_per_m3) if price_per_m3 else None,
+            "liters": None,
+            "amount": None,
+            "closed_at": None,
+            "close_reason": None,
+        }
+
+    def cursor(self) -> "FakeCursor":
+        return FakeCursor(self)
+
+    def connection(self) -> "FakeConnection":
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    """
+    Reemplazo de pool.connection(): async with ... as conn / conn.cursor().
+    """
+
+    def __init__(self, db: FakeBillingDB) -> None:
+        self.db = db
+
+    async def __aenter__(self) -> "FakeConnection":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        return None
+
+    def cursor(self) -> "FakeCursor":
+        return self.db.cursor()
+
+
+class FakeCursor:
+    def __init__(self, db: FakeBillingDB) -> None:
+        self.db = db
+        self._rows: list[tuple[Any, ...]] = []
+
+    async def __aenter__(self) -> "FakeCursor":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        return None
+
+    async def execute(self, sql: str, params: tuple[Any, ...] = ()) -> None:
+        q = re.sub(r"\s+", " ", sql).strip()
+        db = self.db
+        self._rows = []
+
+        if q.startswith("UPDATE public.water_dispatch wd SET liters = v.liters, closed_at"):
+            ids, liters, only_unbilled = params
+            for dispatch_id, value in zip(ids, liters):
+                d = db.dispatches.get(dispatch_id)
+                if d is None or (only_unbilled and d["billing_status"] is not None):
+                    continue
+                d["liters"] = Decimal(str(value))
+                d["closed_at"] = d["closed_at"] or "now"
+                d["close_reason"] = d["close_reason"] or "liters_reported"
+                self._rows.append((dispatch_id,))
+
+        elif q.startswith("SELECT id, liters FROM public.water_dispatch WHERE billing_status = 'active'"):
+            # el plazo de gracia no se simula: todo lo cerrado está vencido
+            _grace, excluded = params
+            self._rows = [
+                (i, d["liters"])
+                for i, d in sorted(db.dispatches.items())
+                if d["billing_status"] == "active"
+                and d["closed_at"] is not None
+                and d["liters"] is not None
+                and i not in excluded
+            ]
+
+        elif q.startswith("SELECT cw.company_id, cw.balance FROM public.company_wallet"):
+            (ids,) = params
+            companies = {db.dispatches[i]["company_id"] for i in ids if i in db.dispatches}
+            self._rows = sorted((c, b) for c, b in db.wallets.items() if c in companies)
+
+        elif q.startswith("SELECT id, company_id, billing_status, price_per_m3, liters, amount"):
+            (ids,) = params
+            self._rows = [
+                (i, d["company_id"], d["billing_status"], d["price_per_m3"], d["liters"], d["amount"])
+                for i, d in sorted(db.dispatches.items())
+                if i in ids
+            ]
+
+        elif q.startswith("UPDATE public.company_wallet"):
+            for company_id, balance in zip(*params):
+                db.wallets[company_id] = balance
+
+        elif q.startswith("UPDATE public.water_dispatch wd SET liters = v.liters, amount"):
+            for dispatch_id, liters, amount in zip(*params):
+                db.dispatches[dispatch_id].update(liters=liters, amount=amount, billing_status="completed")
+
+        elif q.startswith("INSERT INTO public.wallet_movement"):
+            db.movements.extend(zip(*params))
+
+        elif q.startswith("UPDATE public.water_dispatch SET closed_at"):
+            (ids,) = params
+            for dispatch_id in ids:
+                d = db.dispatches[dispatch_id]
+                d["closed_at"] = d["closed_at"] or "now"
+                d["close_reason"] = d["close_reason"] or "liters_reported"
+
+        else:
+            raise AssertionError(f"sentencia inesperada: {q[:80]}")
+
+    async def fetchall(self) -> list[tuple[Any, ...]]:
+        return self._rows
+
+    async def fetchone(self) -> Optional[tuple[Any, ...]]:
+        return self._rows[0] if self._rows else None
+
+
+@pytest.fixture
+def billing_db() -> FakeBillingDB:
+    return FakeBillingDB()
+
+
+@pytest.fixture
+def prepaid(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PREPAID_ENABLED", "true")
@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+import itertools
+
+from app.routes import hik
+from app.routes.hik import AccessEventWriter
+
+
+def event(key):
+    return {
+        "station_id": "S1",
+        "ts": datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc),
+        "granted": True,
+        "result": "AccessControllerEvent",
+        "reason": "",
+        "door_index": 1,
+        "reader_index": 1,
+        "person_id": "1",
+        "person_name": "",
+        "credential_type": "password",
+        "credential_value": "",
+        "direction": "",
+        "pic_url": "",
+        "raw": {},
+        "dedupe_key": key,
+    }
+
+
+class FakeTable:
+    """
+    access_event en memoria con el índice único de dedupe_key.
+    """
+
+    def __init__(self, existing=None):
+        self.by_key = dict(existing or {})
+        self.rows = {}
+        self.fail = 0
+
+    async def write(self, batch):
+        if self.fail:
+            self.fail -= 1
+            raise OSError("db down")
+        existing = {}
+        for row in batch:
+            event_id, key = row[0], row[-1]
+            if key in self.by_key:
+                existing[event_id] = self.by_key[key]
+                continue
+            self.by_key[key] = event_id
+            self.rows[event_id] = row
+        return existing
+
+
+def writer(monkeypatch, table, tmp_path):
+    w = AccessEventWriter(batch_size=50, flush_ms=10, queue_max=100, id_block=10)
+    ids = itertools.count(100)
+
+    async def next_id():
+        return next(ids)
+
+    monkeypatch.setattr(w, "_next_id", next_id)
+    monkeypatch.setattr(w, "_write", table.write)
+    monkeypatch.setattr(hik, "HIK_EVENT_SPILL_FILE", str(tmp_path / "spill.jsonl"))
+    monkeypatch.setattr(hik, "HIK_EVENT_RETRY_S", 0.01)
+    return w
+
+
+def test_batches_concurrent_events(monkeypatch, tmp_path):
+    table = FakeTable()
+    w = writer(monkeypatch, table, tmp_path)
+
+    async def main():
+        await w.start()
+        ids = await asyncio.gather(*(w.submit(event(f"k{i}")) for i in range(5)))
+        await w.stop()
+        return ids
+
+    ids = asyncio.run(main())
+
+    assert sorted(ids) == [100, 101, 102, 103, 104]
+    assert set(table.rows) == set(ids)
+    assert w.stats()["written"] == 5
+
+
+def test_duplicate_returns_existing_id(monkeypatch, tmp_path):
+    # reintento de Hik después de un reinicio: el dedupe_key ya está en la tabla
+    table = FakeTable(existing={"k1": 7})
+    w = writer(monkeypatch, table, tmp_path)
+
+    async def main():
+        await w.start()
+        ids = await asyncio.gather(w.submit(event("k1")), w.submit(event("k2")), w.submit(event("k2")))
+        await w.stop()
+        return ids
+
+    first, second, third = asyncio.run(main())
+
+    assert first == 7
+    assert second == third
+    assert second in table.rows
+    assert w.stats()["duplicates"] == 2
+
+
+def test_failed_batch_is_kept_and_retried(monkeypatch, tmp_path):
+    table = FakeTable()
+    table.fail = 4
+    w = writer(monkeypatch, table, tmp_path)
+    monkeypatch.setattr(asyncio, "sleep", _fast_sleep)
+
+    async def main():
+        await w.start()
+        event_id = await w.submit(event("k1"))
+        while w.pending():
+            await _real_sleep(0.01)
+        await w.stop()
+        return event_id
+
+    event_id = asyncio.run(main())
+
+    assert event_id in table.rows
+    assert w.stats()["failed_batches"] == 1
+
+
+def test_unwritten_events_spill_on_stop_and_reload(monkeypatch, tmp_path):
+    table = FakeTable()
+    table.fail = 10**6
+    w = writer(monkeypatch, table, tmp_path)
+    monkeypatch.setattr(asyncio, "sleep", _fast_sleep)
+
+    async def main():
+        await w.start()
+        await w.submit(event("k1"))
+        await w.stop()
+
+        assert (tmp_path / "spill.jsonl").exists()
+        assert table.rows == {}
+
+        table.fail = 0
+        await w.start()
+        while w.pending():
+            await _real_sleep(0.01)
+        await w.stop()
+
+    asyncio.run(main())
+
+    assert not (tmp_path / "spill.jsonl").exists()
+    assert list(table.rows) == [100]
+
+
+_real_sleep = asyncio.sleep
+
+
+async def _fast_sleep(delay, *args, **kwargs):
+    await _real_sleep(0)
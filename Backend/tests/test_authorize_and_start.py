@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+
+from app.routes import hik
+from app.services.prepaid import billing
+from app.services.prepaid.active import ActiveDispatchRegistry
+
+
+CONFIG = {
+    "price_per_m3": Decimal("100"),
+    "minimum_balance": Decimal("50"),
+    "currency": "ARS",
+    "version": 3,
+}
+TS = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FunctionCursor:
+    """
+    Devuelve una fila fija como resultado de authorize_and_start_dispatch().
+    """
+
+    def __init__(self, row):
+        self.row = row
+        self.params = None
+
+    def connection(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
+
+    async def execute(self, sql, params):
+        self.params = params
+
+    async def fetchone(self):
+        return self.row
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    fresh = ActiveDispatchRegistry()
+    monkeypatch.setattr(billing, "active_dispatches", fresh)
+    monkeypatch.setattr(hik, "active_dispatches", fresh)
+
+    async def get():
+        return CONFIG
+
+    monkeypatch.setattr(billing.billing_config, "get", get)
+    return fresh
+
+
+def start(row):
+    return asyncio.run(
+        billing.start_prepaid_dispatch(
+            FunctionCursor(row),
+            company_code="1",
+            company_id=10,
+            station_id="S1",
+            photo_path=None,
+            photo_paths=None,
+            photo_uploads=None,
+            note=None,
+        )
+    )
+
+
+def test_ok_returns_billing(registry):
+    result = start(("OK", 55, TS, 10, "Empresa", Decimal("500"), Decimal("5000"), None))
+
+    assert result["dispatch_id"] == 55
+    assert result["max_affordable_liters"] == Decimal("5000")
+    assert result["billing_config_version"] == 3
+
+
+@pytest.mark.parametrize(
+    "row, status, code",
+    [
+        (("PREPAID_ACCOUNT_NOT_AVAILABLE", None, None, None, None, None, None, None), 402, "PREPAID_ACCOUNT_NOT_AVAILABLE"),
+        (("INSUFFICIENT_MINIMUM_BALANCE", None, None, 10, "Empresa", Decimal("10"), None, None), 402, "INSUFFICIENT_MINIMUM_BALANCE"),
+        (("ACTIVE_DISPATCH_EXISTS", None, None, 10, "Empresa", Decimal("500"), Decimal("5000"), 44), 409, "ACTIVE_DISPATCH_EXISTS"),
+    ],
+)
+def test_result_codes_map_to_http_errors(registry, row, status, code):
+    with pytest.raises(HTTPException) as e:
+        start(row)
+
+    assert e.value.status_code == status
+    assert e.value.detail["code"] == code
+
+
+def test_lost_race_registers_the_winner(registry):
+    with pytest.raises(HTTPException) as e:
+        start(("ACTIVE_DISPATCH_EXISTS", None, None, 10, "Empresa", Decimal("500"), Decimal("5000"), 44))
+
+    assert e.value.detail["dispatch_id"] == 44
+    assert registry.get(10) == 44
+
+
+def test_known_active_dispatch_skips_the_db(registry):
+    registry.add(10, 44)
+
+    with pytest.raises(HTTPException) as e:
+        start(None)
+
+    assert e.value.status_code == 409
+
+
+def pin_event():
+    return {
+        "station_id": "S1",
+        "ts": TS,
+        "granted": True,
+        "result": "AccessControllerEvent",
+        "reason": "",
+        "door_index": 1,
+        "reader_index": 1,
+        "person_id": "1",
+        "person_name": "",
+        "credential_type": "password",
+        "credential_value": "",
+        "direction": "",
+        "pic_url": "",
+        "raw": {},
+        "dedupe_key": "k1",
+    }
+
+
+COMPANY = {"id": 10, "code": "1", "name": "Empresa", "active": True}
+
+
+def start_pin(monkeypatch, row):
+    monkeypatch.setattr(hik, "pool", FunctionCursor(row))
+    return asyncio.run(hik.insert_event_and_start_prepaid_dispatch(pin_event(), COMPANY, CONFIG))
+
+
+def test_pin_ok_opens_prepaid_dispatch(monkeypatch, registry):
+    event_id, info = start_pin(monkeypatch, (7, "OK", 55, TS, Decimal("500"), Decimal("5000"), None))
+
+    assert event_id == 7
+    assert info["dispatch_id"] == 55
+    assert info["max_affordable_liters"] == Decimal("5000")
+
+
+def test_pin_rejected_keeps_event_and_reports_code(monkeypatch, registry):
+    event_id, info = start_pin(monkeypatch, (7, "INSUFFICIENT_MINIMUM_BALANCE", None, None, Decimal("10"), None, None))
+
+    assert event_id == 7
+    assert info["billing_error"]["code"] == "INSUFFICIENT_MINIMUM_BALANCE"
+    assert info["billing_error"]["balance"] == 10.0
+
+
+def test_pin_duplicate_event(monkeypatch, registry):
+    assert start_pin(monkeypatch, None) == (None, None)
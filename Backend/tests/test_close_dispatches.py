@@ -0,0 +1,55 @@
+import asyncio
+from decimal import Decimal
+
+from app.routes.water import _close_dispatches
+
+
+def close(db, items):
+    return asyncio.run(_close_dispatches(db.cursor(), items))
+
+
+def test_without_prepaid_closes_every_dispatch(billing_db, monkeypatch):
+    monkeypatch.setenv("PREPAID_ENABLED", "false")
+    billing_db.add_dispatch(1, company_id=10)
+
+    results = close(billing_db, [(1, 500.0)])
+
+    assert results[1] == {"ok": True, "liters": 500.0}
+    assert billing_db.dispatches[1]["liters"] == Decimal("500.0")
+    assert billing_db.dispatches[1]["closed_at"] is not None
+
+
+def test_prepaid_settles_active_dispatch(billing_db, prepaid):
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+
+    results = close(billing_db, [(1, 2000.0)])
+
+    assert results[1]["ok"]
+    assert results[1]["amount"] == Decimal("200.00")
+    assert billing_db.wallets[10] == Decimal("800.00")
+    assert billing_db.dispatches[1]["billing_status"] == "completed"
+    assert billing_db.dispatches[1]["closed_at"] is not None
+
+
+def test_prepaid_closes_dispatch_without_billing(billing_db, prepaid):
+    # PIN de Hik o despacho anterior a activar el prepago: no se cobra,
+    # pero los litros se guardan y el despacho se cierra
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status=None)
+
+    results = close(billing_db, [(1, 700.0)])
+
+    assert results[1] == {"ok": True, "liters": 700.0}
+    assert billing_db.dispatches[1]["liters"] == Decimal("700.0")
+    assert billing_db.dispatches[1]["closed_at"] is not None
+    assert billing_db.dispatches[1]["billing_status"] is None
+    assert billing_db.wallets[10] == Decimal("1000")
+    assert billing_db.movements == []
+
+
+def test_missing_dispatch_is_404(billing_db, prepaid):
+    results = close(billing_db, [(99, 10.0)])
+
+    assert results[99]["ok"] is False
+    assert results[99]["status"] == 404
@@ -0,0 +1,46 @@
+import asyncio
+
+from app.services.company.registry import CompanyRegistry
+
+
+def company(code, active=True):
+    return {"id": int(code), "name": f"Empresa {code}", "code": code, "active": active}
+
+
+def registry(monkeypatch, db):
+    reg = CompanyRegistry()
+    reg._ready = True
+    calls = []
+
+    async def fetch(code):
+        calls.append(code)
+        return db.get(code)
+
+    monkeypatch.setattr(reg, "_fetch", fetch)
+    return reg, calls
+
+
+def test_miss_reads_db_once_and_caches(monkeypatch):
+    # creada mientras LISTEN estaba caído: no está en memoria
+    reg, calls = registry(monkeypatch, {"5": company("5")})
+
+    assert asyncio.run(reg.get_active("5"))["id"] == 5
+    assert asyncio.run(reg.get_active("5"))["id"] == 5
+    assert calls == ["5"]
+    assert reg.stats()["hits"] == 1
+
+
+def test_unknown_code_is_none(monkeypatch):
+    reg, calls = registry(monkeypatch, {})
+
+    assert asyncio.run(reg.get("9")) is None
+    assert calls == ["9"]
+    assert reg.stats()["size"] == 0
+
+
+def test_inactive_entry_is_rechecked(monkeypatch):
+    reg, calls = registry(monkeypatch, {"5": company("5")})
+    reg._by_code["5"] = company("5", active=False)
+
+    assert asyncio.run(reg.get_active("5"))["active"]
+    assert calls == ["5"]
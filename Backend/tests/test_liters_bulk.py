@@ -0,0 +1,43 @@
+import asyncio
+from decimal import Decimal
+
+from app.routes import water
+from app.routes.water import BulkLitersIn, set_liters_bulk
+
+
+def bulk(db, monkeypatch, items):
+    monkeypatch.setattr(water, "pool", db)
+    body = BulkLitersIn(items=[{"dispatch_id": i, "liters": l} for i, l in items])
+    return asyncio.run(set_liters_bulk(body))
+
+
+def test_bulk_replay_mixes_billed_and_unbilled(billing_db, prepaid, monkeypatch):
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(2, company_id=10, billing_status=None)
+    billing_db.add_dispatch(3, company_id=20, billing_status=None)
+
+    result = bulk(billing_db, monkeypatch, [(1, 1000.0), (2, 300.0), (3, 400.0), (4, 1.0)])
+
+    assert [i["ok"] for i in result["items"]] == [True, True, True, False]
+    assert result["updated"] == 3
+    assert result["failed"] == 1
+    assert result["items"][3]["status"] == 404
+
+    assert billing_db.wallets[10] == Decimal("900.00")
+    for dispatch_id, liters in ((2, "300.0"), (3, "400.0")):
+        assert billing_db.dispatches[dispatch_id]["liters"] == Decimal(liters)
+        assert billing_db.dispatches[dispatch_id]["closed_at"] is not None
+
+
+def test_bulk_replay_is_idempotent(billing_db, prepaid, monkeypatch):
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(2, company_id=10, billing_status=None)
+
+    bulk(billing_db, monkeypatch, [(1, 1000.0), (2, 300.0)])
+    result = bulk(billing_db, monkeypatch, [(1, 1000.0), (2, 300.0)])
+
+    assert result["failed"] == 0
+    assert billing_db.wallets[10] == Decimal("900.00")
+    assert len(billing_db.movements) == 1
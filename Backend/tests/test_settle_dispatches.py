@@ -0,0 +1,67 @@
+import asyncio
+from decimal import Decimal
+
+from app.services.prepaid import settle_dispatches
+
+
+def settle(db, items):
+    return asyncio.run(settle_dispatches(db.cursor(), [(i, Decimal(l)) for i, l in items]))
+
+
+def test_batch_debits_each_company_in_id_order(billing_db, prepaid):
+    billing_db.wallets.update({10: Decimal("1000"), 20: Decimal("500")})
+    billing_db.add_dispatch(3, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(2, company_id=20, billing_status="active", price_per_m3="50")
+
+    results = settle(billing_db, [(3, "2000"), (2, "1000"), (1, "1000")])
+
+    assert all(r["ok"] for r in results.values())
+    assert billing_db.wallets == {10: Decimal("700.00"), 20: Decimal("450.00")}
+    # el último movimiento de cada empresa queda con su saldo final
+    assert billing_db.movements == [
+        (1, 10, Decimal("100.00"), Decimal("900.00")),
+        (2, 20, Decimal("50.00"), Decimal("450.00")),
+        (3, 10, Decimal("200.00"), Decimal("700.00")),
+    ]
+    assert results[3]["balance"] == Decimal("700.00")
+
+
+def test_rejected_item_does_not_block_the_batch(billing_db, prepaid):
+    billing_db.wallets[10] = Decimal("150")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(2, company_id=10, billing_status="active", price_per_m3="100")
+
+    results = settle(billing_db, [(1, "1000"), (2, "1000")])
+
+    assert results[1]["ok"]
+    assert results[2]["ok"] is False
+    assert results[2]["error"]["code"] == "DISPATCH_EXCEEDED_BALANCE"
+    assert billing_db.wallets[10] == Decimal("50.00")
+    assert billing_db.dispatches[2]["billing_status"] == "active"
+
+
+def test_completed_dispatch_repeat_and_change(billing_db, prepaid):
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    settle(billing_db, [(1, "1000")])
+
+    repeated = settle(billing_db, [(1, "1000")])[1]
+    changed = settle(billing_db, [(1, "1200")])[1]
+
+    assert repeated["ok"] and repeated["amount"] == Decimal("100.00")
+    assert changed["ok"] is False
+    assert changed["error"]["code"] == "COMPLETED_DISPATCH_CANNOT_CHANGE"
+    assert billing_db.wallets[10] == Decimal("900.00")
+    assert len(billing_db.movements) == 1
+
+
+def test_dispatch_without_wallet_or_price(billing_db, prepaid):
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.wallets[20] = Decimal("1000")
+    billing_db.add_dispatch(2, company_id=20, billing_status="active")
+
+    results = settle(billing_db, [(1, "10"), (2, "10")])
+
+    assert results[1]["error"]["code"] == "COMPANY_WALLET_NOT_FOUND"
+    assert results[2]["error"]["code"] == "DISPATCH_WITHOUT_PRICE"
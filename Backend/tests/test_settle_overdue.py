@@ -0,0 +1,52 @@
+import asyncio
+from decimal import Decimal
+
+from app.services.flow import supervisor
+from app.services.flow.supervisor import FlowSupervisor
+
+
+def cut(db, dispatch_id, liters):
+    # lo que deja _close: cerrado por el supervisor, sin cobrar
+    db.dispatches[dispatch_id].update(closed_at="now", close_reason="max_liters", liters=Decimal(liters))
+
+
+def test_settles_auto_stopped_dispatch(billing_db, prepaid, monkeypatch):
+    monkeypatch.setattr(supervisor, "pool", billing_db)
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    cut(billing_db, 1, "3000")
+
+    flow = FlowSupervisor()
+    asyncio.run(flow.settle_overdue())
+
+    assert billing_db.dispatches[1]["billing_status"] == "completed"
+    assert billing_db.wallets[10] == Decimal("700.00")
+    assert flow.stats()["settled_overdue"] == 1
+
+
+def test_open_or_reported_dispatches_are_left_alone(billing_db, prepaid, monkeypatch):
+    monkeypatch.setattr(supervisor, "pool", billing_db)
+    billing_db.wallets[10] = Decimal("1000")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    billing_db.add_dispatch(2, company_id=10, billing_status="completed", price_per_m3="100")
+    cut(billing_db, 2, "100")
+
+    asyncio.run(FlowSupervisor().settle_overdue())
+
+    assert billing_db.dispatches[1]["billing_status"] == "active"
+    assert billing_db.wallets[10] == Decimal("1000")
+
+
+def test_rejected_settlement_is_not_retried(billing_db, prepaid, monkeypatch):
+    monkeypatch.setattr(supervisor, "pool", billing_db)
+    billing_db.wallets[10] = Decimal("10")
+    billing_db.add_dispatch(1, company_id=10, billing_status="active", price_per_m3="100")
+    cut(billing_db, 1, "3000")
+
+    flow = FlowSupervisor()
+    asyncio.run(flow.settle_overdue())
+    asyncio.run(flow.settle_overdue())
+
+    assert billing_db.dispatches[1]["billing_status"] == "active"
+    assert flow.stats()["settle_errors"] == 1
+    assert flow.stats()["unsettleable"] == 1
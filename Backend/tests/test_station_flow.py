@@ -0,0 +1,107 @@
+from app.services.flow import supervisor
+from app.services.flow.supervisor import StationFlow
+
+
+def reading(seen, flow_l_min=None, liters=None):
+    return {"seen": seen, "flow_l_min": flow_l_min, "liters": liters}
+
+
+def run(flow, readings, start=0.0):
+    """
+    Un tick por segundo; devuelve (segundo, motivo) del primer corte.
+    """
+    for i, r in enumerate(readings):
+        reason = flow.tick(r, start + i)
+        if reason is not None:
+            return i, reason
+    return None
+
+
+def test_no_readings_never_stops():
+    flow = StationFlow("S1", 1, None)
+
+    assert run(flow, [None] * 100) is None
+    assert flow.state == "waiting"
+    assert not flow.stale
+
+
+def test_flowing_within_range():
+    flow = StationFlow("S1", 1, None)
+
+    assert run(flow, [reading(i, flow_l_min=600) for i in range(20)]) is None
+    assert flow.state == "flowing"
+    assert flow.flow_lps == 10
+
+
+def test_zero_flow_after_flowing_stops_as_stalled():
+    flow = StationFlow("S1", 1, None)
+    run(flow, [reading(i, flow_l_min=600) for i in range(5)])
+
+    zeros = [reading(5 + i, flow_l_min=0) for i in range(supervisor.ZERO_FLOW_TICKS_TO_STOP)]
+    tick, reason = run(flow, zeros, start=5)
+
+    assert reason == "zero_flow"
+    assert tick == supervisor.ZERO_FLOW_TICKS_TO_STOP - 1
+
+
+def test_never_flowed_stops_as_no_flow():
+    flow = StationFlow("S1", 1, None)
+
+    zeros = [reading(i, flow_l_min=0) for i in range(supervisor.ZERO_FLOW_TICKS_TO_STOP)]
+
+    assert run(flow, zeros)[1] == "no_flow"
+
+
+def test_stale_reading_is_unknown_not_zero_flow():
+    # Node-RED manda telemetría por lotes: entre un POST y el siguiente
+    # la última lectura envejece, pero el agua sigue corriendo
+    flow = StationFlow("S1", 1, None)
+    flow.tick(reading(0, flow_l_min=600), 0)
+
+    stale_from = supervisor.FLOW_READING_STALE_S + 1
+    for now in range(int(stale_from), int(stale_from) + 5 * supervisor.ZERO_FLOW_TICKS_TO_STOP):
+        assert flow.tick(reading(0, flow_l_min=600), now) is None
+
+    assert flow.stale
+    assert flow.state == "flowing"
+    assert flow.zero_ticks == 0
+
+
+def test_reading_within_window_is_used():
+    flow = StationFlow("S1", 1, None)
+    last = reading(0, flow_l_min=0)
+
+    ticks = [last] * supervisor.ZERO_FLOW_TICKS_TO_STOP
+    assert supervisor.ZERO_FLOW_TICKS_TO_STOP <= supervisor.FLOW_READING_STALE_S
+
+    assert run(flow, ticks)[1] == "no_flow"
+
+
+def test_fresh_reading_after_stale_resumes():
+    flow = StationFlow("S1", 1, None)
+    flow.tick(reading(0, flow_l_min=600), 0)
+    flow.tick(reading(0, flow_l_min=600), supervisor.FLOW_READING_STALE_S + 1)
+    assert flow.stale
+
+    now = supervisor.FLOW_READING_STALE_S + 2
+    assert flow.tick(reading(now, flow_l_min=600), now) is None
+    assert not flow.stale
+
+
+def test_max_liters_cuts_before_reaching_the_cap():
+    flow = StationFlow("S1", 1, 1000)
+
+    # a 10 L/s la válvula deja pasar REACTION_S * 10 litros más
+    lead = 10 * supervisor.REACTION_S
+    assert flow.tick(reading(0, flow_l_min=600, liters=900), 0) is None
+    assert flow.tick(reading(1, flow_l_min=600, liters=1000 - lead), 1) == "max_liters"
+
+
+def test_over_range_stops_after_sustained_ticks():
+    flow = StationFlow("S1", 1, None)
+    high = (supervisor.MAX_FLOW_LPS + 10) * 60
+
+    tick, reason = run(flow, [reading(i, flow_l_min=high) for i in range(10)])
+
+    assert reason == "over_range"
+    assert tick == supervisor.OVER_RANGE_TICKS_TO_STOP - 1
@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+
+import pytest
+
+from app.services.flow import telemetry
+from app.services.flow.telemetry import TelemetryIngestor
+
+
+T0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def at(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+class RecordingPool:
+    """
+    pool.connection() falso: guarda los UPDATE del volcado (o falla).
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.fail = False
+
+    def connection(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
+
+    def cursor(self):
+        return self
+
+    async def execute(self, sql, params):
+        if self.fail:
+            raise OSError("db down")
+        self.updates.append(dict(zip(params[0], zip(params[1], params[2]))))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = RecordingPool()
+    monkeypatch.setattr(telemetry, "pool", fake)
+    return fake
+
+
+def test_latest_keeps_newest_sample():
+    ing = TelemetryIngestor()
+    ing._observe(1, at(10), 100.0, 600.0)
+    # reintento atrasado de Node-RED
+    ing._observe(1, at(5), 50.0, 0.0)
+
+    latest = ing.latest(1)
+    assert latest["liters"] == 100.0
+    assert latest["flow_l_min"] == 600.0
+
+
+def test_partial_samples_merge():
+    ing = TelemetryIngestor()
+    ing._observe(1, at(1), 100.0, None)
+    ing._observe(1, at(2), None, 300.0)
+
+    assert (ing.latest(1)["liters"], ing.latest(1)["flow_l_min"]) == (100.0, 300.0)
+
+
+def test_flush_sends_only_changed_dispatches_once(db):
+    ing = TelemetryIngestor()
+    ing._observe(1, at(1), 100.0, 600.0)
+    ing._observe(2, at(1), 20.0, 60.0)
+
+    assert asyncio.run(ing.flush()) == 2
+    assert db.updates == [{1: (100.0, 600.0), 2: (20.0, 60.0)}]
+
+    ing._observe(2, at(2), 30.0, 60.0)
+    assert asyncio.run(ing.flush()) == 1
+    assert db.updates[-1] == {2: (30.0, 60.0)}
+
+    assert asyncio.run(ing.flush()) == 0
+
+
+def test_failed_flush_is_retried(db):
+    ing = TelemetryIngestor()
+    ing._observe(1, at(1), 100.0, 600.0)
+
+    db.fail = True
+    with pytest.raises(OSError):
+        asyncio.run(ing.flush())
+    assert ing.stats()["pending_dispatches"] == 1
+
+    db.fail = False
+    assert asyncio.run(ing.flush()) == 1
+    assert db.updates == [{1: (100.0, 600.0)}]
+
+
+def test_pulses_convert_to_liters(monkeypatch):
+    monkeypatch.setattr(telemetry, "FLOW_PULSES_PER_LITER", 4.0)
+
+    assert telemetry.sample_liters(None, 400) == 100.0
+    assert telemetry.sample_liters(12.0, 400) == 12.0